@@ -0,0 +1,6 @@
+"""Benchmarks for miniircd.
+
+Run them from the repository root, e.g.::
+
+    python -m benchmarks.idle_connections
+"""
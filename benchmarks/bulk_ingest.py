@@ -0,0 +1,108 @@
+"""Throughput of inbound bridge messages: one POST each versus /bulk.
+
+Starts miniircd with the webpy.py HTTP front end in a subprocess and has
+one IRC client in #bench count the PRIVMSGs it receives. The messages
+are posted either one per request to / or in batches to /bulk, over a
+single keep-alive HTTP connection.
+
+    python -m benchmarks.bulk_ingest --messages 5000 --batch-size 100
+"""
+
+import argparse
+import httplib
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib
+
+from benchmarks import common
+
+SERVER_CODE = """
+import threading
+import web
+import miniircd
+ircd = miniircd.Server(listen_host='127.0.0.1', ports=(%d,), verbose=False)
+import webpy
+http = web.httpserver.WSGIServer(('127.0.0.1', %d), webpy.app.wsgifunc())
+thread = threading.Thread(target=http.start)
+thread.setDaemon(True)
+thread.start()
+ircd.run()
+"""
+
+
+def post_single(connection, count):
+    for i in range(count):
+        body = urllib.urlencode({
+            "channel_name": "bench",
+            "user_name": "hook",
+            "text": "message %d" % i,
+        })
+        connection.request(
+            "POST", "/", body,
+            {"Content-Type": "application/x-www-form-urlencoded"})
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 200, response.status
+
+
+def post_bulk(connection, count, batch_size):
+    for start in range(0, count, batch_size):
+        body = "\n".join(
+            json.dumps({
+                "channel_name": "bench",
+                "user_name": "hook",
+                "text": "message %d" % i,
+            })
+            for i in range(start, min(count, start + batch_size)))
+        connection.request("POST", "/bulk", body,
+                           {"Content-Type": "application/x-ndjson"})
+        response = connection.getresponse()
+        results = json.loads(response.read())["results"]
+        assert response.status == 200, response.status
+        for result in results:
+            assert result["status"] == "delivered", result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    options = parser.parse_args()
+
+    irc_port = common.free_port()
+    http_port = common.free_port()
+    with open(os.devnull, "w") as devnull:
+        # webpy.py prints every single-message request.
+        proc = subprocess.Popen(
+            [sys.executable, "-c", SERVER_CODE % (irc_port, http_port)],
+            cwd=common.REPO_ROOT, stdout=devnull)
+    try:
+        common.wait_for_port(proc, irc_port)
+        common.wait_for_port(proc, http_port)
+        client = common.IRCClient(irc_port, "reader")
+        client.send("JOIN #bench")
+        client.expect(" 366 ")
+        for (mode, post) in [
+                ("single", lambda c: post_single(c, options.messages)),
+                ("bulk", lambda c: post_bulk(
+                    c, options.messages, options.batch_size))]:
+            connection = httplib.HTTPConnection("127.0.0.1", http_port)
+            start = time.time()
+            post(connection)
+            for i in range(options.messages):
+                client.expect(" PRIVMSG #bench :")
+            elapsed = time.time() - start
+            connection.close()
+            print("%-6s %6d messages in %6.2f s: %8.0f messages/s"
+                  % (mode, options.messages, elapsed,
+                     options.messages / elapsed))
+        client.close()
+    finally:
+        common.stop_server(proc)
+
+
+if __name__ == "__main__":
+    main()
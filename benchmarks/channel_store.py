@@ -0,0 +1,75 @@
+"""Startup time with persistent channels (Server state_dir).
+
+For each channel count, fills a ChannelStore with persistent channels
+that each have a topic and some a key, as a journal, then measures how
+long creating a Server with that state_dir takes: replaying the journal,
+and after compaction, loading the snapshot. Also reports file sizes and
+how long starting a compaction blocks the event loop; the snapshot is
+written by another thread.
+
+    python -m benchmarks.channel_store --channels 1000,10000,50000
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+
+import miniircd
+
+
+def fill(directory, count, changes):
+    store = miniircd.ChannelStore(directory)
+    store.load()
+    now = time.time()
+    for i in range(count):
+        key = "key%d" % i if i % 4 == 0 else None
+        store.set("#channel%d" % i, "The topic of channel %d" % i, now, key)
+    for i in range(changes):
+        store.set("#channel%d" % (i % count), "Topic change %d" % i, now,
+                  None)
+    store.close()
+
+
+def start_server(directory):
+    start = time.time()
+    server = miniircd.Server(verbose=False, state_dir=directory)
+    elapsed = time.time() - start
+    return (server, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", default="1000,10000,50000",
+                        help="comma-separated channel counts to try")
+    parser.add_argument("--changes", type=float, default=1.0,
+                        help="topic changes per channel in the journal")
+    options = parser.parse_args()
+
+    for count in [int(x) for x in options.channels.split(",")]:
+        directory = tempfile.mkdtemp(prefix="channel-store-")
+        try:
+            fill(directory, count, int(count * options.changes))
+            (server, from_journal) = start_server(directory)
+            assert len(server.channels) == count
+            journal_size = server.channel_store.journal_size
+            start = time.time()
+            server.channel_store.compact([
+                (x.name, x.topic, x.topic_time, x.key)
+                for x in server.channels.values()])
+            compact_time = time.time() - start
+            server.channel_store.close()
+            snapshot_size = server.channel_store.snapshot_size
+            (server, from_snapshot) = start_server(directory)
+            assert len(server.channels) == count
+        finally:
+            shutil.rmtree(directory)
+        print("%6d channels: journal %7.1f KiB, load %6.1f ms;"
+              " snapshot %7.1f KiB, load %6.1f ms; compaction %5.1f ms"
+              % (count, journal_size / 1024.0, from_journal * 1e3,
+                 snapshot_size / 1024.0, from_snapshot * 1e3,
+                 compact_time * 1e3))
+
+
+if __name__ == "__main__":
+    main()
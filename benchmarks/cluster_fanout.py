@@ -0,0 +1,153 @@
+"""Channel fan-out throughput of cluster.py with 1, 2, 4... workers.
+
+Starts cluster.py with each number of workers in turn and connects
+receivers that all join one channel; the kernel spreads them over the
+workers. Senders outside the channel then send messages to it, and the
+benchmark measures how long it takes until every receiver has every
+message. Receivers are read by several processes, so that reading is
+less likely to be the bottleneck than the server.
+
+    python -m benchmarks.cluster_fanout --workers 1,2,4 --receivers 400
+
+Scaling needs at least as many free cores as workers, plus some for
+the readers.
+"""
+
+import argparse
+import multiprocessing
+import select
+import socket
+import subprocess
+import sys
+import time
+
+from benchmarks import common
+
+_MARKER = b" PRIVMSG #fan "
+
+
+def read_messages(port, nicknames, ready, results, go):
+    """Connect receivers, then count the messages they get."""
+    sockets = []
+    for nickname in nicknames:
+        s = socket.create_connection(("127.0.0.1", port))
+        s.sendall(("NICK %s\r\nUSER %s 0 * :%s\r\nJOIN #fan\r\n"
+                   % (nickname, nickname, nickname)).encode("latin-1"))
+        data = b""
+        while b" 366 " not in data:
+            data += s.recv(65536)
+        s.setblocking(0)
+        sockets.append(s)
+    ready.put(len(sockets))
+    expected = go.get()
+    poller = select.poll()
+    by_fd = {}
+    counts = {}
+    tails = {}
+    for s in sockets:
+        poller.register(s.fileno(), select.POLLIN)
+        by_fd[s.fileno()] = s
+        counts[s.fileno()] = 0
+        tails[s.fileno()] = b""
+    remaining = len(sockets)
+    while remaining:
+        for (fd, _) in poller.poll(10000):
+            try:
+                data = by_fd[fd].recv(262144)
+            except socket.error:
+                continue
+            # A marker split over two reads is only counted once, as
+            # the tail is shorter than the marker.
+            data = tails[fd] + data
+            counts[fd] += data.count(_MARKER)
+            tails[fd] = data[-(len(_MARKER) - 1):]
+            if counts[fd] >= expected:
+                poller.unregister(fd)
+                remaining -= 1
+    results.put((time.time(), sum(counts.values())))
+
+
+def measure(workers, options):
+    port = common.free_port()
+    proc = subprocess.Popen(
+        [sys.executable, "cluster.py", "--workers", str(workers),
+         "--listen", "127.0.0.1", "--ports", str(port)],
+        cwd=common.REPO_ROOT)
+    try:
+        common.wait_for_port(proc, port)
+        ready = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        gos = []
+        readers = []
+        for i in range(options.readers):
+            go = multiprocessing.Queue()
+            nicknames = ["r%d_%d" % (i, j) for j in range(
+                i, options.receivers, options.readers)]
+            reader = multiprocessing.Process(
+                target=read_messages,
+                args=(port, nicknames, ready, results, go))
+            reader.start()
+            gos.append(go)
+            readers.append(reader)
+        for _ in readers:
+            ready.get()
+        senders = [common.IRCClient(port, "s%d" % i)
+                   for i in range(options.senders)]
+        # Let the joins reach all workers.
+        time.sleep(1)
+        expected = options.senders * options.messages
+        for go in gos:
+            go.put(expected)
+
+        cpu_before = common.process_cpu_time(proc.pid)
+        start = time.time()
+        text = "x" * options.size
+        for first in range(0, options.messages, options.batch):
+            for sender in senders:
+                sender.send_lines(
+                    ["PRIVMSG #fan :%d %s" % (i, text)
+                     for i in range(first, min(options.messages,
+                                               first + options.batch))])
+            # Keep the senders from running far ahead of the fan-out.
+            for sender in senders:
+                sender.ping()
+        done = [results.get() for _ in readers]
+        elapsed = max(when for (when, _) in done) - start
+        delivered = sum(count for (_, count) in done)
+        hub_cpu = common.process_cpu_time(proc.pid) - cpu_before
+        for reader in readers:
+            reader.join()
+    finally:
+        common.stop_server(proc)
+    return (delivered, elapsed, hub_cpu)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4",
+                        help="comma-separated worker counts to try")
+    parser.add_argument("--receivers", type=int, default=400)
+    parser.add_argument("--readers", type=int, default=4,
+                        help="processes reading the receivers")
+    parser.add_argument("--senders", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=2000,
+                        help="messages per sender")
+    parser.add_argument("--batch", type=int, default=50,
+                        help="messages sent per sender between PINGs")
+    parser.add_argument("--size", type=int, default=40,
+                        help="bytes of text per message")
+    options = parser.parse_args()
+
+    common.raise_fd_limit(2 * options.receivers + 100)
+    print("%d CPUs, %d receivers, %d x %d messages"
+          % (multiprocessing.cpu_count(), options.receivers,
+             options.senders, options.messages))
+    for workers in [int(x) for x in options.workers.split(",")]:
+        (delivered, elapsed, hub_cpu) = measure(workers, options)
+        print("%d workers: %d lines delivered in %.2f s, %.0f lines/s;"
+              " hub CPU %.2f s"
+              % (workers, delivered, elapsed, delivered / elapsed, hub_cpu))
+
+
+if __name__ == "__main__":
+    main()
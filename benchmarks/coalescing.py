@@ -0,0 +1,179 @@
+"""Batches formed by bridge.Coalescer in front of a WebhookDispatcher.
+
+Starts a stub webhook that records the messages in each request, and a
+miniircd subprocess relaying #bridged to it through a Coalescer. A
+client then talks in #bridged in three ways: bursts smaller than
+--max-batch, which should go out one batch per --window; a burst of
+several times --max-batch, which should go out in full batches as it
+arrives; and a few last messages followed by SIGTERM, which should go
+out when the coalescer is stopped. Reports the batches the webhook got
+and the coalescer's metrics from STATS M, and exits with status 1 if a
+message was lost or out of order.
+
+    python -m benchmarks.coalescing --window 0.5 --max-batch 20
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import SocketServer
+import subprocess
+import sys
+import threading
+import time
+import urlparse
+
+from benchmarks import common
+
+SERVER_CODE = """
+import signal
+import bridge
+import miniircd
+server = miniircd.Server(listen_host='127.0.0.1', ports=(%(port)d,),
+                         verbose=False)
+dispatcher = bridge.WebhookDispatcher(workers=1)
+dispatcher.register_metrics(server.metrics)
+coalescer = bridge.Coalescer(dispatcher, window=%(window)r,
+                             max_batch=%(max_batch)d)
+coalescer.register_metrics(server.metrics)
+coalescer.start(server.scheduler)
+bridge.bridge_channels({'#bridged': %(url)r}, coalescer)
+dispatcher.start()
+signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+server.run()
+coalescer.stop()
+server.close()
+dispatcher.stop(10)
+"""
+
+
+class RecordingWebhook(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ("127.0.0.1", 0), RecordingWebhookHandler)
+        self.batches = []  # Message texts, per request.
+        self.lock = threading.Lock()
+
+    def messages(self):
+        with self.lock:
+            return sum(len(x) for x in self.batches)
+
+
+class RecordingWebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive.
+
+    def do_POST(self):
+        length = int(self.headers.getheader("content-length", 0))
+        body = self.rfile.read(length)
+        payload = json.loads(urlparse.parse_qs(body)["payload"][0])
+        texts = [x["text"] for x in payload.get("messages", [payload])]
+        with self.server.lock:
+            self.server.batches.append(texts)
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write("ok")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def wait_for(webhook, count, timeout):
+    deadline = time.time() + timeout
+    while webhook.messages() < count and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--window", type=float, default=0.5,
+                        help="coalescing window in seconds")
+    parser.add_argument("--max-batch", type=int, default=20)
+    parser.add_argument("--bursts", type=int, default=5,
+                        help="bursts smaller than --max-batch")
+    parser.add_argument("--burst-size", type=int, default=7)
+    options = parser.parse_args()
+
+    webhook = RecordingWebhook()
+    thread = threading.Thread(target=webhook.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    url = "http://127.0.0.1:%d/hook" % webhook.server_address[1]
+
+    port = common.free_port()
+    proc = subprocess.Popen(
+        [sys.executable, "-c", SERVER_CODE % {
+            "port": port, "url": url, "window": options.window,
+            "max_batch": options.max_batch}],
+        cwd=common.REPO_ROOT)
+    sent = []
+    phases = []  # (name, index of the first batch)
+
+    def say(client, count):
+        lines = []
+        for _ in range(count):
+            sent.append("message %d" % len(sent))
+            lines.append("PRIVMSG #bridged :%s" % sent[-1])
+        client.send_lines(lines)
+        # The server has handled the lines once it answers the PING.
+        client.ping()
+
+    try:
+        common.wait_for_port(proc, port)
+        talker = common.IRCClient(port, "talker")
+        talker.send("JOIN #bridged")
+        talker.expect(" 366 ")
+        timeout = options.window * 2 + 10
+
+        phases.append(("window", len(webhook.batches)))
+        for _ in range(options.bursts):
+            say(talker, options.burst_size)
+            wait_for(webhook, len(sent), timeout)
+
+        phases.append(("full", len(webhook.batches)))
+        say(talker, options.max_batch * 3 + options.burst_size)
+        wait_for(webhook, len(sent), timeout)
+
+        talker.send("STATS M")
+        metrics = []
+        while True:
+            line = talker.expect(" 249 ", " 219 ")
+            if " 219 " in line:
+                break
+            sample = line.split(" :", 1)[1]
+            if sample.startswith(("webhook_batch", "webhook_coalesc")):
+                metrics.append(sample)
+
+        phases.append(("stop", len(webhook.batches)))
+        say(talker, options.burst_size)
+        proc.terminate()
+        proc.wait()
+        wait_for(webhook, len(sent), 10)
+    finally:
+        if proc.poll() is None:
+            common.stop_server(proc)
+        webhook.shutdown()
+
+    print("window %.2f s, max batch %d, %d messages"
+          % (options.window, options.max_batch, len(sent)))
+    phases.append((None, len(webhook.batches)))
+    for ((name, first), (_, end)) in zip(phases, phases[1:]):
+        print("%-6s batches: %s" % (
+            name, " ".join(str(len(x)) for x in webhook.batches[first:end])
+            or "-"))
+    print("metrics before stopping:")
+    for sample in metrics:
+        print("  " + sample)
+    received = [text for batch in webhook.batches for text in batch]
+    if received != sent:
+        print("webhook got %d of %d messages, or not in order"
+              % (len(received), len(sent)))
+        sys.exit(1)
+    print("all messages delivered in order")
+
+
+if __name__ == "__main__":
+    main()
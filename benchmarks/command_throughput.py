@@ -0,0 +1,71 @@
+"""Server throughput for a mix of JOIN, PRIVMSG and PART commands.
+
+A number of clients each pipeline rounds of JOIN, PRIVMSG and PART over
+a shared set of mixed-case channel names, then wait for a PONG. Reports
+commands per second of wall time and of server CPU time, which is
+dominated by command dispatch and nickname/channel name lookups.
+
+    python -m benchmarks.command_throughput --clients 20 --rounds 2000
+"""
+
+import argparse
+import threading
+import time
+
+from benchmarks import common
+
+
+def run_client(client, script):
+    client.socket.sendall(script)
+    client.expect("PONG")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=2000,
+                        help="JOIN/PRIVMSG/PART rounds per client")
+    parser.add_argument("--channels", type=int, default=50)
+    options = parser.parse_args()
+
+    port = common.free_port()
+    proc = common.start_server(port)
+    try:
+        clients = [common.IRCClient(port, "Client[%d]" % i)
+                   for i in range(options.clients)]
+        scripts = []
+        for (i, client) in enumerate(clients):
+            lines = []
+            for j in range(options.rounds):
+                channel = "#Chan^%d" % ((i + j) % options.channels)
+                lines.append("JOIN %s" % channel)
+                lines.append("PRIVMSG %s :hello from %s"
+                             % (channel.lower(), client.nickname))
+                lines.append("PART %s" % channel.upper())
+            lines.append("PING :done")
+            scripts.append("".join(line + "\r\n" for line in lines))
+        threads = [threading.Thread(target=run_client, args=(client, script))
+                   for (client, script) in zip(clients, scripts)]
+        cpu_before = common.process_cpu_time(proc.pid)
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        cpu_after = common.process_cpu_time(proc.pid)
+        commands = 3 * options.rounds * options.clients
+        print("%d commands in %.2f s: %.0f commands/s"
+              % (commands, elapsed, commands / elapsed))
+        if cpu_before is not None:
+            cpu = cpu_after - cpu_before
+            print("server CPU %.2f s: %.0f commands/CPU s"
+                  % (cpu, commands / cpu))
+        for client in clients:
+            client.close()
+    finally:
+        common.stop_server(proc)
+
+
+if __name__ == "__main__":
+    main()
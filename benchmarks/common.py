@@ -0,0 +1,159 @@
+"""Helpers shared by the benchmark scripts."""
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def raise_fd_limit(wanted):
+    """Raise RLIMIT_NOFILE towards wanted; return the resulting limit.
+
+    Subprocesses started afterwards inherit the new limit.
+    """
+    try:
+        import resource
+    except ImportError:
+        return wanted
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+        soft = wanted
+    return soft
+
+
+def start_server(port, server_args="", python=None, prelude=""):
+    """Start miniircd in a subprocess listening on 127.0.0.1:port.
+
+    server_args is extra keyword argument source text for Server() and
+    prelude is source code to run before the server is created.
+    """
+    code = ("%s\n"
+            "import miniircd\n"
+            "miniircd.Server(listen_host='127.0.0.1', ports=(%d,), "
+            "verbose=False%s).run()\n"
+            % (prelude, port, server_args and ", " + server_args))
+    proc = subprocess.Popen([python or sys.executable, "-c", code],
+                            cwd=REPO_ROOT)
+    wait_for_port(proc, port)
+    return proc
+
+
+def wait_for_port(proc, port, timeout=10):
+    """Wait until proc accepts connections on 127.0.0.1:port.
+
+    proc may be None for a server running in this process.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except socket.error:
+            if proc is not None and proc.poll() is not None \
+                    or time.time() > deadline:
+                raise RuntimeError("server did not start")
+            time.sleep(0.05)
+
+
+def stop_server(proc):
+    """Terminate proc, unless it has already exited, and wait for it."""
+    if proc.poll() is None:
+        try:
+            proc.terminate()
+        except OSError:
+            pass  # It exited in the meantime.
+    proc.wait()
+
+
+class IRCClient(object):
+    """Minimal blocking IRC client."""
+
+    def __init__(self, port, nickname=None, timeout=30):
+        self.socket = socket.create_connection(("127.0.0.1", port))
+        self.socket.settimeout(timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.nickname = nickname
+        self._buffer = b""
+        if nickname:
+            self.send("NICK %s" % nickname)
+            self.send("USER %s 0 * :%s" % (nickname, nickname))
+            self.expect(" 422 ", " 376 ")
+
+    def send(self, line):
+        self.socket.sendall((line + "\r\n").encode("latin-1"))
+
+    def send_lines(self, lines):
+        self.socket.sendall(
+            "".join(line + "\r\n" for line in lines).encode("latin-1"))
+
+    def read_line(self):
+        while b"\n" not in self._buffer:
+            data = self.socket.recv(65536)
+            if not data:
+                raise EOFError("connection closed")
+            self._buffer += data
+        (line, self._buffer) = self._buffer.split(b"\n", 1)
+        return line.rstrip(b"\r").decode("latin-1")
+
+    def expect(self, *patterns):
+        while True:
+            line = self.read_line()
+            for pattern in patterns:
+                if pattern in line:
+                    return line
+
+    def ping(self, token="bench"):
+        """Return the round-trip time of a PING in seconds."""
+        start = time.time()
+        self.send("PING :%s" % token)
+        self.expect("PONG")
+        return time.time() - start
+
+    def close(self):
+        self.socket.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def process_cpu_time(pid):
+    """Return the CPU seconds used by process pid, or None if unknown."""
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except IOError:
+        return None
+    # utime and stime are fields 14 and 15 of stat(5), in clock ticks.
+    return (int(fields[11]) + int(fields[12])) \
+        / float(os.sysconf("SC_CLK_TCK"))
+
+
+def process_rss(pid):
+    """Return the resident set size of process pid in bytes, or None."""
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
@@ -0,0 +1,84 @@
+"""Per-line cost of parsing and dispatching client commands.
+
+Runs a miniircd Server in-process without its event loop. One registered
+client is connected over loopback; batches of commands are written to it
+and handed to the server with Client.socket_readable_notification, while
+the replies are drained. Reports microseconds per command line, which is
+mostly parsing, dispatch and the handler itself.
+
+    python -m benchmarks.dispatch --lines 200000
+"""
+
+import argparse
+import socket
+import time
+
+import miniircd
+
+COMMANDS = [
+    "PING :token",
+    "PRIVMSG #bench :hello there",
+    "NOTICE #bench :hello there",
+    "TOPIC #bench",
+    "MODE #bench",
+    "ISON alice bench nobody",
+    "AWAY",
+    "PONG :token",
+    "FOO bar",
+]
+
+
+def connect(server):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    peer = socket.create_connection(listener.getsockname())
+    (conn, _) = listener.accept()
+    listener.close()
+    server.add_client(conn)
+    return (server.clients[conn], peer)
+
+
+def feed(client, peer, data):
+    peer.sendall(data)
+    while True:
+        client.socket_readable_notification()
+        try:
+            while peer.recv(65536):
+                pass
+        except socket.error:
+            pass
+        # The client's socket is non-blocking; stop once all is read.
+        try:
+            if not client.socket.recv(1, socket.MSG_PEEK):
+                break
+        except socket.error:
+            break
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--batch", type=int, default=200,
+                        help="command lines per read")
+    options = parser.parse_args()
+
+    server = miniircd.Server(listen_host="127.0.0.1", verbose=False)
+    (client, peer) = connect(server)
+    peer.setblocking(0)
+    feed(client, peer, "NICK bench\r\nUSER bench 0 * :bench\r\n"
+                       "JOIN #bench\r\n")
+    batch = "".join(COMMANDS[i % len(COMMANDS)] + "\r\n"
+                    for i in range(options.batch))
+    batches = max(1, options.lines // options.batch)
+    start = time.time()
+    for _ in range(batches):
+        feed(client, peer, batch)
+    elapsed = time.time() - start
+    lines = batches * options.batch
+    print("%d lines in %.2f s: %.2f us/line, %.0f lines/s"
+          % (lines, elapsed, 1e6 * elapsed / lines, lines / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Latency for well-behaved clients while another client floods.
+
+A flooder sends WHO and PRIVMSG lines to a busy channel as fast as the
+server takes them, while a talker and an observer in a quiet channel
+measure channel delivery and PING round-trip times, sending well under
+--flood-rate commands per second themselves. This is done once
+without the client token bucket and once with --flood-rate, and with no
+flooder for reference. Lines per iteration are bounded in all cases, so
+even without the token bucket the flooder only gets its share of each
+loop iteration; with it, it is also held to --flood-rate commands per
+second and its reads are paused, leaving the rest in its socket buffers.
+
+    python -m benchmarks.flood_latency --flood-rate 50 --seconds 10
+"""
+
+import argparse
+import socket
+import threading
+import time
+
+from benchmarks import common
+
+
+def flood(port, members, stop):
+    """Flood #busy from one client until stop is set."""
+    listeners = [common.IRCClient(port, "member%d" % i)
+                 for i in range(members)]
+    for client in listeners:
+        client.send("JOIN #busy")
+        client.expect(" 366 ")
+    flooder = common.IRCClient(port, "flooder")
+    flooder.send("JOIN #busy")
+    flooder.expect(" 366 ")
+    for client in listeners + [flooder]:
+        client.socket.settimeout(0.5)
+
+    def drain():
+        while not stop.is_set():
+            for client in listeners + [flooder]:
+                if stop.is_set():
+                    break
+                try:
+                    client.socket.recv(262144)
+                except socket.error:
+                    pass
+    reader = threading.Thread(target=drain)
+    reader.setDaemon(True)
+    reader.start()
+    batch = "".join("WHO #busy\r\nPRIVMSG #busy :%s\r\n" % ("x" * 100)
+                    for _ in range(100))
+    while not stop.is_set():
+        try:
+            flooder.socket.sendall(batch)
+        except socket.timeout:
+            pass  # The server has stopped reading.
+        except socket.error:
+            break  # The server has stopped.
+    reader.join()
+    for client in listeners + [flooder]:
+        client.socket.close()
+
+
+def measure(server_args, options, flooding):
+    port = common.free_port()
+    proc = common.start_server(port, server_args)
+    stop = threading.Event()
+    flooder = None
+    try:
+        talker = common.IRCClient(port, "talker")
+        observer = common.IRCClient(port, "observer")
+        for client in (talker, observer):
+            client.send("JOIN #quiet")
+            client.expect(" 366 ")
+        if flooding:
+            flooder = threading.Thread(
+                target=flood, args=(port, options.members, stop))
+            flooder.setDaemon(True)
+            flooder.start()
+            time.sleep(1)
+        rtts = []
+        deliveries = []
+        deadline = time.time() + options.seconds
+        i = 0
+        while time.time() < deadline:
+            start = time.time()
+            talker.send("PRIVMSG #quiet :message %d" % i)
+            observer.expect("message %d" % i)
+            deliveries.append(time.time() - start)
+            rtts.append(talker.ping())
+            i += 1
+            time.sleep(options.interval)
+    finally:
+        stop.set()
+        if flooder is not None:
+            # Let it stop writing before the server goes away.
+            flooder.join(10)
+        common.stop_server(proc)
+    return (rtts, deliveries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--flood-rate", type=float, default=50,
+                        help="commands per second allowed per client")
+    parser.add_argument("--interval", type=float, default=0.1,
+                        help="seconds between the talker's messages")
+    parser.add_argument("--seconds", type=float, default=10,
+                        help="measuring time per configuration")
+    parser.add_argument("--members", type=int, default=20,
+                        help="other members of the flooded channel")
+    options = parser.parse_args()
+
+    for (name, server_args, flooding) in (
+            ("no flooder", "", False),
+            ("no token bucket", "", True),
+            ("token bucket", "flood_rate=%r" % options.flood_rate, True)):
+        (rtts, deliveries) = measure(server_args, options, flooding)
+        print(name)
+        for (what, values) in (("PING round trip", rtts),
+                               ("channel delivery", deliveries)):
+            print("  %-17s p50 %8.2f ms  p99 %8.2f ms  max %8.2f ms" % (
+                what + ":",
+                common.percentile(values, 0.5) * 1e3,
+                common.percentile(values, 0.99) * 1e3,
+                max(values) * 1e3))
+
+
+if __name__ == "__main__":
+    main()
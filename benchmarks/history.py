@@ -0,0 +1,72 @@
+"""Cost of channel history: logging channel messages and replaying them.
+
+Runs a miniircd Server in-process without its event loop, like
+benchmarks.dispatch, and feeds it PRIVMSG lines to a channel with
+history disabled, kept in memory only, and also logged to disk. Then
+times CHATHISTORY requests that have to be served from the log.
+
+    python -m benchmarks.history --lines 200000
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+
+import miniircd
+from benchmarks.dispatch import connect, feed
+
+
+def make_server(mode, directory):
+    server = miniircd.Server(
+        listen_host="127.0.0.1", verbose=False,
+        history_dir=directory if mode == "disk" else None)
+    if mode == "off":
+        server.history_length = 0
+    (client, peer) = connect(server)
+    peer.setblocking(0)
+    feed(client, peer, "NICK bench\r\nUSER bench 0 * :bench\r\n"
+                       "JOIN #bench\r\n")
+    return (server, client, peer)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--batch", type=int, default=200,
+                        help="command lines per read")
+    parser.add_argument("--replays", type=int, default=200)
+    options = parser.parse_args()
+
+    batch = "".join("PRIVMSG #bench :message number %d with some text\r\n"
+                    % i for i in range(options.batch))
+    batches = max(1, options.lines // options.batch)
+    lines = batches * options.batch
+    directory = tempfile.mkdtemp()
+    try:
+        for mode in ("off", "memory", "disk"):
+            (server, client, peer) = make_server(mode, directory)
+            start = time.time()
+            for _ in range(batches):
+                feed(client, peer, batch)
+            # What the flush timer would have done meanwhile.
+            server.flush_history()
+            elapsed = time.time() - start
+            print("history %-6s: %.2f us/line" % (mode, 1e6 * elapsed / lines))
+
+        # Replays beyond the ring buffer are served from the log.
+        request = "CHATHISTORY LATEST #bench * %d\r\n" % (
+            server.history_replay_limit)
+        start = time.time()
+        for _ in range(options.replays):
+            feed(client, peer, request)
+        elapsed = time.time() - start
+        print("CHATHISTORY LATEST %d from disk: %.2f ms/request"
+              % (server.history_replay_limit,
+                 1e3 * elapsed / options.replays))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
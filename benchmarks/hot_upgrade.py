@@ -0,0 +1,168 @@
+"""Hot upgrades of gateway.py under load, checking that nothing is lost.
+
+Starts gateway.py, connects receivers that join one channel and senders
+that keep sending numbered messages to it, and sends SIGUSR2 every
+--interval seconds so that the gateway hands its clients over to a new
+process. Afterwards, every receiver must have got every message of
+every sender, in order, without being disconnected. Reports the longest
+time the receivers went without messages, and exits with status 1 if
+anything was lost.
+
+    python -m benchmarks.hot_upgrade --upgrades 3 --receivers 50
+"""
+
+import argparse
+import os
+import select
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import common
+
+
+def read_pid(path, old=None, timeout=30):
+    """Return the process ID in path once it is there and not old."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with open(path) as f:
+                pid = int(f.read())
+            if pid != old:
+                return pid
+        except (IOError, ValueError):
+            pass
+        time.sleep(0.05)
+    raise RuntimeError("no new process")
+
+
+def send_messages(senders, rate, stop, sent):
+    """Send rate messages per second from each sender until stop."""
+    i = 0
+    while not stop.is_set():
+        start = time.time()
+        for sender in senders:
+            sender.send("PRIVMSG #load :%s %d" % (sender.nickname, i))
+        i += 1
+        sent[0] = i
+        time.sleep(max(0, 1.0 / rate - (time.time() - start)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--upgrades", type=int, default=3)
+    parser.add_argument("--interval", type=float, default=2.0,
+                        help="seconds between upgrades")
+    parser.add_argument("--receivers", type=int, default=50)
+    parser.add_argument("--senders", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=100,
+                        help="messages per second per sender")
+    options = parser.parse_args()
+
+    common.raise_fd_limit(2 * (options.receivers + options.senders) + 100)
+    port = common.free_port()
+    pid_file = tempfile.mktemp(prefix="gateway-", suffix=".pid")
+    proc = subprocess.Popen(
+        [sys.executable, "gateway.py", "--listen", "127.0.0.1",
+         "--ports", str(port), "--http-port", str(common.free_port()),
+         "--history-on-join", "0", "--pid-file", pid_file],
+        cwd=common.REPO_ROOT)
+    common.wait_for_port(proc, port)
+    pid = read_pid(pid_file)
+    stop = threading.Event()
+    try:
+        receivers = []
+        for i in range(options.receivers):
+            receiver = common.IRCClient(port, "r%d" % i)
+            receiver.send("JOIN #load")
+            receiver.expect(" 366 ")
+            receivers.append(receiver)
+        senders = [common.IRCClient(port, "s%d" % i)
+                   for i in range(options.senders)]
+        sent = [0]
+        sender_thread = threading.Thread(
+            target=send_messages, args=(senders, options.rate, stop, sent))
+        sender_thread.start()
+
+        by_fd = dict((r.socket.fileno(), r) for r in receivers)
+        # Receiver --> sender nickname --> next expected number
+        expected = dict((r, dict((s.nickname, 0) for s in senders))
+                        for r in receivers)
+        errors = []
+        longest_gap = 0.0
+        last_message = time.time()
+        upgrades = 0
+        next_upgrade = time.time() + options.interval
+        done_at = None
+        while True:
+            now = time.time()
+            if upgrades < options.upgrades and now >= next_upgrade:
+                os.kill(pid, signal.SIGUSR2)
+                pid = read_pid(pid_file, pid)
+                upgrades += 1
+                next_upgrade = time.time() + options.interval
+            elif upgrades == options.upgrades and done_at is None \
+                    and now >= next_upgrade:
+                stop.set()
+                sender_thread.join()
+                done_at = time.time()
+            if done_at is not None and all(
+                    n == sent[0] for counts in expected.values()
+                    for n in counts.values()):
+                break
+            if done_at is not None and time.time() > done_at + 10:
+                errors.append("timed out waiting for messages")
+                break
+            (readable, _, _) = select.select(list(by_fd), [], [], 0.1)
+            for fd in readable:
+                receiver = by_fd[fd]
+                data = receiver.socket.recv(262144)
+                if not data:
+                    errors.append("%s was disconnected" % receiver.nickname)
+                    del by_fd[fd]
+                    continue
+                receiver._buffer += data
+                while b"\n" in receiver._buffer:
+                    line = receiver.read_line()
+                    if " PRIVMSG #load :" not in line:
+                        if line.startswith("ERROR"):
+                            errors.append("%s: %s"
+                                          % (receiver.nickname, line))
+                        continue
+                    (nickname, number) = line.rsplit(" :", 1)[1].split()
+                    counts = expected[receiver]
+                    if int(number) != counts[nickname]:
+                        errors.append("%s got %s %s, expected %d" % (
+                            receiver.nickname, nickname, number,
+                            counts[nickname]))
+                    counts[nickname] = int(number) + 1
+                    now = time.time()
+                    longest_gap = max(longest_gap, now - last_message)
+                    last_message = now
+            if len(errors) > 10:
+                break
+    finally:
+        stop.set()
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+        proc.wait()
+        if os.path.exists(pid_file):
+            os.remove(pid_file)
+
+    print("%d upgrades, %d receivers, %d senders x %d messages"
+          % (upgrades, options.receivers, options.senders, sent[0]))
+    print("longest pause in deliveries: %.1f ms" % (longest_gap * 1e3))
+    if errors:
+        for error in errors[:10]:
+            print(error)
+        sys.exit(1)
+    print("all messages delivered in order")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Event loop cost as a function of the number of idle connections.
+
+Opens an increasing number of idle connections against a miniircd
+subprocess and measures PING round-trip time from one active client. With
+a persistent readiness backend the round-trip time should stay flat as
+idle connections grow; with per-iteration select() lists it grows
+linearly (and select() fails outright beyond FD_SETSIZE).
+
+    python -m benchmarks.idle_connections --counts 0,1000,4000
+"""
+
+import argparse
+import socket
+
+from benchmarks import common
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--counts", default="0,250,500,1000,2000,4000",
+                        help="comma-separated idle connection counts")
+    parser.add_argument("--samples", type=int, default=500,
+                        help="PING round trips per count")
+    options = parser.parse_args()
+    counts = sorted(int(x) for x in options.counts.split(","))
+
+    common.raise_fd_limit(2 * counts[-1] + 100)
+    port = common.free_port()
+    proc = common.start_server(port)
+    idle = []
+    try:
+        active = common.IRCClient(port, "active")
+        print("%8s %12s %12s" % ("idle", "p50 (us)", "p99 (us)"))
+        for count in counts:
+            while len(idle) < count:
+                idle.append(socket.create_connection(("127.0.0.1", port)))
+            for _ in range(20):
+                active.ping()  # Warm up.
+            rtts = [active.ping() for _ in range(options.samples)]
+            print("%8d %12.1f %12.1f" % (
+                count,
+                common.percentile(rtts, 0.5) * 1e6,
+                common.percentile(rtts, 0.99) * 1e6))
+    finally:
+        for s in idle:
+            s.close()
+        common.stop_server(proc)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""JOIN latency in a large channel.
+
+Fills a channel with N members whose connections are drained in a
+background thread, then measures the time from JOIN to the end of the
+NAMES reply (366) for a probe client that joins and parts repeatedly,
+and for a storm of clients joining at the same time. Also reports the
+longest NAMES line, which must stay within the 512 bytes of the RFC.
+
+    python -m benchmarks.join_storm --members 5000
+"""
+
+import argparse
+import select
+import socket
+import threading
+import time
+
+from benchmarks import common
+
+
+class Drainer(threading.Thread):
+    """Read and discard everything sent to a set of sockets."""
+
+    def __init__(self, sockets):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.sockets = dict((s.fileno(), s) for s in sockets)
+        self.stopped = False
+
+    def run(self):
+        poller = select.poll()
+        for fd in self.sockets:
+            poller.register(fd, select.POLLIN)
+        while not self.stopped:
+            for (fd, _) in poller.poll(100):
+                try:
+                    if not self.sockets[fd].recv(65536):
+                        poller.unregister(fd)
+                except socket.error:
+                    pass
+
+
+def connect(port, nickname, channel):
+    s = socket.create_connection(("127.0.0.1", port))
+    s.sendall(("NICK %s\r\nUSER %s 0 * :%s\r\nJOIN %s\r\n"
+               % (nickname, nickname, nickname, channel)).encode("latin-1"))
+    return s
+
+
+def wait_for_names(sockets, channel):
+    """Wait until each of sockets has got the end of channel's NAMES.
+
+    Returns the times at which each socket did, and the longest line
+    seen.
+    """
+    buffers = dict((s.fileno(), b"") for s in sockets)
+    by_fd = dict((s.fileno(), s) for s in sockets)
+    done = {}
+    longest = 0
+    poller = select.poll()
+    for fd in by_fd:
+        poller.register(fd, select.POLLIN)
+    marker = (" %s :End of NAMES" % channel).encode("latin-1")
+    while len(done) < len(sockets):
+        for (fd, _) in poller.poll(10000):
+            data = by_fd[fd].recv(65536)
+            if not data:
+                raise EOFError("connection closed")
+            lines = (buffers[fd] + data).split(b"\n")
+            buffers[fd] = lines.pop()
+            for line in lines:
+                longest = max(longest, len(line) + 1)
+                if marker in line and fd not in done:
+                    done[fd] = time.time()
+                    poller.unregister(fd)
+    return (list(done.values()), longest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=5000)
+    parser.add_argument("--joins", type=int, default=200,
+                        help="JOIN/PART rounds of the probe client")
+    parser.add_argument("--storm", type=int, default=500,
+                        help="clients joining at the same time")
+    options = parser.parse_args()
+
+    channel = "#big"
+    common.raise_fd_limit(2 * (options.members + options.storm) + 100)
+    port = common.free_port()
+    proc = common.start_server(port)
+    try:
+        # Members join in batches, each drained once it is in, so that
+        # the JOINs of later members don't pile up unread.
+        drainers = []
+        for first in range(0, options.members, 500):
+            batch = [connect(port, "m%d" % i, channel)
+                     for i in range(first, min(options.members, first + 500))]
+            wait_for_names(batch, channel)
+            drainers.append(Drainer(batch))
+            drainers[-1].start()
+
+        probe = common.IRCClient(port, "probe")
+        longest = 0
+        latencies = []
+        cpu_before = common.process_cpu_time(proc.pid)
+        for _ in range(options.joins):
+            start = time.time()
+            probe.send("JOIN %s" % channel)
+            while True:
+                line = probe.read_line()
+                longest = max(longest, len(line) + 2)
+                if " 366 " in line:
+                    break
+            latencies.append(time.time() - start)
+            probe.send("PART %s" % channel)
+            probe.expect(" PART ")
+        join_cpu = (common.process_cpu_time(proc.pid) - cpu_before) \
+            / options.joins
+
+        # A NAMES reply on its own, without the JOIN's fan-out.
+        names_latencies = []
+        probe.send("JOIN %s" % channel)
+        probe.expect(" 366 ")
+        for _ in range(options.joins):
+            start = time.time()
+            probe.send("NAMES %s" % channel)
+            probe.expect(" 366 ")
+            names_latencies.append(time.time() - start)
+
+        start = time.time()
+        storm = [connect(port, "s%d" % i, channel)
+                 for i in range(options.storm)]
+        (times, storm_longest) = wait_for_names(storm, channel)
+        storm_elapsed = max(times) - start
+        for drainer in drainers:
+            drainer.stopped = True
+    finally:
+        common.stop_server(proc)
+
+    print("probe JOIN to 366 in a %d-member channel: p50 %.2f ms, "
+          "p99 %.2f ms, server CPU %.2f ms per JOIN and PART"
+          % (options.members, 1e3 * common.percentile(latencies, 0.5),
+             1e3 * common.percentile(latencies, 0.99), 1e3 * join_cpu))
+    print("NAMES round trip: p50 %.2f ms, p99 %.2f ms"
+          % (1e3 * common.percentile(names_latencies, 0.5),
+             1e3 * common.percentile(names_latencies, 0.99)))
+    print("storm of %d JOINs: all NAMES replies done after %.2f s"
+          % (options.storm, storm_elapsed))
+    print("longest NAMES line: %d bytes" % max(longest, storm_longest))
+
+
+if __name__ == "__main__":
+    main()
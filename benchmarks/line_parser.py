@@ -0,0 +1,139 @@
+"""Line splitting and tokenising: regex parser vs LineBuffer.
+
+Feeds a synthetic but realistic stream of client-to-server IRC traffic
+through the parser miniircd used to have (1 KiB recv, regexp split of
+the whole read buffer, string module tokenising) and through
+LineBuffer.feed + parse_message, and reports lines per second.
+
+    python -m benchmarks.line_parser --read-size 16384
+"""
+
+import argparse
+import random
+import re
+import string
+import time
+
+import miniircd
+
+
+class LegacyParser(object):
+    """The parser Client used before LineBuffer, minus the dispatch."""
+
+    linesep_regexp = re.compile(r"\r?\n")
+
+    def __init__(self):
+        self.readbuffer = ""
+
+    def feed(self, data):
+        self.readbuffer += data
+        lines = self.linesep_regexp.split(self.readbuffer)
+        self.readbuffer = lines[-1]
+        lines = lines[:-1]
+        messages = []
+        for line in lines:
+            if not line:
+                continue
+            x = line.split(" ", 1)
+            command = x[0].upper()
+            if len(x) == 1:
+                arguments = []
+            else:
+                if len(x[1]) > 0 and x[1][0] == ":":
+                    arguments = [x[1][1:]]
+                else:
+                    y = string.split(x[1], " :", 1)
+                    arguments = string.split(y[0])
+                    if len(y) == 2:
+                        arguments.append(y[1])
+            messages.append((command, arguments))
+        return messages
+
+
+def make_traffic(nlines, seed=1):
+    rng = random.Random(seed)
+    words = ["the", "bridge", "is", "up", "again", "lol", "ok", "deploy",
+             "https://example.com/some/long/path?with=query", "ping", ":)",
+             "thanks", "channel", "message", "server", "anyone", "around"]
+    channels = ["#general", "#off-topic", "#ops", "#random", "#dev"]
+    lines = []
+    for _ in range(nlines):
+        r = rng.random()
+        if r < 0.80:
+            text = " ".join(rng.choice(words)
+                            for _ in range(rng.randint(1, 40)))
+            lines.append("PRIVMSG %s :%s" % (rng.choice(channels), text))
+        elif r < 0.85:
+            lines.append("NOTICE %s :%s" % (rng.choice(channels),
+                                            rng.choice(words)))
+        elif r < 0.90:
+            lines.append("PING :%d" % rng.randint(0, 10 ** 9))
+        elif r < 0.93:
+            lines.append("JOIN %s" % ",".join(rng.sample(channels, 2)))
+        elif r < 0.96:
+            lines.append("PART %s :bye" % rng.choice(channels))
+        elif r < 0.98:
+            lines.append("MODE %s +k key%d" % (rng.choice(channels),
+                                               rng.randint(0, 99)))
+        else:
+            lines.append("WHO %s" % rng.choice(channels))
+    return "".join(line + "\r\n" for line in lines)
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def run_legacy(data, read_size):
+    parser = LegacyParser()
+    count = 0
+    pieces = chunks(data, read_size)
+    start = time.time()
+    for piece in pieces:
+        count += len(parser.feed(piece))
+    return (count, time.time() - start)
+
+
+def run_linebuffer(data, read_size):
+    linebuffer = miniircd.LineBuffer()
+    parse_message = miniircd.parse_message
+    buf = bytearray(read_size)
+    count = 0
+    pieces = chunks(data, read_size)
+    start = time.time()
+    for piece in pieces:
+        # Stands in for socket.recv_into.
+        length = len(piece)
+        buf[:length] = piece
+        for line in linebuffer.feed(buf, length):
+            parse_message(line)
+            count += 1
+    return (count, time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--read-size", type=int, default=2 ** 14,
+                        help="read size for LineBuffer")
+    parser.add_argument("--repeat", type=int, default=3)
+    options = parser.parse_args()
+
+    data = make_traffic(options.lines)
+    print("%d lines, %d bytes" % (options.lines, len(data)))
+    runs = [
+        ("legacy, 1 KiB reads", run_legacy, 2 ** 10),
+        ("legacy, %d B reads" % options.read_size, run_legacy,
+         options.read_size),
+        ("LineBuffer, 1 KiB reads", run_linebuffer, 2 ** 10),
+        ("LineBuffer, %d B reads" % options.read_size, run_linebuffer,
+         options.read_size),
+    ]
+    for (name, function, read_size) in runs:
+        best = min(function(data, read_size)[1]
+                   for _ in range(options.repeat))
+        print("%-28s %10.0f lines/s" % (name, options.lines / best))
+
+
+if __name__ == "__main__":
+    main()
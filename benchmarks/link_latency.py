@@ -0,0 +1,123 @@
+"""Channel message latency across linked servers (links.py).
+
+Starts --servers instances of links.py linked in a chain, each one to
+the one before it, with a receiver on every server and a sender on the
+first, all in one channel. The sender sends messages one at a time and
+the benchmark measures how long each takes to reach the receivers 0,
+1, 2... hops away. --background adds clients on every server that talk
+in another channel, which does not concern the links.
+
+    python -m benchmarks.link_latency --servers 3 --messages 1000
+"""
+
+import argparse
+import select
+import socket
+import subprocess
+import sys
+import time
+
+from benchmarks import common
+
+
+def start_chain(count):
+    procs = []
+    ports = []
+    link_port = None
+    for i in range(count):
+        port = common.free_port()
+        args = [sys.executable, "links.py", "--name", "s%d" % i,
+                "--listen", "127.0.0.1", "--ports", str(port),
+                "--link-password", "bench"]
+        if i < count - 1:
+            next_link_port = common.free_port()
+            args += ["--link-port", str(next_link_port)]
+        if link_port is not None:
+            args += ["--peer", "127.0.0.1:%d" % link_port]
+        procs.append(subprocess.Popen(args, cwd=common.REPO_ROOT))
+        common.wait_for_port(procs[-1], port)
+        ports.append(port)
+        if i < count - 1:
+            link_port = next_link_port
+            common.wait_for_port(procs[-1], link_port)
+    return (procs, ports)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--background", type=int, default=0,
+                        help="chatting clients per server in #noise")
+    options = parser.parse_args()
+
+    (procs, ports) = start_chain(options.servers)
+    try:
+        receivers = []
+        for (i, port) in enumerate(ports):
+            receiver = common.IRCClient(port, "r%d" % i)
+            receiver.send("JOIN #lat")
+            receiver.expect(" 366 ")
+            receivers.append(receiver)
+        noise = []
+        for (i, port) in enumerate(ports):
+            for j in range(options.background):
+                client = common.IRCClient(port, "n%d_%d" % (i, j))
+                client.send("JOIN #noise")
+                client.expect(" 366 ")
+                noise.append(client)
+        sender = common.IRCClient(ports[0], "sender")
+        sender.send("JOIN #lat")
+        sender.expect(" 366 ")
+        # Wait until the last server knows the sender is in #lat.
+        last = receivers[-1]
+        last.send("NAMES #lat")
+        while "sender" not in last.expect(" 353 "):
+            time.sleep(0.1)
+            last.send("NAMES #lat")
+
+        by_fd = dict((r.socket.fileno(), r) for r in receivers)
+        latencies = [[] for _ in receivers]
+        for i in range(options.messages):
+            for client in noise:
+                client.send("PRIVMSG #noise :chatter %d" % i)
+            text = "m%d" % i
+            start = time.time()
+            sender.send("PRIVMSG #lat :%s" % text)
+            waiting = set(by_fd)
+            while waiting:
+                (readable, _, _) = select.select(list(waiting), [], [], 10)
+                if not readable:
+                    raise RuntimeError("message %d was lost" % i)
+                now = time.time()
+                for fd in readable:
+                    receiver = by_fd[fd]
+                    # Skip anything left over from earlier messages.
+                    while True:
+                        line = receiver.read_line()
+                        if line.endswith(" :" + text):
+                            break
+                    latencies[receivers.index(receiver)].append(now - start)
+                    waiting.remove(fd)
+            for client in noise:
+                client.socket.setblocking(0)
+                try:
+                    while client.socket.recv(65536):
+                        pass
+                except socket.error:
+                    pass
+                client.socket.setblocking(1)
+    finally:
+        for proc in procs:
+            common.stop_server(proc)
+
+    print("%d servers, %d messages, %d background clients per server"
+          % (options.servers, options.messages, options.background))
+    for (hops, values) in enumerate(latencies):
+        print("%d hops: p50 %7.3f ms  p99 %7.3f ms  max %7.3f ms" % (
+            hops, common.percentile(values, 0.5) * 1e3,
+            common.percentile(values, 0.99) * 1e3, max(values) * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Event loop stalls caused by LIST on a server with many channels.
+
+Creates N channels, then has several clients send LIST at the same time
+and read the replies slowly, while a probe client measures PING round
+trips. Reports the probe's worst round-trip time, how long the LISTs
+took, and how much the server's RSS grew meanwhile.
+
+    python -m benchmarks.list_replies --channels 10000 --listers 20
+"""
+
+import argparse
+import threading
+import time
+
+from benchmarks import common
+
+
+def read_list(client, delay, result):
+    count = 0
+    while True:
+        line = client.read_line()
+        if " 323 " in line:
+            break
+        count += 1
+        if count % 100 == 0:
+            time.sleep(delay)  # A slow reader.
+    result.append((count, time.time()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=10000)
+    parser.add_argument("--listers", type=int, default=20)
+    parser.add_argument("--delay", type=float, default=0.001,
+                        help="seconds a lister sleeps per 100 lines read")
+    options = parser.parse_args()
+
+    port = common.free_port()
+    proc = common.start_server(port)
+    try:
+        creator = common.IRCClient(port, "creator")
+        for first in range(0, options.channels, 1000):
+            creator.send("JOIN %s" % ",".join(
+                "#channel%d" % i
+                for i in range(first, min(options.channels, first + 1000))))
+            creator.ping()
+        probe = common.IRCClient(port, "probe")
+        listers = [common.IRCClient(port, "lister%d" % i)
+                   for i in range(options.listers)]
+        probe.ping()
+        rss_before = common.process_rss(proc.pid)
+
+        start = time.time()
+        results = []
+        threads = []
+        for lister in listers:
+            lister.send("LIST")
+            thread = threading.Thread(
+                target=read_list, args=(lister, options.delay, results))
+            thread.start()
+            threads.append(thread)
+        rtts = []
+        rss_peak = rss_before
+        while any(thread.is_alive() for thread in threads):
+            rtts.append(probe.ping())
+            rss_peak = max(rss_peak, common.process_rss(proc.pid))
+            time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+    finally:
+        common.stop_server(proc)
+
+    counts = set(count for (count, _) in results)
+    print("%d LISTs of %s channels done after %.2f s"
+          % (options.listers, "/".join(str(x) for x in counts),
+             max(done for (_, done) in results) - start))
+    print("probe PING during the LISTs: p50 %.2f ms, max %.2f ms"
+          % (1e3 * common.percentile(rtts, 0.5), 1e3 * max(rtts)))
+    print("server RSS grew by up to %d KiB"
+          % ((rss_peak - rss_before) // 1024))
+
+
+if __name__ == "__main__":
+    main()
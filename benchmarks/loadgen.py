@@ -0,0 +1,413 @@
+"""Synthetic load generator for miniircd.
+
+Starts a server on loopback, as a subprocess (the default) or in a thread
+of this process, and connects N clients that join channels out of M
+following a uniform or Zipf membership distribution. For the measured
+duration it sends channel PRIVMSGs at a fixed total rate, with optional
+JOIN, PART and NICK churn, and times every copy of each PRIVMSG from
+send to receipt.
+
+Reports delivered messages per second, p50/p99/p999 fan-out latency, the
+server's event loop iteration time, CPU time and RSS as JSON, so runs can
+be compared across changes:
+
+    python -m benchmarks.loadgen --clients 500 --channels 50 \\
+        --rate 2000 --duration 10 --output before.json
+"""
+
+import argparse
+import bisect
+import errno
+import json
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import common
+
+# Makes a subprocess server write its loop counters to a file on SIGUSR1.
+STATS_PRELUDE = """
+import json, os, signal
+import miniircd
+_run = miniircd.Server.run
+def run(self):
+    def dump(signum, frame):
+        with open(%(path)r + '.tmp', 'w') as f:
+            json.dump({'iterations': self.loop_seconds.count,
+                       'busy_time': self.loop_seconds.sum,
+                       'busy_max': self.loop_busy_max}, f)
+        os.rename(%(path)r + '.tmp', %(path)r)
+    signal.signal(signal.SIGUSR1, dump)
+    _run(self)
+miniircd.Server.run = run
+"""
+
+PAYLOAD_MARKER = " :lg "
+
+
+class LoadClient(object):
+    def __init__(self, index, sock):
+        self.index = index
+        self.socket = sock
+        self.nickname = "lg%d" % index
+        self.channels = set()
+        self.registered = False
+        self.pending_joins = 0
+        self.inbuf = b""
+        self.outbuf = b""
+
+
+class LoadGenerator(object):
+    def __init__(self, options, port):
+        self.options = options
+        self.port = port
+        self.random = random.Random(options.seed)
+        self.epoll = select.epoll()
+        self.clients = {}  # fd --> LoadClient
+        self.channel_names = ["#load%d" % i for i in range(options.channels)]
+        self.cumulative_weights = self.make_weights()
+        self.nick_sequence = options.clients
+        self.latencies = []
+        self.delivered = 0
+        self.sent = {"privmsg": 0, "join": 0, "part": 0, "nick": 0}
+        self.measuring = False
+
+    def make_weights(self):
+        if self.options.distribution == "zipf":
+            weights = [1.0 / (rank + 1) ** self.options.zipf_exponent
+                       for rank in range(self.options.channels)]
+        else:
+            weights = [1.0] * self.options.channels
+        total = 0.0
+        cumulative = []
+        for weight in weights:
+            total += weight
+            cumulative.append(total)
+        return [x / total for x in cumulative]
+
+    def pick_channel(self):
+        return self.channel_names[min(
+            len(self.channel_names) - 1,
+            bisect.bisect(self.cumulative_weights, self.random.random()))]
+
+    # Sending.
+
+    def send(self, client, line):
+        client.outbuf += line + "\r\n"
+        self.flush(client)
+
+    def flush(self, client):
+        try:
+            sent = client.socket.send(client.outbuf)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            sent = 0
+        client.outbuf = client.outbuf[sent:]
+        events = select.EPOLLIN
+        if client.outbuf:
+            events |= select.EPOLLOUT
+        self.epoll.modify(client.socket.fileno(), events)
+
+    # Receiving.
+
+    def poll(self, timeout):
+        for (fd, events) in self.epoll.poll(timeout):
+            client = self.clients[fd]
+            if events & select.EPOLLOUT:
+                self.flush(client)
+            if events & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                self.receive(client)
+
+    def receive(self, client):
+        try:
+            data = client.socket.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if not data:
+            raise RuntimeError("server closed %s" % client.nickname)
+        lines = (client.inbuf + data).split(b"\r\n")
+        client.inbuf = lines.pop()
+        now = time.time()
+        for line in lines:
+            position = line.find(PAYLOAD_MARKER)
+            if position >= 0:
+                if self.measuring:
+                    sent_at = float(line[position + len(PAYLOAD_MARKER):]
+                                    .split(" ", 1)[0])
+                    self.latencies.append(now - sent_at)
+                    self.delivered += 1
+            elif line.startswith("PING "):
+                self.send(client, "PONG " + line[5:])
+            elif " 001 " in line:
+                client.registered = True
+            elif " 366 " in line:
+                client.pending_joins -= 1
+
+    def wait_until(self, condition, what, timeout=60):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                raise RuntimeError("timed out waiting for %s" % what)
+            self.poll(0.1)
+
+    # Setup.
+
+    def connect(self):
+        for i in range(self.options.clients):
+            sock = socket.create_connection(("127.0.0.1", self.port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(0)
+            client = LoadClient(i, sock)
+            self.clients[sock.fileno()] = client
+            self.epoll.register(sock.fileno(), select.EPOLLIN)
+            self.send(client, "NICK %s\r\nUSER lg 0 * :Load generator"
+                      % client.nickname)
+            if i % 100 == 99:
+                self.poll(0)
+        self.wait_until(
+            lambda: all(x.registered for x in self.clients.values()),
+            "registration")
+        for client in self.clients.values():
+            while len(client.channels) < min(self.options.joins,
+                                             self.options.channels):
+                client.channels.add(self.pick_channel())
+            client.pending_joins = len(client.channels)
+            self.send(client, "JOIN %s" % ",".join(client.channels))
+            self.poll(0)
+        self.wait_until(
+            lambda: all(x.pending_joins <= 0 for x in self.clients.values()),
+            "joins")
+
+    # Load.
+
+    def do_privmsg(self):
+        client = self.random.choice(self.client_list)
+        if not client.channels:
+            return
+        channel = self.random.choice(list(client.channels))
+        self.send(client, "PRIVMSG %s%s%.6f %s"
+                  % (channel, PAYLOAD_MARKER, time.time(),
+                     "x" * self.options.message_size))
+        self.sent["privmsg"] += 1
+
+    def do_join(self):
+        client = self.random.choice(self.client_list)
+        channel = self.pick_channel()
+        if channel not in client.channels:
+            client.channels.add(channel)
+            self.send(client, "JOIN %s" % channel)
+            self.sent["join"] += 1
+
+    def do_part(self):
+        client = self.random.choice(self.client_list)
+        if client.channels:
+            channel = self.random.choice(list(client.channels))
+            client.channels.discard(channel)
+            self.send(client, "PART %s" % channel)
+            self.sent["part"] += 1
+
+    def do_nick(self):
+        client = self.random.choice(self.client_list)
+        client.nickname = "lg%d" % self.nick_sequence
+        self.nick_sequence += 1
+        self.send(client, "NICK %s" % client.nickname)
+        self.sent["nick"] += 1
+
+    def run(self):
+        options = self.options
+        self.client_list = list(self.clients.values())
+        actions = [(rate, action) for (rate, action) in [
+            (options.rate, self.do_privmsg),
+            (options.join_rate, self.do_join),
+            (options.part_rate, self.do_part),
+            (options.nick_rate, self.do_nick)] if rate > 0]
+        start = time.time()
+        end = start + options.duration
+        due = [start] * len(actions)
+        self.measuring = True
+        while True:
+            now = time.time()
+            if now >= end:
+                break
+            for (i, (rate, action)) in enumerate(actions):
+                # Don't try to catch up on more than a second of backlog.
+                due[i] = max(due[i], now - 1)
+                while due[i] <= now:
+                    action()
+                    due[i] += 1.0 / rate
+            self.poll(max(0, min(due + [end]) - time.time()))
+        elapsed = time.time() - start
+        # Collect copies that are still in flight.
+        drain_end = time.time() + options.drain
+        while time.time() < drain_end:
+            self.poll(drain_end - time.time())
+        self.measuring = False
+        return elapsed
+
+    def close(self):
+        for client in self.clients.values():
+            client.socket.close()
+        self.epoll.close()
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+
+    def at(fraction):
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(fraction * len(latencies)))
+        return 1000 * latencies[index]
+
+    return {
+        "count": len(latencies),
+        "p50_ms": at(0.5),
+        "p99_ms": at(0.99),
+        "p999_ms": at(0.999),
+        "max_ms": latencies and 1000 * latencies[-1] or None,
+    }
+
+
+def loop_summary(before, after):
+    if before is None or after is None:
+        return None
+    iterations = after["iterations"] - before["iterations"]
+    busy = after["busy_time"] - before["busy_time"]
+    return {
+        "iterations": iterations,
+        "mean_busy_us": iterations and 1e6 * busy / iterations,
+        "max_busy_us": 1e6 * after["busy_max"],
+    }
+
+
+class SubprocessServer(object):
+    def __init__(self, port):
+        self.stats_path = os.path.join(
+            tempfile.gettempdir(), "miniircd-loadgen-%d.json" % os.getpid())
+        self.proc = common.start_server(
+            port, prelude=STATS_PRELUDE % {"path": self.stats_path})
+        self.pid = self.proc.pid
+
+    def loop_stats(self):
+        if os.path.exists(self.stats_path):
+            os.unlink(self.stats_path)
+        os.kill(self.proc.pid, signal.SIGUSR1)
+        deadline = time.time() + 5
+        while not os.path.exists(self.stats_path):
+            if time.time() > deadline:
+                return None
+            time.sleep(0.01)
+        with open(self.stats_path) as f:
+            return json.load(f)
+
+    def stop(self):
+        common.stop_server(self.proc)
+        if os.path.exists(self.stats_path):
+            os.unlink(self.stats_path)
+
+
+class ThreadServer(object):
+    def __init__(self, port):
+        import miniircd
+        self.server = miniircd.Server(
+            listen_host="127.0.0.1", ports=(port,), verbose=False)
+        self.thread = threading.Thread(target=self.server.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.pid = os.getpid()
+        common.wait_for_port(None, port)
+
+    def loop_stats(self):
+        return {
+            "iterations": self.server.loop_seconds.count,
+            "busy_time": self.server.loop_seconds.sum,
+            "busy_max": self.server.loop_busy_max,
+        }
+
+    def stop(self):
+        self.server.inject(self.exit_loop)
+        self.thread.join()
+
+    @staticmethod
+    def exit_loop():
+        # Not an Exception, so it propagates out of Server.run and ends
+        # the thread quietly.
+        raise SystemExit
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--joins", type=int, default=3,
+                        help="channels joined by each client at start")
+    parser.add_argument("--distribution", choices=("uniform", "zipf"),
+                        default="uniform",
+                        help="how channel memberships are distributed")
+    parser.add_argument("--zipf-exponent", type=float, default=1.0)
+    parser.add_argument("--rate", type=float, default=1000,
+                        help="channel PRIVMSGs per second, in total")
+    parser.add_argument("--message-size", type=int, default=40,
+                        help="bytes of filler text per PRIVMSG")
+    parser.add_argument("--join-rate", type=float, default=0)
+    parser.add_argument("--part-rate", type=float, default=0)
+    parser.add_argument("--nick-rate", type=float, default=0)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--drain", type=float, default=2,
+                        help="seconds to wait for in-flight copies")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--in-process", action="store_true",
+                        help="run the server in a thread of this process")
+    parser.add_argument("--output", help="write the JSON result here")
+    options = parser.parse_args()
+
+    common.raise_fd_limit(2 * options.clients + 100)
+    port = common.free_port()
+    if options.in_process:
+        server = ThreadServer(port)
+    else:
+        server = SubprocessServer(port)
+    generator = LoadGenerator(options, port)
+    try:
+        generator.connect()
+        loop_before = server.loop_stats()
+        cpu_before = common.process_cpu_time(server.pid)
+        elapsed = generator.run()
+        loop_after = server.loop_stats()
+        cpu_after = common.process_cpu_time(server.pid)
+        result = {
+            "config": vars(options),
+            "server": "in-process" if options.in_process else "subprocess",
+            "elapsed_s": elapsed,
+            "sent": generator.sent,
+            "sent_privmsg_per_s": generator.sent["privmsg"] / elapsed,
+            "delivered": generator.delivered,
+            "delivered_per_s": generator.delivered / elapsed,
+            "latency": latency_summary(generator.latencies),
+            "loop": loop_summary(loop_before, loop_after),
+            "server_cpu_s": (cpu_before is not None
+                             and cpu_after - cpu_before or None),
+            # For --in-process this includes the load generator.
+            "server_rss_bytes": common.process_rss(server.pid),
+        }
+    finally:
+        generator.close()
+        server.stop()
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(text + "\n")
+    sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
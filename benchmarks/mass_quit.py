@@ -0,0 +1,95 @@
+"""Many clients disconnecting at once from shared channels.
+
+Connects N clients that all join the same few channels, plus some
+observers that stay, as after a network blip that drops most of a
+server's users. All N connections are then closed together. Reports
+how long it takes until every observer has seen every QUIT, and the
+server CPU time spent on it.
+
+    python -m benchmarks.mass_quit --clients 1000 --channels 3
+"""
+
+import argparse
+import socket
+import time
+
+from benchmarks import common
+
+
+def drain(sockets):
+    """Read whatever is waiting on sockets; return the bytes read."""
+    total = 0
+    for s in sockets:
+        while True:
+            try:
+                data = s.recv(65536)
+            except socket.error:
+                break
+            if not data:
+                break
+            total += len(data)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000,
+                        help="clients that quit")
+    parser.add_argument("--channels", type=int, default=3,
+                        help="channels, all joined by every client")
+    parser.add_argument("--observers", type=int, default=10)
+    options = parser.parse_args()
+
+    common.raise_fd_limit(2 * (options.clients + options.observers) + 100)
+    channels = ",".join("#c%d" % i for i in range(options.channels))
+    port = common.free_port()
+    proc = common.start_server(port)
+    try:
+        observers = []
+        for i in range(options.observers):
+            observer = common.IRCClient(port, "obs%d" % i)
+            observer.send("JOIN %s" % channels)
+            observer.ping()
+            observers.append(observer)
+        quitters = []
+        for i in range(options.clients):
+            s = socket.create_connection(("127.0.0.1", port))
+            s.sendall(("NICK q%d\r\nUSER q 0 * :q\r\nJOIN %s\r\n"
+                       % (i, channels)).encode("latin-1"))
+            s.setblocking(0)
+            quitters.append(s)
+            if i % 100 == 99:
+                drain(quitters)
+        # Let the server settle and read everything the joins produced,
+        # so the QUITs are all that is left to do.
+        while True:
+            for observer in observers:
+                observer.ping()
+            if not drain(quitters):
+                break
+            time.sleep(0.2)
+        for observer in observers:
+            observer.ping()
+
+        cpu_before = common.process_cpu_time(proc.pid)
+        start = time.time()
+        for s in quitters:
+            s.close()
+        for observer in observers:
+            quits = 0
+            while quits < options.clients:
+                if " QUIT :" in observer.read_line():
+                    quits += 1
+        elapsed = time.time() - start
+        cpu = common.process_cpu_time(proc.pid) - cpu_before
+    finally:
+        common.stop_server(proc)
+
+    print("%d clients in %d shared channels quit: all QUITs seen by %d "
+          "observers after %.3f s, server CPU %.3f s"
+          % (options.clients, options.channels, options.observers, elapsed,
+             cpu))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Server memory per connected client and per channel membership.
+
+Opens N loopback connections to a miniircd subprocess, registers them,
+and then has each join K of M channels. The server's resident set size
+is sampled when it has started, after registration and after the joins,
+and reported as bytes per client and bytes per membership. Needs Linux
+/proc.
+
+    python -m benchmarks.memory --clients 5000 --channels 1000 --joins 2
+"""
+
+import argparse
+import errno
+import socket
+import time
+
+from benchmarks import common
+
+
+def drain(sockets):
+    """Read and discard everything the server has sent to sockets."""
+    quiet = 0
+    while quiet < 2:
+        received = False
+        for s in sockets:
+            try:
+                while s.recv(65536):
+                    received = True
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+        if received:
+            quiet = 0
+        else:
+            quiet += 1
+            time.sleep(0.1)
+
+
+def settle(sockets, active):
+    drain(sockets)
+    # The server has handled everything sent before the PING once the
+    # PONG arrives.
+    active.ping()
+    drain(sockets)
+    time.sleep(0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=5000)
+    parser.add_argument("--channels", type=int, default=1000)
+    parser.add_argument("--joins", type=int, default=2,
+                        help="channels joined per client")
+    options = parser.parse_args()
+
+    common.raise_fd_limit(2 * options.clients + 100)
+    port = common.free_port()
+    proc = common.start_server(port)
+    sockets = []
+    try:
+        active = common.IRCClient(port, "active")
+        settle(sockets, active)
+        base = common.process_rss(proc.pid)
+        for i in range(options.clients):
+            s = socket.create_connection(("127.0.0.1", port))
+            s.sendall("NICK user%d\r\nUSER user%d 0 * :Idle user %d\r\n"
+                      % (i, i, i))
+            s.setblocking(0)
+            sockets.append(s)
+            if i % 500 == 499:
+                drain(sockets)
+        settle(sockets, active)
+        registered = common.process_rss(proc.pid)
+        for (i, s) in enumerate(sockets):
+            channels = ["#channel%d" % ((i + j * 7919) % options.channels)
+                        for j in range(options.joins)]
+            s.sendall("JOIN %s\r\n" % ",".join(channels))
+            if i % 500 == 499:
+                drain(sockets)
+        settle(sockets, active)
+        joined = common.process_rss(proc.pid)
+        memberships = options.clients * options.joins
+        print("server RSS at start:   %10d bytes" % base)
+        print("%6d clients:         %10d bytes, %6d bytes/client"
+              % (options.clients, registered,
+                 (registered - base) // options.clients))
+        print("%6d memberships:     %10d bytes, %6d bytes/membership"
+              % (memberships, joined, (joined - registered) // memberships))
+    finally:
+        for s in sockets:
+            s.close()
+        common.stop_server(proc)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Send queue limits with a client that never reads.
+
+A talker floods a channel that a reader and a stalled client (which
+never reads its socket) have joined. Without a send queue limit the
+server buffers everything for the stalled client; with one, the chosen
+policy must keep server memory bounded while the reader still gets every
+message. Reports server RSS growth and the policy counters from STATS M,
+and exits with status 1 if the policy did not do its job.
+
+    python -m benchmarks.slow_consumer --policy disconnect
+    python -m benchmarks.slow_consumer --policy none
+"""
+
+import argparse
+import re
+import socket
+import sys
+import threading
+
+from benchmarks import common
+
+
+def stats(client):
+    """Return the server's metric samples as a name --> value dict."""
+    client.send("STATS M")
+    result = {}
+    while True:
+        line = client.read_line()
+        if " 219 " in line:
+            return result
+        match = re.search(r" 249 \S+ :(\S+) (\S+)$", line)
+        if match:
+            result[match.group(1)] = float(match.group(2))
+
+
+def read_messages(client, count, result):
+    received = 0
+    while received < count:
+        line = client.read_line()
+        if " PRIVMSG #flood :" in line:
+            received += 1
+    result.append(received)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--policy", default="disconnect",
+                        choices=("none", "disconnect", "drop", "pause"))
+    parser.add_argument("--sendq", type=int, default=2 ** 20,
+                        help="per-client send queue limit in bytes")
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--size", type=int, default=400,
+                        help="bytes of text per message")
+    options = parser.parse_args()
+
+    if options.policy == "none":
+        server_args = ""
+    else:
+        server_args = ("sendq_limit=%d, global_sendq_limit=%d, "
+                       "sendq_policy=%r"
+                       % (options.sendq, 16 * options.sendq, options.policy))
+    port = common.free_port()
+    proc = common.start_server(port, server_args)
+    try:
+        reader = common.IRCClient(port, "reader")
+        talker = common.IRCClient(port, "talker")
+        stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        stalled.connect(("127.0.0.1", port))
+        stalled.sendall("NICK stalled\r\nUSER stalled 0 * :stalled\r\n"
+                        "JOIN #flood\r\n")
+        for client in (reader, talker):
+            client.send("JOIN #flood")
+            client.expect(" 366 ")
+        reader.ping()  # The stalled client has joined too.
+        rss_before = common.process_rss(proc.pid)
+
+        # The reader must keep up, or it would hit the limit too.
+        result = []
+        thread = threading.Thread(
+            target=read_messages, args=(reader, options.messages, result))
+        thread.start()
+        text = "x" * options.size
+        for start in range(0, options.messages, 100):
+            talker.send_lines(
+                ["PRIVMSG #flood :%d %s" % (i, text)
+                 for i in range(start, min(options.messages, start + 100))])
+        thread.join()
+        received = result[0]
+        reader.ping()
+        rss_after = common.process_rss(proc.pid)
+        reader.send("ISON stalled")
+        stalled_online = "stalled" in reader.expect(" 303 ").split(":", 2)[2]
+        samples = stats(reader)
+    finally:
+        common.stop_server(proc)
+
+    actions = dict(
+        (action, int(samples.get(
+            'irc_sendq_actions_total{action="%s"}' % action, 0)))
+        for action in ("disconnect", "drop", "pause"))
+    growth = rss_after - rss_before
+    print("policy %s: reader got %d/%d messages, server RSS grew by %d KiB"
+          % (options.policy, received, options.messages, growth // 1024))
+    print("stalled client %s; sendq actions %s"
+          % ("still connected" if stalled_online else "disconnected",
+             actions))
+    expected = {
+        "none": lambda: stalled_online,
+        "disconnect": lambda: not stalled_online and actions["disconnect"],
+        "drop": lambda: stalled_online and actions["drop"],
+        "pause": lambda: stalled_online and actions["pause"],
+    }[options.policy]
+    if not expected():
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""IRC latency while bridged messages go to a slow webhook.
+
+Starts a stub webhook HTTP server that sleeps before answering, and a
+miniircd subprocess relaying #bridged to it through
+bridge.WebhookDispatcher. One client talks in #bridged while another
+measures PING round-trip times. The round trips should not depend on
+the webhook latency. --blocking relays with a synchronous urlopen inside
+the event loop instead, which is how webpy.py used to do it.
+
+    python -m benchmarks.webhook_latency --latency 0.5
+"""
+
+import argparse
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+
+from benchmarks import common
+
+DISPATCHER_PRELUDE = """
+import bridge
+dispatcher = bridge.WebhookDispatcher()
+dispatcher.start()
+bridge.bridge_channels({'#bridged': %r}, dispatcher)
+"""
+
+BLOCKING_PRELUDE = """
+import json, urllib, urllib2
+import miniircd
+old_message_channel = miniircd.Client.message_channel
+def message_channel(self, channel, command, message, include_self=False):
+    if command == 'PRIVMSG' and channel.name == '#bridged':
+        urllib2.urlopen(%r, urllib.urlencode({'payload': json.dumps(
+            {'text': message, 'username': self.nickname})})).read()
+    old_message_channel(self, channel, command, message, include_self)
+miniircd.Client.message_channel = message_channel
+"""
+
+
+class StubWebhook(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ("127.0.0.1", 0), StubWebhookHandler)
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+
+class StubWebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive.
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader("content-length", 0)))
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write("ok")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.5,
+                        help="webhook response delay in seconds")
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--pings-per-message", type=int, default=10)
+    parser.add_argument("--blocking", action="store_true",
+                        help="relay synchronously in the event loop")
+    options = parser.parse_args()
+
+    webhook = StubWebhook(options.latency)
+    thread = threading.Thread(target=webhook.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    url = "http://127.0.0.1:%d/hook" % webhook.server_address[1]
+    prelude = BLOCKING_PRELUDE if options.blocking else DISPATCHER_PRELUDE
+
+    port = common.free_port()
+    proc = common.start_server(port, prelude=prelude % url)
+    try:
+        talker = common.IRCClient(port, "talker")
+        observer = common.IRCClient(port, "observer")
+        for client in (talker, observer):
+            client.send("JOIN #bridged")
+            client.expect(" 366 ")
+        rtts = []
+        deliveries = []
+        for i in range(options.messages):
+            start = time.time()
+            talker.send("PRIVMSG #bridged :message %d" % i)
+            observer.expect("message %d" % i)
+            deliveries.append(time.time() - start)
+            for _ in range(options.pings_per_message):
+                rtts.append(observer.ping())
+        deadline = time.time() + options.latency * options.messages + 10
+        while webhook.requests < options.messages and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        common.stop_server(proc)
+        webhook.shutdown()
+
+    print("mode:             %s" % (
+        "blocking urlopen" if options.blocking else "WebhookDispatcher"))
+    print("webhook latency:  %.0f ms" % (options.latency * 1e3))
+    print("webhook requests: %d/%d" % (webhook.requests, options.messages))
+    for (name, values) in (("PING round trip", rtts),
+                           ("channel delivery", deliveries)):
+        print("%-17s p50 %8.2f ms  p99 %8.2f ms  max %8.2f ms" % (
+            name + ":",
+            common.percentile(values, 0.5) * 1e3,
+            common.percentile(values, 0.99) * 1e3,
+            max(values) * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,667 @@
+"""Bridging of IRC channels to and from webhooks.
+
+Outgoing deliveries are queued by the IRC event loop and performed by a
+pool of worker threads, so a slow or hung webhook endpoint never blocks
+IRC clients. gateway.AsyncWebhookClient does the same without threads,
+on the event loop itself.
+"""
+
+import httplib
+import json
+import os
+import Queue
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import traceback
+import urllib
+import urlparse
+from collections import OrderedDict
+
+import miniircd
+
+
+DELIVERY_BOUNDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, 60.0, 300.0)
+BATCH_SIZE_BOUNDS = (1, 2, 5, 10, 20, 50, 100)
+# The default window is one second; 1.01 separates batches sent on time
+# from late ones.
+WINDOW_BOUNDS = (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.01, 1.1,
+                 2.5, 5.0, 10.0)
+
+
+class WebhookDispatcher(object):
+    """Bounded queue of webhook deliveries served by worker threads.
+
+    Each URL is always served by the same worker, which keeps messages
+    to one webhook in order and lets the worker keep a persistent HTTP
+    connection to it. Failed deliveries are retried with exponential
+    backoff. When a worker's queue is full, a delivery is dropped or, if
+    overflow is "spill", appended to that worker's spill file (spill_path
+    followed by "." and the worker's number). Until the worker has
+    replayed its spill file, which it does once its queue is empty, its
+    later deliveries are spilled too, so they stay in order.
+    """
+
+    def __init__(self, workers=4, queue_size=10000, max_retries=5,
+                 backoff=0.5, max_backoff=30.0, timeout=10.0,
+                 overflow="drop", spill_path=None):
+        if overflow not in ("drop", "spill"):
+            raise ValueError("overflow must be 'drop' or 'spill'")
+        if overflow == "spill" and not spill_path:
+            raise ValueError("overflow='spill' requires spill_path")
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.overflow = overflow
+        self.spill_path = spill_path
+        per_worker = max(1, queue_size // workers)
+        self._queues = [Queue.Queue(per_worker) for _ in range(workers)]
+        self._threads = []
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        # Guards the spill files and _spilled, which tells per worker
+        # whether its spill file may hold deliveries.
+        self._spill_lock = threading.Lock()
+        self._spilled = [spill_path is not None
+                         and os.path.exists(self._spill_file(i))
+                         for i in range(workers)]
+        self.counters = {
+            "submitted": 0,
+            "delivered": 0,
+            "failed": 0,
+            "retried": 0,
+            "dropped": 0,
+            "spilled": 0,
+            "replayed": 0,
+        }
+        # Seconds from submit() to successful delivery, retries included.
+        self.delivery_seconds = miniircd.Histogram(DELIVERY_BOUNDS)
+
+    def start(self):
+        for i in range(len(self._queues)):
+            thread = threading.Thread(
+                target=self._work, args=(i,), name="webhook-%d" % i)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop the workers after they have drained their queues.
+
+        From now on, failed deliveries are not retried and spill files
+        are left for the next start. Waits at most timeout seconds, if
+        given, for the workers to finish.
+        """
+        self._stopping.set()
+        for queue in self._queues:
+            try:
+                # Wakes up an idle worker. A full queue's worker is busy
+                # and stops once the queue is empty.
+                queue.put_nowait(None)
+            except Queue.Full:
+                pass
+        deadline = timeout and time.time() + timeout
+        for thread in self._threads:
+            thread.join(deadline and max(0, deadline - time.time()))
+        self._threads = []
+
+    def submit(self, url, payload):
+        """Queue payload (a JSON-serialisable dict) for delivery to url.
+
+        Never blocks. Returns False if the delivery was dropped.
+        """
+        self._count("submitted")
+        index = hash(url) % len(self._queues)
+        if not self._spilled[index]:
+            try:
+                self._queues[index].put_nowait((url, payload, time.time()))
+                return True
+            except Queue.Full:
+                pass
+        if self.overflow == "spill":
+            return self._spill(index, url, payload)
+        self._count("dropped")
+        return False
+
+    def queue_depth(self):
+        return sum(queue.qsize() for queue in self._queues)
+
+    def stats(self):
+        with self._lock:
+            result = dict(self.counters)
+        result["queued"] = self.queue_depth()
+        return result
+
+    def register_metrics(self, metrics):
+        """Export the counters and delivery latencies to a Metrics."""
+        metrics.counter(
+            "webhook_deliveries_total", "Webhook deliveries by outcome.",
+            ("outcome",), self._outcome_counts)
+        metrics.gauge("webhook_queued", "Webhook deliveries waiting.",
+                      lambda: {(): self.queue_depth()})
+        metrics.histogram(
+            "webhook_delivery_seconds",
+            "Time from queueing to successful webhook delivery.",
+            DELIVERY_BOUNDS, function=self._delivery_histogram)
+
+    def _outcome_counts(self):
+        with self._lock:
+            return dict(((name,), value)
+                        for (name, value) in self.counters.items())
+
+    def _delivery_histogram(self):
+        with self._lock:
+            histogram = miniircd.Histogram(DELIVERY_BOUNDS)
+            histogram.counts = list(self.delivery_seconds.counts)
+            histogram.sum = self.delivery_seconds.sum
+        return {(): histogram}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def _spill_file(self, index):
+        return "%s.%d" % (self.spill_path, index)
+
+    def _spill(self, index, url, payload):
+        try:
+            with self._spill_lock:
+                with open(self._spill_file(index), "a") as f:
+                    f.write(json.dumps([url, payload]) + "\n")
+                self._spilled[index] = True
+        except (IOError, OSError) as e:
+            sys.stderr.write("Could not spill webhook delivery: %s\n" % e)
+            self._count("dropped")
+            return False
+        self._count("spilled")
+        return True
+
+    def _take_spilled(self, index):
+        spill_file = self._spill_file(index)
+        replay_path = spill_file + ".replay"
+        with self._spill_lock:
+            # Deliveries submitted from now on are queued behind these.
+            self._spilled[index] = False
+            try:
+                os.rename(spill_file, replay_path)
+            except OSError:
+                return []
+        with open(replay_path) as f:
+            items = [json.loads(line) for line in f if line.strip()]
+        os.unlink(replay_path)
+        return items
+
+    def _work(self, index):
+        queue = self._queues[index]
+        connections = {}  # (scheme, netloc) --> HTTPConnection
+        try:
+            while True:
+                try:
+                    if self._spilled[index] or self._stopping.is_set():
+                        item = queue.get_nowait()
+                    else:
+                        item = queue.get(timeout=1)
+                except Queue.Empty:
+                    if self._stopping.is_set():
+                        return
+                    if self._spilled[index]:
+                        # Everything queued before the first spilled
+                        # delivery has been delivered.
+                        for (url, payload) in self._take_spilled(index):
+                            self._count("replayed")
+                            self._deliver(connections, url, payload, None)
+                    continue
+                if item is None:
+                    return
+                (url, payload, queued_at) = item
+                self._deliver(connections, url, payload, queued_at)
+        finally:
+            for connection in connections.values():
+                connection.close()
+
+    def _deliver(self, connections, url, payload, queued_at):
+        body = urllib.urlencode({"payload": json.dumps(payload)})
+        attempt = 0
+        while True:
+            try:
+                status = self._post(connections, url, body)
+                if 200 <= status < 300:
+                    with self._lock:
+                        self.counters["delivered"] += 1
+                        if queued_at is not None:
+                            self.delivery_seconds.observe(
+                                time.time() - queued_at)
+                    return
+                if status != 429 and status < 500:
+                    # Retrying will not help.
+                    sys.stderr.write(
+                        "Webhook %s rejected delivery: HTTP %d\n"
+                        % (url, status))
+                    self._count("failed")
+                    return
+                error = "HTTP %d" % status
+            except (httplib.HTTPException, socket.error) as e:
+                error = e
+            if attempt >= self.max_retries or self._stopping.is_set():
+                sys.stderr.write("Giving up on webhook %s: %s\n"
+                                 % (url, error))
+                self._count("failed")
+                return
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+            attempt += 1
+            self._count("retried")
+            self._stopping.wait(delay * random.uniform(0.5, 1.0))
+
+    def _post(self, connections, url, body):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        connection = connections.get(key)
+        if connection is None:
+            if parts.scheme == "https":
+                connection_class = httplib.HTTPSConnection
+            else:
+                connection_class = httplib.HTTPConnection
+            connection = connection_class(parts.netloc, timeout=self.timeout)
+            connections[key] = connection
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        try:
+            connection.request(
+                "POST", path, body,
+                {"Content-Type": "application/x-www-form-urlencoded"})
+            response = connection.getresponse()
+            # The body must be consumed before the connection is reused.
+            response.read()
+        except:
+            # Reconnect on the next attempt.
+            connection.close()
+            del connections[key]
+            raise
+        if response.getheader("connection", "").lower() == "close":
+            connection.close()
+            del connections[key]
+        return response.status
+
+
+class Coalescer(object):
+    """Merge webhook payloads from one channel within a time window.
+
+    Sits in front of a WebhookDispatcher. Payloads are batched per URL
+    and "channel" field, so channels sharing a webhook are not mixed:
+    the first payload of a batch opens a window of window seconds and
+    all payloads submitted for the same URL and channel until it closes
+    are sent as one, in order. A batch is sent early once it holds
+    max_batch payloads. Timers run on scheduler, so submit must be
+    called from the event loop; until start() has provided a scheduler,
+    payloads are passed straight to dispatcher.
+    """
+
+    def __init__(self, dispatcher, window=1.0, max_batch=50):
+        self.dispatcher = dispatcher
+        self.window = window
+        self.max_batch = max_batch
+        self.scheduler = None
+        # (URL, channel name) --> [(payload, submit time)]
+        self._pending = {}
+        self._timers = {}  # (URL, channel name) --> Timer
+        # Batches sent, by why they were sent: "window", "full" or
+        # "stop".
+        self.batches = {"window": 0, "full": 0, "stop": 0}
+        self.batch_sizes = miniircd.Histogram(BATCH_SIZE_BOUNDS)
+        # Seconds from submit() to sending, per payload.
+        self.delay_seconds = miniircd.Histogram(WINDOW_BOUNDS)
+
+    def start(self, scheduler):
+        self.scheduler = scheduler
+
+    def stop(self):
+        """Send all pending batches now. Must run in the event loop."""
+        for key in list(self._pending):
+            self.flush(key, "stop")
+        self.scheduler = None
+
+    def submit(self, url, payload):
+        if self.scheduler is None:
+            return self.dispatcher.submit(url, payload)
+        key = (url, payload.get("channel"))
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = []
+            self._timers[key] = self.scheduler.call_later(
+                self.window, self.flush, key)
+        batch.append((payload, time.time()))
+        if len(batch) >= self.max_batch:
+            self.flush(key, "full")
+        return True
+
+    def flush(self, key, reason="window"):
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        self._timers.pop(key).cancel()
+        url = key[0]
+        now = time.time()
+        self.batches[reason] += 1
+        self.batch_sizes.observe(len(batch))
+        observe = self.delay_seconds.observe
+        for (_, submitted) in batch:
+            observe(now - submitted)
+        self.dispatcher.submit(url, merge_payloads([x[0] for x in batch]))
+
+    def pending(self):
+        return sum(len(x) for x in self._pending.values())
+
+    def stats(self):
+        result = dict(("%s_batches" % reason, count)
+                      for (reason, count) in self.batches.items())
+        result["batches"] = self.batch_sizes.count
+        result["messages"] = self.batch_sizes.sum
+        result["pending"] = self.pending()
+        if result["messages"]:
+            result["delay_mean"] = (
+                self.delay_seconds.sum / result["messages"])
+            result["batch_size_mean"] = (
+                float(result["messages"]) / result["batches"])
+        return result
+
+    def register_metrics(self, metrics):
+        """Export the batch counts, sizes and delays to a Metrics."""
+        metrics.counter(
+            "webhook_batches_total",
+            "Coalesced webhook batches sent, by why they were sent.",
+            ("reason",),
+            lambda: dict(((reason,), count)
+                         for (reason, count) in self.batches.items()))
+        metrics.gauge("webhook_coalescing", "Payloads waiting in a window.",
+                      lambda: {(): self.pending()})
+        metrics.histogram(
+            "webhook_batch_size", "Payloads per coalesced webhook batch.",
+            BATCH_SIZE_BOUNDS, function=lambda: {(): self.batch_sizes})
+        metrics.histogram(
+            "webhook_coalesce_delay_seconds",
+            "Time payloads waited in a coalescing window.",
+            WINDOW_BOUNDS, function=lambda: {(): self.delay_seconds})
+
+
+# Username of merged payloads with messages from several users.
+MERGED_USERNAME = "IRC"
+
+
+def merge_payloads(payloads):
+    """Merge bridge payloads into one, keeping order and attribution.
+
+    If all messages are from the same user, the texts are joined by line
+    breaks under that username; otherwise each line is prefixed with
+    "<nickname> " and the username is MERGED_USERNAME. The channel of
+    the first payload is kept, and the individual payloads are kept in
+    "messages".
+    """
+    if len(payloads) == 1:
+        return payloads[0]
+    usernames = set(x["username"] for x in payloads)
+    if len(usernames) == 1:
+        merged = {
+            "username": payloads[0]["username"],
+            "text": "\n".join(x["text"] for x in payloads),
+        }
+    else:
+        merged = {
+            "username": MERGED_USERNAME,
+            "text": "\n".join("<%s> %s" % (x["username"], x["text"])
+                              for x in payloads),
+        }
+    if "channel" in payloads[0]:
+        merged["channel"] = payloads[0]["channel"]
+    merged["messages"] = payloads
+    return merged
+
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode("utf-8")
+    return s
+
+
+# User and host of bridged senders. With them, the source of a bridged
+# message is a full nick!user@host, which clients do not take for a
+# server.
+BRIDGE_USERHOST = "webhook@bridge"
+
+# Anything that would end the nickname part of a prefix, or the line.
+_invalid_nickname_regexp = re.compile(r"[\x00\r\n !@]")
+
+
+def valid_nickname(nickname):
+    """Return whether nickname can be the sender of bridged messages."""
+    nickname = _utf8(nickname)
+    return bool(nickname) and not nickname.startswith(":") \
+        and not _invalid_nickname_regexp.search(nickname)
+
+
+def bridged_prefix(nickname):
+    """Return the source of messages bridged from nickname.
+
+    Raises ValueError if nickname is not valid_nickname().
+    """
+    if not valid_nickname(nickname):
+        raise ValueError("invalid nickname %r" % nickname)
+    return "%s!%s" % (_utf8(nickname), BRIDGE_USERHOST)
+
+
+def privmsg_lines(channelname, nickname, text):
+    """Format bridged text as PRIVMSG lines, one per line of text.
+
+    Raises ValueError if nickname is not valid_nickname().
+    """
+    prefix = ":%s PRIVMSG %s :" % (
+        bridged_prefix(nickname), _utf8(channelname))
+    return [prefix + line for line in _utf8(text).splitlines() or [""]]
+
+
+def log_bridged(server, channel, nickname, text):
+    """Add bridged text to the history of channel."""
+    source = bridged_prefix(nickname)
+    for line in _utf8(text).splitlines() or [""]:
+        server.log_channel(channel, source, "PRIVMSG", line)
+
+
+def relay_to_channel(server, channelname, nickname, text):
+    """Send a bridged message to the members of an existing channel.
+
+    Must run in the event loop; other threads should go through
+    Server.inject. Returns False if the channel does not exist or
+    nickname is not valid_nickname().
+    """
+    if not valid_nickname(nickname) or not server.has_channel(channelname):
+        return False
+    channel = server.get_channel(channelname)
+    server.broadcast_lines(
+        channel.members, privmsg_lines(channelname, nickname, text),
+        low_priority=True)
+    log_bridged(server, channel, nickname, text)
+    return True
+
+
+def parse_bulk(body):
+    """Parse the body of a bulk ingest request.
+
+    body is either a JSON array of message objects or newline-delimited
+    JSON objects, each with channel_name, user_name and text fields.
+    channel_name gets a "#" prepended unless it already starts with a
+    channel prefix. user_name must be valid_nickname(). Returns one
+    entry per message: a (channelname, nickname, text) tuple, or an
+    error string if the message is invalid.
+    Raises ValueError if a JSON array body cannot be parsed at all.
+    """
+    body = body.strip()
+    if body.startswith("["):
+        items = json.loads(body)
+        if not isinstance(items, list):
+            raise ValueError("expected a JSON array")
+    else:
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append("invalid JSON: %s" % e)
+    messages = []
+    for item in items:
+        if isinstance(item, basestring):
+            messages.append(item)
+            continue
+        if not isinstance(item, dict):
+            messages.append("expected a JSON object")
+            continue
+        fields = [item.get(x) for x in ("channel_name", "user_name", "text")]
+        if not all(isinstance(x, basestring) for x in fields):
+            messages.append(
+                "channel_name, user_name and text must be strings")
+            continue
+        (channelname, nickname, text) = [_utf8(x) for x in fields]
+        if not valid_nickname(nickname):
+            messages.append("invalid user_name")
+            continue
+        if not channelname or channelname[0] not in "#&+!":
+            channelname = "#" + channelname
+        messages.append((channelname, nickname, text))
+    return messages
+
+
+def relay_batch(server, messages):
+    """Send (channelname, nickname, text) messages to existing channels.
+
+    Messages are grouped per channel and each group is sent to the
+    channel's members in one broadcast, keeping their relative order.
+    Must run in the event loop. Returns a status per message: None if it
+    was delivered, otherwise an error string.
+    """
+    groups = OrderedDict()  # irc_lower(Channel name) --> [message index]
+    statuses = [None] * len(messages)
+    for (i, (channelname, nickname, text)) in enumerate(messages):
+        if valid_nickname(nickname):
+            groups.setdefault(miniircd.irc_lower(channelname), []).append(i)
+        else:
+            statuses[i] = "invalid user_name"
+    for indices in groups.values():
+        channelname = messages[indices[0]][0]
+        if not server.has_channel(channelname):
+            for i in indices:
+                statuses[i] = "no such channel"
+            continue
+        channel = server.get_channel(channelname)
+        lines = []
+        for i in indices:
+            lines.extend(privmsg_lines(channel.name, *messages[i][1:]))
+        server.broadcast_lines(channel.members, lines, low_priority=True)
+        for i in indices:
+            log_bridged(server, channel, *messages[i][1:])
+    return statuses
+
+
+class _Completion(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.failed = False
+
+
+def call_in_loop(server, timeout, callback, *args):
+    """Run callback(*args) in server's event loop and wait for the result.
+
+    Raises Queue.Full if the server's injection queue is full. Returns
+    a completion whose event is set once the callback has finished, and
+    whose value is then its return value unless failed is set because
+    it raised.
+    """
+    completion = _Completion()
+
+    def run():
+        try:
+            completion.value = callback(*args)
+        except:
+            completion.failed = True
+            raise
+        finally:
+            completion.event.set()
+
+    if not server.inject(run):
+        raise Queue.Full
+    completion.event.wait(timeout)
+    return completion
+
+
+def ingest_bulk(server, body, timeout=5.0):
+    """Relay a bulk ingest request body from outside the event loop.
+
+    Returns a list with a result dict per message, in request order.
+    Raises ValueError for an unparsable body and Queue.Full if the
+    server is not accepting injected work.
+    """
+    messages = parse_bulk(body)
+    valid = [x for x in messages if isinstance(x, tuple)]
+    completion = call_in_loop(server, timeout, relay_batch, server, valid)
+    if not completion.event.is_set():
+        statuses = None
+    elif completion.failed:
+        statuses = ["internal error"] * len(valid)
+    else:
+        statuses = completion.value
+    return bulk_results(messages, statuses)
+
+
+def bulk_results(messages, statuses):
+    """Return the result dicts of a bulk ingest request.
+
+    messages is what parse_bulk returned and statuses what relay_batch
+    returned for the valid messages, or None if they are still queued.
+    """
+    if statuses is not None:
+        statuses = iter(statuses)
+    results = []
+    for message in messages:
+        if not isinstance(message, tuple):
+            results.append({"status": "rejected", "error": message})
+        elif statuses is None:
+            # Still queued; it will be delivered when the loop gets to it.
+            results.append({"status": "queued"})
+        else:
+            error = next(statuses)
+            if error:
+                results.append({"status": "rejected", "error": error})
+            else:
+                results.append({"status": "delivered"})
+    return results
+
+
+def bridge_channels(channels, dispatcher):
+    """Relay PRIVMSGs in bridged channels to their webhooks.
+
+    channels maps channel names to webhook URLs. Client.message_channel
+    is wrapped so that deliveries are handed to dispatcher, which is a
+    WebhookDispatcher or a Coalescer in front of one. Payloads have the
+    text, the sender's username and the channel.
+    """
+    old_message_channel = miniircd.Client.message_channel
+
+    def message_channel(self, channel, command, message, include_self=False):
+        try:
+            if command == "PRIVMSG" and channel.name in channels:
+                dispatcher.submit(channels[channel.name], {
+                    "text": message.split(" ", 1)[1][1:],
+                    "username": self.nickname,
+                    "channel": channel.name,
+                })
+        except:
+            traceback.print_exc()
+        old_message_channel(self, channel, command, message, include_self)
+
+    miniircd.Client.message_channel = message_channel
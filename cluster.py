@@ -0,0 +1,693 @@
+#! /usr/bin/env python
+"""miniircd on several cores: worker processes sharing the IRC ports.
+
+Each worker is a miniircd Server listening on the same ports with
+SO_REUSEPORT, so the kernel spreads new connections over the workers.
+The parent process is a hub that the workers talk to over Unix socket
+pairs:
+
+- The hub owns the nicknames. A worker claims a nickname from the hub
+  before giving it to a client. The client's further lines wait for
+  the answer, while the worker serves everyone else; if no answer
+  comes within WorkerBus.claim_timeout seconds, the nickname is
+  refused.
+- Everything else is replicated asynchronously. A worker tells the hub
+  about its users' registrations, joins, parts, topics, keys and quits,
+  and the hub passes them on to all other workers. Those apply them to
+  RemoteClients, so that each worker knows every user and channel.
+- Channel messages go only to the workers with members in the channel.
+  Each worker then sends them to its own members.
+
+Topics and keys set at the same moment on different workers may end up
+different in each worker. Channel history is kept by each worker, of
+the lines its own members saw.
+
+The hub restarts workers that exit and sends the new worker the current
+users and channels. SIGINT or SIGTERM stops the hub and all workers.
+
+    python cluster.py --workers 4 --ports 6667
+"""
+
+import argparse
+import errno
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from collections import deque
+
+import miniircd
+from miniircd import irc_lower, parse_message
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Kernel buffer size of the bus sockets, so that bursts of channel
+# messages rarely have to wait for the poller.
+_BUS_BUFFER_SIZE = 2 ** 22
+
+
+class LineConnection(object):
+    """Newline-terminated lines over a connected socket, non-blocking.
+
+    Lines are queued with send() and written by flush(); the owner is
+    expected to call flush() once it has queued a batch. Used for the
+    bus here and for server links (links.py).
+    """
+
+    def __init__(self, poller, sock):
+        self.poller = poller
+        self.socket = sock
+        self.fileno = sock.fileno()
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            sock.setsockopt(socket.SOL_SOCKET, option, _BUS_BUFFER_SIZE)
+        sock.setblocking(0)
+        self.closed = False
+        self._linebuffer = miniircd.LineBuffer()
+        self._read_buffer = bytearray(2 ** 16)
+        self._output = []
+        self._unsent = b""
+        self._write_interest = False
+        poller.register(self.fileno, self)
+
+    def send(self, line):
+        """Queue line. Returns whether nothing was queued before."""
+        self._output.append(line)
+        return len(self._output) == 1 and not self._unsent
+
+    def read_lines(self):
+        """Return the lines that can be read now, or None at EOF."""
+        try:
+            length = self.socket.recv_into(self._read_buffer)
+        except socket.error as e:
+            if e.args[0] in _WOULD_BLOCK:
+                return []
+            length = 0
+        if not length:
+            return None
+        return self._linebuffer.feed(self._read_buffer, length)
+
+    def flush(self):
+        """Send as much queued output as the socket accepts."""
+        if self.closed:
+            return
+        if self._output:
+            self._unsent += "\n".join(self._output) + "\n"
+            self._output = []
+        while self._unsent:
+            try:
+                sent = self.socket.send(self._unsent)
+            except socket.error as e:
+                if e.args[0] not in _WOULD_BLOCK:
+                    self.close()
+                    return
+                break
+            self._unsent = self._unsent[sent:]
+        want = bool(self._unsent)
+        if want != self._write_interest:
+            self._write_interest = want
+            self.poller.set_writable(self.fileno, self, want)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.poller.unregister(self.fileno, self)
+            self.socket.close()
+
+    def socket_writable_notification(self):
+        self.flush()
+
+
+class _Claim(object):
+    """A nickname claim sent to the hub and not answered yet."""
+
+    __slots__ = ("client", "oldnickname", "nickname", "callback", "timer",
+                 "quitmsg")
+
+    def __init__(self, client, oldnickname, nickname, callback):
+        self.client = client
+        self.oldnickname = oldnickname
+        self.nickname = nickname
+        # Called with the answer; None once answered or given up on.
+        self.callback = callback
+        self.timer = None
+        # Set if the client quit while waiting.
+        self.quitmsg = None
+
+
+class WorkerBus(LineConnection):
+    """Server.network of a cluster worker: its connection to the hub.
+
+    Local changes are sent to the hub in the server's flush phase, and
+    changes made on other workers are applied through RemoteClients.
+    """
+
+    # Seconds to wait for the hub to answer a nickname claim.
+    claim_timeout = 10.0
+
+    def __init__(self, server, sock):
+        LineConnection.__init__(self, server.poller, sock)
+        self.server = server
+        # Claims in the order they were sent, which the hub answers in.
+        self.__claims = deque()
+        server.network = self
+
+    def __send(self, line):
+        if self.send(line):
+            self.server.schedule_flush(self)
+
+    def claim_nickname(self, client, nickname, callback):
+        """Ask the hub for nickname; callback gets the answer later."""
+        if self.closed:
+            return False
+        claim = _Claim(client, client.nickname or "*", nickname, callback)
+        claim.timer = self.server.scheduler.call_later(
+            self.claim_timeout, self.__claim_timed_out, claim)
+        self.__claims.append(claim)
+        self.__send("CLAIM %s %s" % (claim.oldnickname, nickname))
+        return None
+
+    def __claim_timed_out(self, claim):
+        self.server.print_error("The hub did not answer the claim of %s."
+                                % claim.nickname)
+        self.__answer(claim, False)
+
+    def __answer(self, claim, granted):
+        # Tell the client, unless already done.
+        if claim.timer is not None:
+            claim.timer.cancel()
+            claim.timer = None
+        callback = claim.callback
+        if callback is not None:
+            claim.callback = None
+            if claim.quitmsg is None:
+                return callback(granted)
+        return False
+
+    def __claimed_handler(self, nickname):
+        claim = self.__claims.popleft()
+        if self.__answer(claim, True):
+            return
+        # Given up on, or the client has gone; let go of the nickname.
+        if claim.quitmsg is None and claim.oldnickname != "*":
+            # The hub has renamed the user; rename it back.
+            self.__claims.append(_Claim(
+                claim.client, nickname, claim.oldnickname,
+                lambda granted: True))
+            self.__send("CLAIM %s %s" % (nickname, claim.oldnickname))
+        else:
+            self.__send("QUIT %s :%s" % (nickname, claim.quitmsg or ""))
+
+    def __taken_handler(self, nickname):
+        self.__answer(self.__claims.popleft(), False)
+
+    def introduce(self, client):
+        self.__send("USER %s %s %s :%s" % (client.nickname, client.user,
+                                           client.host, client.realname))
+
+    def joined(self, client, channel):
+        self.__send("JOIN %s %s" % (client.nickname, channel.name))
+
+    def parted(self, client, channel, partmsg):
+        self.__send("PART %s %s :%s"
+                    % (client.nickname, channel.name, partmsg))
+
+    def topic_changed(self, client, channel):
+        self.__send("TOPIC %s %s :%s"
+                    % (client.nickname, channel.name, channel.topic))
+
+    def key_changed(self, client, channel):
+        if channel.key is None:
+            self.__send("KEY %s %s" % (client.nickname, channel.name))
+        else:
+            self.__send("KEY %s %s %s"
+                        % (client.nickname, channel.name, channel.key))
+
+    def channel_message(self, client, channel, command, text):
+        self.__send("%s %s %s :%s"
+                    % (command, client.nickname, channel.name, text))
+
+    def private_message(self, target, line):
+        self.__send("PRIVATE %s :%s" % (target.nickname, line))
+
+    def quit(self, client, quitmsg):
+        if client.nickname:
+            self.__send("QUIT %s :%s" % (client.nickname, quitmsg))
+        for claim in self.__claims:
+            if claim.client is client:
+                claim.quitmsg = quitmsg
+
+    def socket_readable_notification(self):
+        lines = self.read_lines()
+        if lines is None:
+            # The hub closes the bus when it stops or dies.
+            self.server.print_info("The hub has gone away; stopping.")
+            self.close()
+            self.server.stop()
+            while self.__claims:
+                self.__answer(self.__claims.popleft(), False)
+            return
+        handlers = self._handlers
+        for line in lines:
+            message = parse_message(line)
+            handler = handlers.get(message.command)
+            if handler is None:
+                self.server.print_error(
+                    "Unknown command from the hub: %s" % message.command)
+                continue
+            try:
+                handler(self, *message.params)
+            except Exception:
+                self.server.print_error(
+                    "Error handling %r from the hub:\n%s"
+                    % (message.params, traceback.format_exc()))
+
+    def __remote(self, nickname):
+        client = self.server.nicknames.get(irc_lower(nickname))
+        if client is None or client.link is not self:
+            return None
+        return client
+
+    def __user_handler(self, nickname, user, host, realname):
+        server = self.server
+        if server.get_client(nickname) is not None:
+            server.print_error("Hub introduced %s, which is in use."
+                               % nickname)
+            return
+        client = miniircd.RemoteClient(
+            server, self, nickname, user, host, realname)
+        server.nicknames[client.lower_nickname] = client
+
+    def __nick_handler(self, nickname, newnickname):
+        client = self.__remote(nickname)
+        if client is not None:
+            client.change_nickname(newnickname)
+
+    def __join_handler(self, nickname, channelname):
+        client = self.__remote(nickname)
+        if client is not None:
+            client.join(self.server.get_channel(channelname))
+
+    def __part_handler(self, nickname, channelname, partmsg):
+        client = self.__remote(nickname)
+        if client is not None:
+            channel = client.channels.get(irc_lower(channelname))
+            if channel is not None:
+                client.part(channel, partmsg)
+
+    def __topic_handler(self, nickname, channelname, topic):
+        server = self.server
+        if not server.has_channel(channelname):
+            return
+        channel = server.get_channel(channelname)
+        client = self.__remote(nickname)
+        if client is None:
+            # Sent by the hub to a new worker.
+            channel.topic = topic
+        else:
+            client.set_topic(channel, topic)
+
+    def __key_handler(self, nickname, channelname, key=None):
+        server = self.server
+        if not server.has_channel(channelname):
+            return
+        channel = server.get_channel(channelname)
+        client = self.__remote(nickname)
+        if client is None:
+            channel.key = key
+        else:
+            client.set_key(channel, key)
+
+    def __privmsg_handler(self, nickname, channelname, text):
+        self.__message(nickname, channelname, "PRIVMSG", text)
+
+    def __notice_handler(self, nickname, channelname, text):
+        self.__message(nickname, channelname, "NOTICE", text)
+
+    def __message(self, nickname, channelname, command, text):
+        client = self.__remote(nickname)
+        channel = self.server.channels.get(irc_lower(channelname))
+        if client is not None and channel is not None:
+            client.message_channel(channel, command, text)
+
+    def __private_handler(self, nickname, line):
+        client = self.server.get_client(nickname)
+        if client is not None and client.link is None:
+            client.message(line)
+
+    def __quit_handler(self, nickname, quitmsg):
+        client = self.__remote(nickname)
+        if client is not None:
+            self.server.remove_client(client, quitmsg)
+
+    # Command --> handler, called with the bus connection and the
+    # parameters of the message.
+    _handlers = {
+        "CLAIMED": __claimed_handler,
+        "JOIN": __join_handler,
+        "KEY": __key_handler,
+        "NICK": __nick_handler,
+        "NOTICE": __notice_handler,
+        "PART": __part_handler,
+        "PRIVATE": __private_handler,
+        "PRIVMSG": __privmsg_handler,
+        "QUIT": __quit_handler,
+        "TAKEN": __taken_handler,
+        "TOPIC": __topic_handler,
+        "USER": __user_handler,
+    }
+
+
+class _HubUser(object):
+    __slots__ = ("worker", "nickname", "user", "host", "realname",
+                 "channels")
+
+    def __init__(self, worker, nickname, user, host, realname):
+        self.worker = worker
+        self.nickname = nickname
+        self.user = user
+        self.host = host
+        self.realname = realname
+        self.channels = set()  # irc_lower(Channel name)
+
+
+class _HubChannel(object):
+    __slots__ = ("name", "topic", "key", "workers")
+
+    def __init__(self, name):
+        self.name = name
+        self.topic = ""
+        self.key = None
+        self.workers = {}  # _Worker --> number of its users in the channel
+
+
+class _Worker(LineConnection):
+    def __init__(self, hub, number, pid, sock):
+        LineConnection.__init__(self, hub.poller, sock)
+        self.hub = hub
+        self.number = number
+        self.pid = pid
+
+    def send(self, line):
+        if LineConnection.send(self, line):
+            self.hub.flush_pending.append(self)
+
+    def socket_readable_notification(self):
+        lines = self.read_lines()
+        if lines is None:
+            self.hub.worker_exited(self)
+            return
+        for line in lines:
+            self.hub.handle(self, line)
+
+
+class Hub(object):
+    """Supervisor of the workers and relay of their bus messages.
+
+    server_options are keyword arguments for the workers' Servers.
+    """
+
+    restart_delay = 1.0
+
+    def __init__(self, workers, server_options):
+        self.server_options = server_options
+        self.poller = miniircd.make_poller()
+        self.scheduler = miniircd.Scheduler()
+        self.workers = [None] * workers
+        self.nicknames = {}  # irc_lower(Nickname) --> _Worker
+        self.users = {}  # irc_lower(Nickname) --> _HubUser
+        self.channels = {}  # irc_lower(Channel name) --> _HubChannel
+        self.flush_pending = []  # _Workers with newly queued lines.
+        self.stopping = False
+
+    def run(self):
+        for number in range(len(self.workers)):
+            self.start_worker(number)
+        try:
+            while not self.stopping:
+                self.run_once()
+        finally:
+            self.stop_workers()
+
+    def run_once(self):
+        now = time.time()
+        timeout = self.scheduler.timeout(now)
+        if timeout is None or timeout > 1:
+            # Check self.stopping now and then, as a signal may arrive
+            # just before poll().
+            timeout = 1
+        for (fd, handler, readable, writable) in self.poller.poll(timeout):
+            if readable and self.poller.owns(fd, handler):
+                handler.socket_readable_notification()
+            if writable and self.poller.owns(fd, handler):
+                handler.socket_writable_notification()
+        self.scheduler.run_due(time.time())
+        pending = self.flush_pending
+        self.flush_pending = []
+        for worker in pending:
+            worker.flush()
+
+    def stop(self):
+        """Make run() stop the workers and return. Safe in signals."""
+        self.stopping = True
+
+    def start_worker(self, number):
+        (hub_end, worker_end) = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                hub_end.close()
+                for worker in self.workers:
+                    if worker is not None:
+                        worker.socket.close()
+                run_worker(worker_end, self.server_options)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        worker_end.close()
+        worker = _Worker(self, number, pid, hub_end)
+        self.workers[number] = worker
+        self.__burst(worker)
+
+    def __burst(self, worker):
+        # Tell a new worker about all users and channels.
+        for user in self.users.values():
+            worker.send("USER %s %s %s :%s" % (user.nickname, user.user,
+                                               user.host, user.realname))
+            for name in user.channels:
+                worker.send("JOIN %s %s"
+                            % (user.nickname, self.channels[name].name))
+        for channel in self.channels.values():
+            if channel.topic:
+                worker.send("TOPIC * %s :%s" % (channel.name, channel.topic))
+            if channel.key is not None:
+                worker.send("KEY * %s %s" % (channel.name, channel.key))
+
+    def worker_exited(self, worker):
+        worker.close()
+        (_, status) = os.waitpid(worker.pid, 0)
+        self.workers[worker.number] = None
+        for (name, owner) in list(self.nicknames.items()):
+            if owner is worker:
+                del self.nicknames[name]
+        for (name, user) in list(self.users.items()):
+            if user.worker is worker:
+                self.__quit(worker, user, "Server exited",
+                            "QUIT %s :Server exited" % user.nickname)
+        if not self.stopping:
+            if os.WIFSIGNALED(status):
+                reason = "was killed by signal %d" % os.WTERMSIG(status)
+            else:
+                reason = "exited with status %d" % os.WEXITSTATUS(status)
+            sys.stderr.write("Worker %d (pid %d) %s; restarting it.\n"
+                             % (worker.number, worker.pid, reason))
+            self.scheduler.call_later(
+                self.restart_delay, self.start_worker, worker.number)
+
+    def stop_workers(self):
+        for worker in self.workers:
+            if worker is not None:
+                try:
+                    os.kill(worker.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        for worker in self.workers:
+            if worker is not None:
+                worker.close()
+                os.waitpid(worker.pid, 0)
+
+    def __relay(self, origin, line):
+        for worker in self.workers:
+            if worker is not None and worker is not origin:
+                worker.send(line)
+
+    def handle(self, worker, line):
+        """Handle line from worker."""
+        (command, _, rest) = line.partition(" ")
+        if command in ("PRIVMSG", "NOTICE"):
+            # The bulk of the traffic; only the channel name is needed.
+            channel = self.channels.get(irc_lower(rest.split(" ", 2)[1]))
+            if channel is not None:
+                for x in channel.workers:
+                    if x is not worker:
+                        x.send(line)
+            return
+        handler = self._handlers.get(command)
+        if handler is None:
+            sys.stderr.write("Unknown command from worker %d: %r\n"
+                             % (worker.number, line))
+            return
+        try:
+            handler(self, worker, line, *parse_message(line).params)
+        except Exception:
+            sys.stderr.write("Error handling %r from worker %d:\n%s"
+                             % (line, worker.number, traceback.format_exc()))
+
+    def __claim_handler(self, worker, line, oldnickname, nickname):
+        lower_nickname = irc_lower(nickname)
+        owner = self.nicknames.get(lower_nickname)
+        if owner is not None and owner is not worker:
+            worker.send("TAKEN %s" % nickname)
+            return
+        if oldnickname != "*":
+            lower_oldnickname = irc_lower(oldnickname)
+            if lower_oldnickname != lower_nickname \
+                    and self.nicknames.get(lower_oldnickname) is worker:
+                del self.nicknames[lower_oldnickname]
+            user = self.users.pop(lower_oldnickname, None)
+            if user is not None:
+                user.nickname = nickname
+                self.users[lower_nickname] = user
+                self.__relay(worker, "NICK %s %s" % (oldnickname, nickname))
+        self.nicknames[lower_nickname] = worker
+        worker.send("CLAIMED %s" % nickname)
+
+    def __user_handler(self, worker, line, nickname, user, host, realname):
+        self.users[irc_lower(nickname)] = _HubUser(
+            worker, nickname, user, host, realname)
+        self.__relay(worker, line)
+
+    def __join_handler(self, worker, line, nickname, channelname):
+        user = self.users.get(irc_lower(nickname))
+        if user is None:
+            return
+        name = irc_lower(channelname)
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = _HubChannel(channelname)
+        if name not in user.channels:
+            user.channels.add(name)
+            channel.workers[worker] = channel.workers.get(worker, 0) + 1
+        self.__relay(worker, line)
+
+    def __leave(self, worker, user, name):
+        user.channels.discard(name)
+        channel = self.channels[name]
+        count = channel.workers[worker] - 1
+        if count:
+            channel.workers[worker] = count
+        else:
+            del channel.workers[worker]
+            if not channel.workers:
+                del self.channels[name]
+
+    def __part_handler(self, worker, line, nickname, channelname, partmsg):
+        user = self.users.get(irc_lower(nickname))
+        name = irc_lower(channelname)
+        if user is not None and name in user.channels:
+            self.__leave(worker, user, name)
+            self.__relay(worker, line)
+
+    def __topic_handler(self, worker, line, nickname, channelname, topic):
+        channel = self.channels.get(irc_lower(channelname))
+        if channel is not None:
+            channel.topic = topic
+            self.__relay(worker, line)
+
+    def __key_handler(self, worker, line, nickname, channelname, key=None):
+        channel = self.channels.get(irc_lower(channelname))
+        if channel is not None:
+            channel.key = key
+            self.__relay(worker, line)
+
+    def __private_handler(self, worker, line, nickname, text):
+        user = self.users.get(irc_lower(nickname))
+        if user is not None and user.worker is not worker:
+            user.worker.send(line)
+
+    def __quit_handler(self, worker, line, nickname, quitmsg):
+        lower_nickname = irc_lower(nickname)
+        if self.nicknames.get(lower_nickname) is worker:
+            del self.nicknames[lower_nickname]
+        user = self.users.get(lower_nickname)
+        if user is not None and user.worker is worker:
+            self.__quit(worker, user, quitmsg, line)
+
+    def __quit(self, worker, user, quitmsg, line):
+        del self.users[irc_lower(user.nickname)]
+        for name in list(user.channels):
+            self.__leave(worker, user, name)
+        self.__relay(worker, line)
+
+    # Command --> handler, called with the hub, the worker, the line and
+    # the parameters of the message.
+    _handlers = {
+        "CLAIM": __claim_handler,
+        "JOIN": __join_handler,
+        "KEY": __key_handler,
+        "PART": __part_handler,
+        "PRIVATE": __private_handler,
+        "QUIT": __quit_handler,
+        "TOPIC": __topic_handler,
+        "USER": __user_handler,
+    }
+
+
+def run_worker(sock, server_options):
+    """Serve clients in a worker process until SIGTERM or SIGINT."""
+    server = miniircd.Server(reuse_port=True, **server_options)
+    WorkerBus(server, sock)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+    server.run()
+    server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run miniircd in several processes sharing ports.")
+    parser.add_argument("--workers", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--listen", default="",
+                        help="address to listen on (default: all)")
+    parser.add_argument("--ports", default="6667",
+                        help="comma-separated IRC ports (default: 6667)")
+    parser.add_argument("--password", help="IRC server password")
+    parser.add_argument("--history-on-join", type=int, default=0,
+                        help="history lines replayed on JOIN")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--debug", action="store_true")
+    options = parser.parse_args()
+
+    hub = Hub(options.workers, {
+        "listen_host": options.listen,
+        "ports": [int(x) for x in options.ports.split(",")],
+        "password": options.password,
+        "verbose": options.verbose,
+        "debug": options.debug,
+        "history_on_join": options.history_on_join,
+    })
+    signal.signal(signal.SIGINT, lambda signum, frame: hub.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: hub.stop())
+    hub.run()
+
+
+if __name__ == "__main__":
+    main()
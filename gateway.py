@@ -0,0 +1,881 @@
+#! /usr/bin/env python
+"""IRC server and webhook bridge in one process, on one event loop.
+
+webpy.py runs miniircd and the web.py application on separate threads.
+Here everything runs on the miniircd Server's event loop instead: an
+embedded HTTP server takes the inbound webhook requests, and
+AsyncWebhookClient delivers outbound messages with non-blocking
+sockets. Handlers touch IRC state directly; no other thread does.
+
+    python gateway.py --ports 6667 --http-port 8080 \\
+        --bridge '#off-topic=https://hooks.example.com/xyz'
+
+SIGINT or SIGTERM shuts down gracefully: the HTTP server stops, pending
+coalesced messages are handed over for delivery, IRC clients are
+disconnected and outstanding deliveries get up to --shutdown-timeout
+seconds to complete.
+
+SIGUSR2 starts a new gateway process with the same command line and
+hands the IRC clients and the listening sockets over to it (see
+upgrade.py), so the code can be upgraded without disconnecting anyone.
+This process then shuts down as above, except that it has no clients to
+disconnect. Use --pid-file to keep track of the serving process.
+"""
+
+import argparse
+import errno
+import httplib
+import json
+import os
+import random
+import signal
+import socket
+import ssl
+import sys
+import threading
+import time
+import traceback
+import urllib
+import urlparse
+from collections import deque
+
+import bridge
+import miniircd
+import upgrade
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class HTTPRequest(object):
+    __slots__ = ("method", "path", "query", "version", "headers", "body")
+
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        (self.path, _, self.query) = target.partition("?")
+        self.version = version
+        self.headers = headers  # Lower-case name --> value.
+        self.body = body
+
+
+class _HTTPError(Exception):
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+
+class HTTPServer(object):
+    """Minimal HTTP/1.1 server on the event loop of a miniircd Server.
+
+    routes maps (method, path) to a function taking an HTTPRequest and
+    returning (status, content type, body). Requests must have a
+    Content-Length if they have a body; chunked requests are refused.
+    Connections are kept alive unless the client asks otherwise, and
+    closed after idle_timeout seconds without a request.
+    """
+
+    max_header_size = 16384
+    max_body_size = 2 ** 20
+    idle_timeout = 60.0
+
+    def __init__(self, server, address, routes):
+        self.server = server
+        self.address = address
+        self.routes = routes
+        self.socket = None
+        self.connections = set()
+
+    def listen(self, sock=None):
+        """Listen on address, or on the listening socket sock if given."""
+        if sock is None:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(self.address)
+            s.listen(socket.SOMAXCONN)
+        else:
+            s = sock
+        s.setblocking(0)
+        self.socket = s
+        self.server.poller.register(s.fileno(), self)
+        self.server.print_info("HTTP server listening on port %d."
+                               % s.getsockname()[1])
+
+    def close(self):
+        """Stop listening and close all connections."""
+        if self.socket is not None:
+            self.server.poller.unregister(self.socket.fileno(), self)
+            self.socket.close()
+            self.socket = None
+        for connection in list(self.connections):
+            connection.close()
+
+    def socket_readable_notification(self):
+        for _ in range(64):
+            try:
+                (conn, addr) = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] not in _WOULD_BLOCK:
+                    self.server.print_error(
+                        "Could not accept HTTP connection: %s." % e)
+                return
+            conn.setblocking(0)
+            self.connections.add(_HTTPConnection(self, conn))
+
+    def socket_writable_notification(self):
+        pass
+
+    def handle(self, request):
+        """Return (status, content type, body) for request."""
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for (_, path) in self.routes):
+                return (405, "text/plain", "Method Not Allowed\n")
+            return (404, "text/plain", "Not Found\n")
+        try:
+            return handler(request)
+        except Exception:
+            self.server.print_error("Error handling %s %s:\n%s"
+                                    % (request.method, request.path,
+                                       traceback.format_exc()))
+            return (500, "text/plain", "Internal Server Error\n")
+
+
+class _HTTPConnection(object):
+    def __init__(self, httpserver, sock):
+        self.httpserver = httpserver
+        self.server = httpserver.server
+        self.socket = sock
+        self.fileno = sock.fileno()
+        self.closed = False
+        self.__input = b""
+        self.__output = b""
+        self.__writable = False
+        self.__close_when_sent = False
+        self.__timer = None
+        self.__touch()
+        self.server.poller.register(self.fileno, self)
+
+    def __touch(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+        self.__timer = self.server.scheduler.call_later(
+            self.httpserver.idle_timeout, self.close)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.__timer.cancel()
+        self.server.poller.unregister(self.fileno, self)
+        self.socket.close()
+        self.httpserver.connections.discard(self)
+
+    def socket_readable_notification(self):
+        try:
+            data = self.socket.recv(65536)
+        except socket.error as e:
+            if e.args[0] not in _WOULD_BLOCK:
+                self.close()
+            return
+        if not data:
+            self.close()
+            return
+        self.__touch()
+        self.__input += data
+        while not self.__close_when_sent:
+            try:
+                request = self.__parse()
+            except _HTTPError as e:
+                reason = httplib.responses.get(e.status, "Error")
+                self.__respond(e.status, "text/plain", reason + "\n", False)
+                break
+            if request is None:
+                break
+            (status, content_type, body) = self.httpserver.handle(request)
+            connection = request.headers.get("connection", "").lower()
+            if request.version == "HTTP/1.0":
+                keep_alive = connection == "keep-alive"
+            else:
+                keep_alive = connection != "close"
+            self.__respond(status, content_type, body, keep_alive)
+        self.__send()
+
+    def socket_writable_notification(self):
+        self.__send()
+
+    def __parse(self):
+        # Return the next complete request in the input, or None.
+        end = self.__input.find(b"\r\n\r\n")
+        if end < 0:
+            if len(self.__input) > self.httpserver.max_header_size:
+                raise _HTTPError(431)
+            return None
+        lines = self.__input[:end].split(b"\r\n")
+        try:
+            (method, target, version) = lines[0].split(b" ", 2)
+        except ValueError:
+            raise _HTTPError(400)
+        headers = {}
+        for line in lines[1:]:
+            (name, colon, value) = line.partition(b":")
+            if not colon:
+                raise _HTTPError(400)
+            headers[name.strip().lower()] = value.strip()
+        if "transfer-encoding" in headers:
+            raise _HTTPError(411)
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise _HTTPError(400)
+        if length < 0:
+            raise _HTTPError(400)
+        if length > self.httpserver.max_body_size:
+            raise _HTTPError(413)
+        if len(self.__input) < end + 4 + length:
+            return None
+        body = self.__input[end + 4:end + 4 + length]
+        self.__input = self.__input[end + 4 + length:]
+        return HTTPRequest(method, target, version, headers, body)
+
+    def __respond(self, status, content_type, body, keep_alive):
+        self.__output += (
+            "HTTP/1.1 %d %s\r\n"
+            "Content-Type: %s\r\n"
+            "Content-Length: %d\r\n"
+            "Connection: %s\r\n"
+            "\r\n"
+            % (status, httplib.responses.get(status, ""), content_type,
+               len(body), "keep-alive" if keep_alive else "close")) + body
+        if not keep_alive:
+            self.__close_when_sent = True
+
+    def __send(self):
+        if self.closed:
+            return
+        while self.__output:
+            try:
+                sent = self.socket.send(self.__output)
+            except socket.error as e:
+                if e.args[0] in _WOULD_BLOCK:
+                    break
+                self.close()
+                return
+            self.__output = self.__output[sent:]
+        if not self.__output and self.__close_when_sent:
+            self.close()
+            return
+        writable = bool(self.__output)
+        if writable != self.__writable:
+            self.__writable = writable
+            self.server.poller.set_writable(self.fileno, self, writable)
+
+
+def bridge_routes(server):
+    """Return HTTPServer routes for the bridge's inbound endpoints.
+
+    They are the endpoints of webpy.py, handled on the event loop:
+    POST / relays one form-encoded message, POST /bulk many JSON ones
+    (see bridge.parse_bulk), and GET /metrics renders server.metrics.
+    """
+    def relay(request):
+        form = urlparse.parse_qs(request.body)
+        try:
+            channel = "#" + form["channel_name"][0]
+            user_name = form["user_name"][0]
+            text = form["text"][0]
+        except KeyError as e:
+            return (400, "text/plain", "Missing field %s\n" % e)
+        if not bridge.valid_nickname(user_name):
+            return (400, "text/plain", "Invalid user_name\n")
+        bridge.relay_to_channel(server, channel, user_name, text)
+        return (200, "text/plain", "")
+
+    def bulk(request):
+        try:
+            messages = bridge.parse_bulk(request.body)
+        except ValueError as e:
+            return (400, "text/plain", "Invalid JSON: %s\n" % e)
+        statuses = bridge.relay_batch(
+            server, [x for x in messages if isinstance(x, tuple)])
+        return (200, "application/json",
+                json.dumps({"results": bridge.bulk_results(messages,
+                                                           statuses)}))
+
+    def metrics(request):
+        return (200, "text/plain; version=0.0.4", server.metrics.render())
+
+    return {
+        ("POST", "/"): relay,
+        ("POST", "/bulk"): bulk,
+        ("GET", "/metrics"): metrics,
+    }
+
+
+class AsyncWebhookClient(object):
+    """Webhook deliveries on the event loop of a miniircd Server.
+
+    A counterpart of bridge.WebhookDispatcher without worker threads,
+    with the same submit(), stats() and register_metrics(). Deliveries
+    to one host go over one persistent connection, one at a time and in
+    order. Failed deliveries are retried with exponential backoff,
+    holding up later ones to the same host, like the dispatcher's
+    workers do. Beyond queue_size waiting deliveries, new ones are
+    dropped.
+
+    getaddrinfo() blocks, so host names are looked up on a short-lived
+    thread, which hands the result back through Server.inject. Results
+    are cached; a failed connection makes the next attempt look up
+    again.
+    """
+
+    def __init__(self, server, queue_size=10000, max_retries=5,
+                 backoff=0.5, max_backoff=30.0, timeout=10.0):
+        self.server = server
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.stopping = False  # Set by close(); no more retries.
+        self.counters = {
+            "submitted": 0,
+            "delivered": 0,
+            "failed": 0,
+            "retried": 0,
+            "dropped": 0,
+        }
+        self.delivery_seconds = miniircd.Histogram(bridge.DELIVERY_BOUNDS)
+        self.__hosts = {}  # (scheme, netloc) --> _WebhookConnection
+        self.__addresses = {}  # (host, port) --> getaddrinfo() entry
+        self.__lookups = {}  # (host, port) --> [callback], in progress
+
+    def submit(self, url, payload):
+        """Queue payload (a JSON-serialisable dict) for delivery to url.
+
+        Returns False if the delivery was dropped.
+        """
+        self.counters["submitted"] += 1
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ("http", "https") \
+                or self.queue_depth() >= self.queue_size:
+            self.counters["dropped"] += 1
+            return False
+        key = (parts.scheme, parts.netloc)
+        connection = self.__hosts.get(key)
+        if connection is None:
+            connection = self.__hosts[key] = _WebhookConnection(
+                self, parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        body = urllib.urlencode({"payload": json.dumps(payload)})
+        connection.queue.append([path, body, time.time(), 0])
+        connection.kick()
+        return True
+
+    def queue_depth(self):
+        return sum(len(x.queue) for x in self.__hosts.values())
+
+    def idle(self):
+        """Return whether no deliveries are waiting or in progress."""
+        return self.queue_depth() == 0
+
+    def close(self):
+        """Abandon outstanding deliveries and close all connections."""
+        self.stopping = True
+        for connection in self.__hosts.values():
+            connection.close()
+        self.__hosts = {}
+
+    def stats(self):
+        result = dict(self.counters)
+        result["queued"] = self.queue_depth()
+        return result
+
+    def register_metrics(self, metrics):
+        """Export the counters and delivery latencies to a Metrics."""
+        metrics.counter(
+            "webhook_deliveries_total", "Webhook deliveries by outcome.",
+            ("outcome",),
+            lambda: dict(((name,), value)
+                         for (name, value) in self.counters.items()))
+        metrics.gauge("webhook_queued", "Webhook deliveries waiting.",
+                      lambda: {(): self.queue_depth()})
+        metrics.histogram(
+            "webhook_delivery_seconds",
+            "Time from queueing to successful webhook delivery.",
+            bridge.DELIVERY_BOUNDS,
+            function=lambda: {(): self.delivery_seconds})
+
+    def resolve(self, host, port, callback):
+        """Return the getaddrinfo() entry to connect to, if cached.
+
+        Otherwise return None, and once the lookup is done, call
+        callback(entry, None) or, if it failed, callback(None, error)
+        from the event loop.
+        """
+        key = (host, port)
+        address = self.__addresses.get(key)
+        if address is not None:
+            return address
+        callbacks = self.__lookups.get(key)
+        if callbacks is None:
+            callbacks = self.__lookups[key] = []
+            thread = threading.Thread(
+                target=self.__look_up, args=(key,),
+                name="resolve-%s" % host)
+            thread.setDaemon(True)
+            thread.start()
+        if callback not in callbacks:
+            callbacks.append(callback)
+        return None
+
+    def __look_up(self, key):
+        # Runs on a thread of its own.
+        try:
+            result = (socket.getaddrinfo(
+                key[0], key[1], 0, socket.SOCK_STREAM)[0], None)
+        except socket.error as e:
+            result = (None, e)
+        while not self.server.inject(self.__resolved, key, *result):
+            time.sleep(0.1)
+
+    def __resolved(self, key, address, error):
+        if address is not None:
+            self.__addresses[key] = address
+        for callback in self.__lookups.pop(key, ()):
+            callback(address, error)
+
+    def forget_address(self, host, port):
+        self.__addresses.pop((host, port), None)
+
+
+class _WebhookConnection(object):
+    """Deliveries to one host, over one non-blocking connection."""
+
+    # States.
+    IDLE = 0  # Nothing in progress; the socket, if any, is kept alive.
+    RESOLVING = 1
+    CONNECTING = 2
+    HANDSHAKE = 3  # TLS handshake.
+    SENDING = 4
+    RECEIVING = 5
+    WAITING = 6  # Waiting to retry.
+
+    def __init__(self, client, scheme, netloc):
+        self.client = client
+        self.server = client.server
+        self.scheme = scheme
+        self.netloc = netloc
+        self.host = urlparse.urlsplit("//" + netloc).hostname
+        self.port = urlparse.urlsplit("//" + netloc).port \
+            or (443 if scheme == "https" else 80)
+        self.queue = deque()  # [path, body, queued at, attempts]
+        self.socket = None
+        self.state = self.IDLE
+        self.__fileno = None
+        self.__timer = None
+        self.__output = b""
+        self.__input = b""
+
+    def kick(self):
+        """Start the next delivery, if idle."""
+        if self.state != self.IDLE or not self.queue:
+            return
+        if self.socket is None:
+            self.__connect()
+        else:
+            self.__start_request()
+
+    def close(self):
+        self.__cancel_timer()
+        self.__close_socket()
+        self.queue.clear()
+        self.state = self.IDLE
+
+    def __close_socket(self):
+        if self.socket is not None:
+            self.server.poller.unregister(self.__fileno, self)
+            self.socket.close()
+            self.socket = None
+
+    def __cancel_timer(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+    def __arm_timeout(self):
+        self.__cancel_timer()
+        self.__timer = self.server.scheduler.call_later(
+            self.client.timeout, self.__timed_out)
+
+    def __timed_out(self):
+        self.__timer = None
+        self.__failed(socket.timeout("timed out"))
+
+    def __connect(self):
+        address = self.client.resolve(self.host, self.port, self.__resolved)
+        if address is None:
+            self.state = self.RESOLVING
+            self.__arm_timeout()
+        else:
+            self.__connect_to(address)
+
+    def __resolved(self, address, error):
+        if self.state != self.RESOLVING:
+            # Timed out or closed in the meantime.
+            return
+        if error is not None:
+            self.__failed(error)
+        else:
+            self.__connect_to(address)
+
+    def __connect_to(self, entry):
+        (family, socktype, proto, _, address) = entry
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(0)
+        error = sock.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self.client.forget_address(self.host, self.port)
+            self.__failed(socket.error(error, errno.errorcode.get(error)))
+            return
+        self.socket = sock
+        self.__fileno = sock.fileno()
+        self.state = self.CONNECTING
+        self.server.poller.register(self.__fileno, self, writable=True)
+        self.__arm_timeout()
+
+    def __start_request(self):
+        if not self.queue:
+            self.state = self.IDLE
+            return
+        (path, body, _, _) = self.queue[0]
+        self.__output = (
+            "POST %s HTTP/1.1\r\n"
+            "Host: %s\r\n"
+            "Content-Type: application/x-www-form-urlencoded\r\n"
+            "Content-Length: %d\r\n"
+            "\r\n%s" % (path, self.netloc, len(body), body))
+        self.__input = b""
+        self.state = self.SENDING
+        self.__arm_timeout()
+        self.server.poller.set_writable(self.__fileno, self, True)
+
+    def socket_writable_notification(self):
+        if self.state == self.CONNECTING:
+            error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self.client.forget_address(self.host, self.port)
+                self.__failed(socket.error(error, errno.errorcode.get(error)))
+            elif self.scheme == "https":
+                context = ssl.create_default_context()
+                self.socket = context.wrap_socket(
+                    self.socket, server_hostname=self.host,
+                    do_handshake_on_connect=False)
+                self.state = self.HANDSHAKE
+                self.__handshake()
+            else:
+                self.__start_request()
+        elif self.state == self.HANDSHAKE:
+            self.__handshake()
+        elif self.state == self.SENDING:
+            self.__send()
+        else:
+            self.server.poller.set_writable(self.__fileno, self, False)
+
+    def socket_readable_notification(self):
+        if self.state == self.HANDSHAKE:
+            self.__handshake()
+        elif self.state == self.RECEIVING:
+            self.__receive()
+        elif self.state in (self.IDLE, self.WAITING):
+            # The server closed an idle keep-alive connection, most
+            # likely, or sent something unasked for.
+            self.__close_socket()
+
+    def __handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self.server.poller.set_writable(self.__fileno, self, False)
+            return
+        except ssl.SSLWantWriteError:
+            self.server.poller.set_writable(self.__fileno, self, True)
+            return
+        except (ssl.SSLError, socket.error) as e:
+            self.__failed(e)
+            return
+        self.__start_request()
+
+    def __send(self):
+        try:
+            sent = self.socket.send(self.__output)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except socket.error as e:
+            if e.args[0] not in _WOULD_BLOCK:
+                self.__failed(e)
+            return
+        self.__output = self.__output[sent:]
+        if not self.__output:
+            self.state = self.RECEIVING
+            self.server.poller.set_writable(self.__fileno, self, False)
+
+    def __receive(self):
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break
+            except socket.error as e:
+                if e.args[0] not in _WOULD_BLOCK:
+                    self.__failed(e)
+                    return
+                break
+            if not data:
+                # Only a response without a length ends like this.
+                response = _parse_response(self.__input, True)
+                if response is None:
+                    self.__failed(httplib.IncompleteRead(self.__input))
+                else:
+                    self.__close_socket()
+                    self.__completed(response[0])
+                return
+            self.__input += data
+        try:
+            response = _parse_response(self.__input, False)
+        except httplib.HTTPException as e:
+            self.__failed(e)
+            return
+        if response is not None:
+            (status, keep_alive) = response
+            if not keep_alive:
+                self.__close_socket()
+            self.__completed(status)
+
+    def __completed(self, status):
+        self.__cancel_timer()
+        client = self.client
+        if 200 <= status < 300:
+            (_, _, queued_at, _) = self.queue.popleft()
+            client.counters["delivered"] += 1
+            client.delivery_seconds.observe(time.time() - queued_at)
+        elif status != 429 and status < 500:
+            # Retrying will not help.
+            sys.stderr.write("Webhook %s://%s rejected delivery: HTTP %d\n"
+                             % (self.scheme, self.netloc, status))
+            self.queue.popleft()
+            client.counters["failed"] += 1
+        else:
+            self.__retry("HTTP %d" % status)
+            return
+        self.state = self.IDLE
+        self.kick()
+
+    def __failed(self, error):
+        self.__cancel_timer()
+        self.__close_socket()
+        self.__retry(error)
+
+    def __retry(self, error):
+        self.__cancel_timer()
+        if not self.queue:
+            self.state = self.IDLE
+            return
+        client = self.client
+        delivery = self.queue[0]
+        if delivery[3] >= client.max_retries or client.stopping:
+            sys.stderr.write("Giving up on webhook %s://%s: %s\n"
+                             % (self.scheme, self.netloc, error))
+            self.queue.popleft()
+            client.counters["failed"] += 1
+            self.state = self.IDLE
+            self.kick()
+            return
+        delay = min(client.max_backoff, client.backoff * 2 ** delivery[3])
+        delivery[3] += 1
+        client.counters["retried"] += 1
+        self.state = self.WAITING
+        self.__timer = self.server.scheduler.call_later(
+            delay * random.uniform(0.5, 1.0), self.__resume)
+
+    def __resume(self):
+        self.__timer = None
+        self.state = self.IDLE
+        self.kick()
+
+
+def _parse_response(data, eof):
+    """Parse an HTTP response to a request.
+
+    Returns (status, keep alive) once data holds the whole response, or
+    None if more is needed. eof tells whether the connection has been
+    closed, which ends a response without a length.
+    """
+    end = data.find(b"\r\n\r\n")
+    if end < 0:
+        return None
+    lines = data[:end].split(b"\r\n")
+    try:
+        (version, status) = lines[0].split(b" ", 2)[:2]
+        status = int(status)
+    except ValueError:
+        raise httplib.BadStatusLine(lines[0])
+    headers = {}
+    for line in lines[1:]:
+        (name, _, value) = line.partition(b":")
+        headers[name.strip().lower()] = value.strip().lower()
+    keep_alive = headers.get("connection") != "close" \
+        and version != "HTTP/1.0"
+    body = data[end + 4:]
+    if status in (204, 304) or 100 <= status < 200:
+        return (status, keep_alive)
+    if headers.get("transfer-encoding") == "chunked":
+        # Walk the chunks to find the end of the body.
+        position = 0
+        while True:
+            line_end = body.find(b"\r\n", position)
+            if line_end < 0:
+                return None
+            try:
+                size = int(body[position:line_end].split(b";")[0], 16)
+            except ValueError:
+                raise httplib.HTTPException("bad chunk size")
+            if size == 0:
+                # Then optional trailers and an empty line.
+                if body.find(b"\r\n\r\n", line_end) < 0:
+                    return None
+                return (status, keep_alive)
+            position = line_end + 2 + size + 2
+            if position > len(body):
+                return None
+    if "content-length" in headers:
+        try:
+            length = int(headers["content-length"])
+        except ValueError:
+            raise httplib.HTTPException("bad Content-Length")
+        if len(body) < length:
+            return None
+        return (status, keep_alive)
+    if eof:
+        return (status, False)
+    return None
+
+
+def _strip_resume_fd(args):
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg == "--resume-fd":
+            skip = True
+        elif not arg.startswith("--resume-fd="):
+            yield arg
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run miniircd and the webhook bridge on one event loop.")
+    parser.add_argument("--listen", default="",
+                        help="address to listen on (default: all)")
+    parser.add_argument("--ports", default="6667",
+                        help="comma-separated IRC ports (default: 6667)")
+    parser.add_argument("--http-port", type=int, default=8080,
+                        help="port for the inbound webhook endpoints")
+    parser.add_argument("--password", help="IRC server password")
+    parser.add_argument("--history-dir",
+                        help="directory for channel history logs")
+    parser.add_argument("--history-on-join", type=int, default=20,
+                        help="history lines replayed on JOIN")
+    parser.add_argument("--state-dir",
+                        help="directory to keep persistent channels in;"
+                             " bridged channels are made persistent")
+    parser.add_argument("--bridge", action="append", default=[],
+                        metavar="CHANNEL=URL",
+                        help="relay PRIVMSGs in CHANNEL to webhook URL")
+    parser.add_argument("--window", type=float, default=1.0,
+                        help="seconds to coalesce outbound messages over")
+    parser.add_argument("--max-batch", type=int, default=20)
+    parser.add_argument("--shutdown-timeout", type=float, default=10.0,
+                        help="seconds to let deliveries finish on exit")
+    parser.add_argument("--pid-file",
+                        help="file to write the serving process' ID to")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--debug", action="store_true")
+    # Given by upgrade.hand_over to the new process.
+    parser.add_argument("--resume-fd", type=int, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    channels = {}
+    for entry in options.bridge:
+        (channel, equals, url) = entry.partition("=")
+        if not equals:
+            parser.error("--bridge takes CHANNEL=URL, not %r" % entry)
+        channels[channel] = url
+
+    server = miniircd.Server(
+        listen_host=options.listen,
+        ports=[int(x) for x in options.ports.split(",")],
+        password=options.password, verbose=options.verbose,
+        debug=options.debug, history_dir=options.history_dir,
+        history_on_join=options.history_on_join,
+        state_dir=options.state_dir)
+    if options.state_dir:
+        for name in channels:
+            server.set_channel_persistent(server.get_channel(name), True)
+    client = AsyncWebhookClient(server)
+    client.register_metrics(server.metrics)
+    coalescer = bridge.Coalescer(client, window=options.window,
+                                 max_batch=options.max_batch)
+    coalescer.register_metrics(server.metrics)
+    coalescer.start(server.scheduler)
+    bridge.bridge_channels(channels, coalescer)
+    httpserver = HTTPServer(server, (options.listen, options.http_port),
+                            bridge_routes(server))
+    if options.resume_fd is None:
+        httpserver.listen()
+    else:
+        (http_socket,) = upgrade.take_over(server, options.resume_fd)
+        httpserver.listen(http_socket)
+    if options.pid_file:
+        with open(options.pid_file, "w") as f:
+            f.write("%d\n" % os.getpid())
+
+    upgrading = []
+
+    def stop(signum, frame):
+        server.stop()
+
+    def upgrade_process(signum, frame):
+        upgrading.append(True)
+        server.stop()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGUSR2, upgrade_process)
+
+    while True:
+        server.run()
+        if not upgrading:
+            break
+        del upgrading[:]
+        # The new process gets the same arguments, minus --resume-fd.
+        argv = [sys.executable, sys.argv[0]] + list(
+            _strip_resume_fd(sys.argv[1:]))
+        if upgrade.hand_over(server, argv, [httpserver.socket]):
+            server.detach()
+            break
+
+    httpserver.close()
+    coalescer.stop()
+    server.close()
+    deadline = time.time() + options.shutdown_timeout
+    while not client.idle() and time.time() < deadline:
+        server.run_once(max(0, deadline - time.time()))
+    if not client.idle():
+        sys.stderr.write("Abandoning %d webhook deliveries.\n"
+                         % client.queue_depth())
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,600 @@
+#! /usr/bin/env python
+"""Linking miniircd servers into one IRC network.
+
+Servers connect to each other over TCP with a shared password, and the
+links must form a tree: no server may be reachable over two paths. Each
+server knows every user and channel membership in the network, through
+RemoteClients, so NAMES, WHO, WHOIS and ISON work across servers.
+
+Users are identified on links by an id unique in the network ("name/n",
+where name is the server's link name), so that nickname changes and
+collisions don't mix users up. Each server forwards what it gets from
+one link to its other links:
+
+- User introductions, nickname changes, joins, parts, topics, keys and
+  quits go to all servers.
+- Channel PRIVMSG and NOTICE go only over links behind which there are
+  members of the channel. Private messages go only towards the target.
+
+When a link comes up, each side first sends all users and channel
+memberships it knows about, with the channels' topics and keys (a
+burst). The rules for conflicts are:
+
+- Nicknames carry the time they were taken. When a server learns of a
+  user whose nickname is in use, the user with the older nickname keeps
+  it and the other is killed; if both are equally old, both are. The
+  server kills a local loser itself and sends a KILL towards a remote
+  one, while removing it locally at once. An unregistered local client
+  holding the nickname always loses.
+- In a burst, a channel's topic is replaced only by a newer one, and
+  its key only if it has none.
+
+When a link is lost, each side quits every user that was behind it,
+with "name1 name2" as quit message (a netsplit), and reconnects every
+reconnect_interval seconds if it made the connection.
+
+    python links.py --name hub1 --ports 6667 --link-port 7000 \\
+        --link-password secret
+    python links.py --name hub2 --ports 6668 --link-password secret \\
+        --peer 127.0.0.1:7000
+"""
+
+import argparse
+import errno
+import itertools
+import signal
+import socket
+import time
+import traceback
+
+import miniircd
+from cluster import LineConnection
+from miniircd import irc_lower, parse_message
+
+_INFINITY = float("inf")
+
+
+class _LinkedUser(object):
+    __slots__ = ("client", "uid", "ts")
+
+    def __init__(self, client, uid, ts):
+        self.client = client  # Client or RemoteClient
+        self.uid = uid
+        self.ts = ts  # When the nickname was taken.
+
+
+class _PeerLink(LineConnection):
+    """A connection to a peer server, once its SERVER line has come."""
+
+    def __init__(self, network, sock, address=None):
+        LineConnection.__init__(self, network.server.poller, sock)
+        self.network = network
+        self.address = address  # Where to reconnect, if we connected.
+        self.name = None  # Set by the peer's SERVER line.
+        self.send("SERVER %s %s" % (network.name, network.password))
+        network.server.schedule_flush(self)
+
+    def send(self, line):
+        if LineConnection.send(self, line):
+            self.network.server.schedule_flush(self)
+
+    def private_message(self, target, line):
+        self.network.private_message(target, line)
+
+    def close(self):
+        if not self.closed:
+            LineConnection.close(self)
+            self.network.link_lost(self)
+
+    def socket_readable_notification(self):
+        lines = self.read_lines()
+        if lines is None:
+            self.close()
+            return
+        for line in lines:
+            if self.closed:
+                break
+            self.network.handle(self, line)
+
+
+class _Listener(object):
+    def __init__(self, network, sock):
+        self.network = network
+        self.socket = sock
+
+    def socket_readable_notification(self):
+        try:
+            (conn, addr) = self.socket.accept()
+        except socket.error as e:
+            if e.args[0] not in miniircd._WOULD_BLOCK:
+                self.network.server.print_error(
+                    "Could not accept link: %s." % e)
+            return
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        _PeerLink(self.network, conn)
+
+    def socket_writable_notification(self):
+        pass
+
+
+class _Connector(object):
+    """A non-blocking connection attempt to a peer."""
+
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(0)
+        self.fileno = self.socket.fileno()
+        error = self.socket.connect_ex(address)
+        if error in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            network.server.poller.register(self.fileno, self, writable=True)
+        else:
+            self.__failed(error)
+
+    def __failed(self, error):
+        self.socket.close()
+        self.network.server.print_info(
+            "Could not link to %s:%d: %s."
+            % (self.address + (errno.errorcode.get(error, error),)))
+        self.network.reconnect_later(self.address)
+
+    def socket_readable_notification(self):
+        self.socket_writable_notification()
+
+    def socket_writable_notification(self):
+        self.network.server.poller.unregister(self.fileno, self)
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.__failed(error)
+            return
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        _PeerLink(self.network, self.socket, self.address)
+
+
+class ServerLinks(object):
+    """Server.network linking a miniircd Server to peer servers.
+
+    name identifies the server on links and must be unique in the
+    network; password is shared by all servers. Peers may connect to
+    port, if given, and start() connects to each (host, port) in peers.
+    Create it before the server has clients.
+    """
+
+    reconnect_interval = 10.0
+
+    def __init__(self, server, name, password, port=None, peers=()):
+        self.server = server
+        self.name = name
+        self.password = password
+        self.port = port
+        self.peers = list(peers)
+        self.links = {}  # Peer name --> _PeerLink
+        self.__uids = itertools.count(1)
+        self.__users = {}  # uid --> _LinkedUser
+        self.__by_client = {}  # Client or RemoteClient --> _LinkedUser
+        # irc_lower(Channel name) --> {_PeerLink: members behind it}
+        self.__interest = {}
+        self.__listener = None
+        server.network = self
+
+    def start(self):
+        """Listen for peers and connect to the configured ones."""
+        if self.port is not None:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((self.server.address, self.port))
+            s.listen(socket.SOMAXCONN)
+            s.setblocking(0)
+            self.__listener = _Listener(self, s)
+            self.server.poller.register(s.fileno(), self.__listener)
+            self.server.print_info("Listening for links on port %d."
+                                   % self.port)
+        for address in self.peers:
+            _Connector(self, address)
+
+    def close(self):
+        """Stop listening and close all links."""
+        if self.__listener is not None:
+            self.server.poller.unregister(
+                self.__listener.socket.fileno(), self.__listener)
+            self.__listener.socket.close()
+            self.__listener = None
+        self.peers = []
+        for link in list(self.links.values()):
+            link.flush()
+            link.close()
+
+    def reconnect_later(self, address):
+        if address in self.peers:
+            self.server.scheduler.call_later(
+                self.reconnect_interval, _Connector, self, address)
+
+    def __send_all(self, line, exclude=None):
+        for link in self.links.values():
+            if link is not exclude:
+                link.send(line)
+
+    def __uid_line(self, user):
+        client = user.client
+        return "UID %s %s %d %s %s :%s" % (
+            user.uid, client.nickname, user.ts, client.user, client.host,
+            client.realname)
+
+    # Changes made by local clients; see Server.network.
+
+    def claim_nickname(self, client, nickname, callback):
+        # Nicknames are checked locally only; collisions with users on
+        # other servers are resolved when they are found.
+        user = self.__by_client.get(client)
+        if user is not None:
+            user.ts = int(time.time())
+            self.__send_all("NICK %s %s %d" % (user.uid, nickname, user.ts))
+        return True
+
+    def introduce(self, client):
+        user = _LinkedUser(client, "%s/%d" % (self.name, next(self.__uids)),
+                           int(time.time()))
+        self.__users[user.uid] = user
+        self.__by_client[client] = user
+        self.__send_all(self.__uid_line(user))
+
+    def joined(self, client, channel):
+        self.__send_all("JOIN %s %s"
+                        % (self.__by_client[client].uid, channel.name))
+
+    def parted(self, client, channel, partmsg):
+        self.__send_all("PART %s %s :%s"
+                        % (self.__by_client[client].uid, channel.name,
+                           partmsg))
+
+    def topic_changed(self, client, channel):
+        self.__send_all("TOPIC %s %s %d :%s"
+                        % (self.__by_client[client].uid, channel.name,
+                           channel.topic_time, channel.topic))
+
+    def key_changed(self, client, channel):
+        line = "KEY %s %s" % (self.__by_client[client].uid, channel.name)
+        if channel.key is not None:
+            line += " " + channel.key
+        self.__send_all(line)
+
+    def channel_message(self, client, channel, command, text):
+        interest = self.__interest.get(channel.lower_name)
+        if interest:
+            line = "%s %s %s :%s" % (command, self.__by_client[client].uid,
+                                     channel.name, text)
+            for link in interest:
+                link.send(line)
+
+    def private_message(self, target, line):
+        target.link.send("PRIVATE %s :%s"
+                         % (self.__by_client[target].uid, line))
+
+    def quit(self, client, quitmsg):
+        user = self.__by_client.pop(client, None)
+        if user is not None:
+            del self.__users[user.uid]
+            self.__send_all("QUIT %s :%s" % (user.uid, quitmsg))
+
+    # Links.
+
+    def link_lost(self, link):
+        if link.name is None:
+            self.server.print_info("Link handshake failed.")
+        else:
+            self.server.print_info("Lost the link to %s." % link.name)
+            if self.links.get(link.name) is link:
+                del self.links[link.name]
+            quitmsg = "%s %s" % (self.name, link.name)
+            for user in list(self.__users.values()):
+                if user.client.link is link:
+                    self.__remove_remote(user.client, quitmsg, link)
+        if link.address is not None:
+            self.reconnect_later(link.address)
+
+    def __burst(self, link):
+        # Send what a new peer needs to know about this side.
+        for user in self.__users.values():
+            link.send(self.__uid_line(user))
+        by_client = self.__by_client
+        for channel in self.server.channels.values():
+            for member in itertools.chain(channel.members,
+                                          channel.remote_members):
+                user = by_client.get(member)
+                if user is not None:
+                    link.send("JOIN %s %s" % (user.uid, channel.name))
+            if channel.topic:
+                link.send("TOPIC * %s %d :%s" % (
+                    channel.name, channel.topic_time, channel.topic))
+            if channel.key is not None:
+                link.send("KEY * %s %s" % (channel.name, channel.key))
+
+    def __gain_interest(self, channel, link):
+        interest = self.__interest.setdefault(channel.lower_name, {})
+        interest[link] = interest.get(link, 0) + 1
+
+    def __lose_interest(self, channel, link):
+        interest = self.__interest[channel.lower_name]
+        interest[link] -= 1
+        if not interest[link]:
+            del interest[link]
+            if not interest:
+                del self.__interest[channel.lower_name]
+
+    def __remove_remote(self, client, quitmsg, exclude):
+        # Forget a remote user at once and quit it in the flush phase.
+        # Other links are told, except exclude.
+        user = self.__by_client.pop(client)
+        del self.__users[user.uid]
+        for channel in client.channels.values():
+            self.__lose_interest(channel, client.link)
+        self.__send_all("QUIT %s :%s" % (user.uid, quitmsg), exclude)
+        self.server.remove_client(client, quitmsg)
+
+    def __kill(self, client, reason):
+        if client.link is None:
+            client.disconnect(reason)
+        else:
+            user = self.__by_client[client]
+            client.link.send("KILL %s :%s" % (user.uid, reason))
+            self.__remove_remote(client, reason, client.link)
+
+    def __collide(self, link, uid, nickname, ts):
+        # Resolve a collision of a user from link with the holder of
+        # nickname, if any. Returns whether the user from link may have
+        # the nickname.
+        holder = self.server.get_client(nickname)
+        if holder is None:
+            return True
+        user = self.__by_client.get(holder)
+        if user is not None and user.uid == uid:
+            return True  # Changing case.
+        if user is None:
+            holder_ts = _INFINITY  # Not registered yet.
+        else:
+            holder_ts = user.ts
+        self.server.print_info("Nickname collision on %s." % nickname)
+        if holder_ts >= ts:
+            self.__kill(holder, "Nickname collision")
+        if holder_ts <= ts:
+            link.send("KILL %s :Nickname collision" % uid)
+            return False
+        return True
+
+    # Messages from peers.
+
+    def handle(self, link, line):
+        """Handle line from link."""
+        message = parse_message(line)
+        if link.name is None and message.command != "SERVER":
+            link.close()
+            return
+        handler = self._handlers.get(message.command)
+        if handler is None:
+            self.server.print_error("Unknown command from %s: %r"
+                                    % (link.name, line))
+            return
+        try:
+            handler(self, link, line, *message.params)
+        except Exception:
+            self.server.print_error("Error handling %r from %s:\n%s"
+                                    % (line, link.name,
+                                       traceback.format_exc()))
+
+    def __remote_user(self, link, uid):
+        # Return the user with uid if it is behind link.
+        user = self.__users.get(uid)
+        if user is None or user.client.link is not link:
+            return None
+        return user
+
+    def __server_handler(self, link, line, name, password):
+        if link.name is not None:
+            return
+        if password != self.password:
+            self.server.print_error("Bad link password from %s." % name)
+            link.close()
+        elif name == self.name or name in self.links:
+            self.server.print_error("Already linked to %s." % name)
+            link.close()
+        else:
+            link.name = name
+            self.links[name] = link
+            self.server.print_info("Linked to %s." % name)
+            self.__burst(link)
+
+    def __uid_handler(self, link, line, uid, nickname, ts, username, host,
+                      realname):
+        ts = int(ts)
+        if uid in self.__users:
+            self.server.print_error("%s introduced %s twice; are the links"
+                                    " a tree?" % (link.name, uid))
+            return
+        if not self.__collide(link, uid, nickname, ts):
+            return
+        client = miniircd.RemoteClient(
+            self.server, link, nickname, username, host, realname)
+        user = _LinkedUser(client, uid, ts)
+        self.__users[uid] = user
+        self.__by_client[client] = user
+        self.server.nicknames[client.lower_nickname] = client
+        self.__send_all(line, link)
+
+    def __nick_handler(self, link, line, uid, nickname, ts):
+        user = self.__remote_user(link, uid)
+        if user is None:
+            return
+        ts = int(ts)
+        if not self.__collide(link, uid, nickname, ts):
+            self.__remove_remote(user.client, "Nickname collision", link)
+            return
+        user.ts = ts
+        user.client.change_nickname(nickname)
+        self.__send_all(line, link)
+
+    def __join_handler(self, link, line, uid, channelname):
+        user = self.__remote_user(link, uid)
+        if user is None:
+            return
+        client = user.client
+        if irc_lower(channelname) not in client.channels:
+            channel = self.server.get_channel(channelname)
+            client.join(channel)
+            self.__gain_interest(channel, link)
+            self.__send_all(line, link)
+
+    def __part_handler(self, link, line, uid, channelname, partmsg):
+        user = self.__remote_user(link, uid)
+        if user is None:
+            return
+        channel = user.client.channels.get(irc_lower(channelname))
+        if channel is not None:
+            self.__lose_interest(channel, link)
+            user.client.part(channel, partmsg)
+            self.__send_all(line, link)
+
+    def __topic_handler(self, link, line, uid, channelname, when, topic):
+        server = self.server
+        if not server.has_channel(channelname):
+            return
+        channel = server.get_channel(channelname)
+        if uid == "*":
+            # From a burst.
+            if int(when) <= channel.topic_time:
+                return
+            channel.topic = topic
+            channel.topic_time = int(when)
+        else:
+            user = self.__remote_user(link, uid)
+            if user is None:
+                return
+            user.client.set_topic(channel, topic)
+            # Keep the time it was set over there, for bursts.
+            channel.topic_time = int(when)
+        self.__send_all(line, link)
+
+    def __key_handler(self, link, line, uid, channelname, key=None):
+        server = self.server
+        if not server.has_channel(channelname):
+            return
+        channel = server.get_channel(channelname)
+        if uid == "*":
+            # From a burst.
+            if channel.key is not None:
+                return
+            channel.key = key
+        else:
+            user = self.__remote_user(link, uid)
+            if user is None:
+                return
+            user.client.set_key(channel, key)
+        self.__send_all(line, link)
+
+    def __privmsg_handler(self, link, line, uid, channelname, text):
+        self.__message(link, line, "PRIVMSG", uid, channelname, text)
+
+    def __notice_handler(self, link, line, uid, channelname, text):
+        self.__message(link, line, "NOTICE", uid, channelname, text)
+
+    def __message(self, link, line, command, uid, channelname, text):
+        user = self.__remote_user(link, uid)
+        if user is None:
+            return
+        channel = user.client.channels.get(irc_lower(channelname))
+        if channel is None:
+            # Sending to a channel does not require being on it.
+            channel = self.server.channels.get(irc_lower(channelname))
+            if channel is None:
+                return
+        user.client.message_channel(channel, command, text)
+        interest = self.__interest.get(channel.lower_name)
+        if interest:
+            for x in interest:
+                if x is not link:
+                    x.send(line)
+
+    def __private_handler(self, link, line, uid, text):
+        user = self.__users.get(uid)
+        if user is None:
+            return
+        client = user.client
+        if client.link is None:
+            client.message(text)
+        elif client.link is not link:
+            client.link.send(line)
+
+    def __quit_handler(self, link, line, uid, quitmsg):
+        user = self.__remote_user(link, uid)
+        if user is not None:
+            self.__remove_remote(user.client, quitmsg, link)
+
+    def __kill_handler(self, link, line, uid, reason):
+        user = self.__users.get(uid)
+        if user is not None and user.client.link is not link:
+            self.__kill(user.client, reason)
+
+    # Command --> handler, called with the ServerLinks, the link, the
+    # line and the parameters of the message.
+    _handlers = {
+        "JOIN": __join_handler,
+        "KEY": __key_handler,
+        "KILL": __kill_handler,
+        "NICK": __nick_handler,
+        "NOTICE": __notice_handler,
+        "PART": __part_handler,
+        "PRIVATE": __private_handler,
+        "PRIVMSG": __privmsg_handler,
+        "QUIT": __quit_handler,
+        "SERVER": __server_handler,
+        "TOPIC": __topic_handler,
+        "UID": __uid_handler,
+    }
+
+
+def _address(text):
+    (host, _, port) = text.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run miniircd linked to other miniircd servers.")
+    parser.add_argument("--name", required=True,
+                        help="name of this server on links, unique in the"
+                             " network")
+    parser.add_argument("--listen", default="",
+                        help="address to listen on (default: all)")
+    parser.add_argument("--ports", default="6667",
+                        help="comma-separated IRC ports (default: 6667)")
+    parser.add_argument("--password", help="IRC server password")
+    parser.add_argument("--link-port", type=int,
+                        help="port to accept links from peers on")
+    parser.add_argument("--link-password", required=True,
+                        help="password shared by the linked servers")
+    parser.add_argument("--peer", action="append", default=[],
+                        metavar="HOST:PORT", type=_address,
+                        help="peer to link to; may be repeated")
+    parser.add_argument("--history-on-join", type=int, default=0,
+                        help="history lines replayed on JOIN")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--debug", action="store_true")
+    options = parser.parse_args()
+
+    server = miniircd.Server(
+        listen_host=options.listen,
+        ports=[int(x) for x in options.ports.split(",")],
+        password=options.password, verbose=options.verbose,
+        debug=options.debug, history_on_join=options.history_on_join)
+    links = ServerLinks(server, options.name, options.link_password,
+                        port=options.link_port, peers=options.peer)
+    links.start()
+    signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    server.run()
+    links.close()
+    server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -22,31 +22,139 @@
 
 VERSION = "1.1"
 
+import array
+import bisect
+import calendar
+import errno
+import fcntl
+import gc
+import heapq
+import itertools
+import mmap
+import os
 import re
 import select
 import socket
 import string
+import struct
 import sys
+import threading
 import time
+import traceback
+from collections import deque
 from datetime import datetime
 
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+# Longest nickname accepted; see Client.__valid_nickname_regexp.
+_MAX_NICKNAME_LENGTH = 51
+
+# Not defined by the socket module of Python 2; 15 is the Linux value.
+_SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+# Socket errors meaning "try again later" on a non-blocking socket.
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Scatter-gather sending is only available on Python 3.3+. Elsewhere,
+# queued chunks are joined into batches of at most _SEND_BATCH_SIZE bytes.
+_have_sendmsg = hasattr(socket.socket, "sendmsg")
+_SEND_BATCH_SIZE = 2 ** 16
+_SENDMSG_MAX_BUFFERS = 1024  # IOV_MAX on Linux.
+
+# Long replies (LIST, WHO) are produced a batch at a time, whenever the
+# client's send queue holds less than this many bytes.
+_PACED_QUEUE_SIZE = 2 ** 12
+
 
 class Channel(object):
-    def __init__(self, server, name):
+    __slots__ = ("server", "name", "lower_name", "members", "_topic", "_key",
+                 "history", "_nicknames", "_names", "topic_time",
+                 "remote_members", "persistent")
+
+    def __init__(self, server, name, lower_name=None):
         self.server = server
-        self.name = name
-        self.members = set()
+        self.name = _intern(name)
+        if lower_name is None:
+            lower_name = irc_lower(name)
+        self.lower_name = _intern(lower_name)
+        self.members = set()  # Local clients.
+        self.remote_members = set()  # RemoteClients; see Server.network.
         self._topic = ""
+        self.topic_time = 0  # When the topic was last set.
         self._key = None
+        self.history = None  # ChannelHistory, created on the first line.
+        self._nicknames = []  # Sorted nicknames of the members.
+        self._names = None  # Cached result of get_names.
+        # Kept without members; see Server.set_channel_persistent.
+        self.persistent = False
+
+    def load(self, topic, topic_time, key):
+        """Set the topic and key without recording a change."""
+        self._topic = topic
+        self.topic_time = topic_time
+        self._key = key
 
     def add_member(self, client):
-        self.members.add(client)
+        if client.link is None:
+            members = self.members
+        else:
+            members = self.remote_members
+        if client not in members:
+            members.add(client)
+            bisect.insort(self._nicknames, client.nickname)
+            self._names = None
+
+    def count_members(self):
+        """Return the number of members, local and remote."""
+        return len(self._nicknames)
+
+    def rename_member(self, oldnickname, newnickname):
+        nicknames = self._nicknames
+        del nicknames[_bisect_left(nicknames, oldnickname)]
+        bisect.insort(nicknames, newnickname)
+        self._names = None
+
+    def get_names(self):
+        """Return the members' nicknames for RPL_NAMREPLY (353).
+
+        The sorted nicknames are split into space-separated chunks short
+        enough for a 353 line to any client to stay within the 512 bytes
+        allowed by the RFC. The chunks are kept until the membership
+        changes.
+        """
+        if self._names is None:
+            limit = 512 - len(":%s 353 %s = %s :\r\n" % (
+                self.server.name, "x" * _MAX_NICKNAME_LENGTH, self.name))
+            nicknames = self._nicknames
+            names = []
+            start = 0
+            size = -1
+            for (i, nickname) in enumerate(nicknames):
+                size += 1 + len(nickname)
+                if size > limit and i > start:
+                    names.append(" ".join(nicknames[start:i]))
+                    start = i
+                    size = len(nickname)
+            if nicknames:
+                names.append(" ".join(nicknames[start:]))
+            self._names = names
+        return self._names
+
+    def broadcast(self, line, exclude=None, low_priority=False):
+        """Queue line for all members except exclude."""
+        self.server.broadcast(self.members, line, exclude, low_priority)
 
     def get_topic(self):
         return self._topic
 
     def set_topic(self, value):
         self._topic = value
+        self.topic_time = time.time()
+        if self.persistent:
+            self.server.channel_changed(self)
 
     topic = property(get_topic, set_topic)
 
@@ -55,17 +163,598 @@ class Channel(object):
 
     def set_key(self, value):
         self._key = value
+        if self.persistent:
+            self.server.channel_changed(self)
 
     key = property(get_key, set_key)
 
     def remove_client(self, client):
-        self.members.discard(client)
-        if not self.members:
+        if client.link is None:
+            members = self.members
+        else:
+            members = self.remote_members
+        if client in members:
+            members.remove(client)
+            nicknames = self._nicknames
+            del nicknames[_bisect_left(nicknames, client.nickname)]
+            self._names = None
+        if not self.members and not self.remote_members \
+                and not self.persistent:
             self.server.remove_channel(self)
 
+
+class ChannelFilter(object):
+    """Channel selection for LIST, as in the ELIST=MNTU extension.
+
+    text is a comma-separated list of conditions: channel names or masks
+    with * and ? wildcards (M), negated masks starting with "!" (N),
+    ">n" and "<n" for more or fewer than n members (U), and "T>n" and
+    "T<n" for a topic set more or less than n minutes ago (T). A channel
+    must match one of the masks, if any are given, and all the other
+    conditions. Conditions with invalid numbers are ignored.
+    """
+
+    def __init__(self, text=""):
+        self.masks = []  # Regexps; a channel must match one of them.
+        self.excluded = []  # Regexps; a channel may match none of them.
+        self.min_users = None
+        self.max_users = None
+        self.min_topic_age = None  # In seconds.
+        self.max_topic_age = None
+        prefixes = []
+        for condition in text.split(","):
+            try:
+                if condition[:2] in ("T>", "T<"):
+                    age = 60 * int(condition[2:])
+                    if condition[1] == ">":
+                        self.min_topic_age = age
+                    else:
+                        self.max_topic_age = age
+                elif condition[:1] == ">":
+                    self.min_users = int(condition[1:])
+                elif condition[:1] == "<":
+                    self.max_users = int(condition[1:])
+                elif condition[:1] == "!":
+                    self.excluded.append(_mask_regexp(condition[1:]))
+                elif condition:
+                    self.masks.append(_mask_regexp(condition))
+                    prefixes.append(
+                        re.split(r"[*?]", irc_lower(condition), 1)[0])
+            except ValueError:
+                pass
+        # Only channels with names starting with prefix can match.
+        self.prefix = os.path.commonprefix(prefixes)
+
+    def match(self, channel, now):
+        name = channel.lower_name
+        if self.masks and not any(x.match(name) for x in self.masks):
+            return False
+        if any(x.match(name) for x in self.excluded):
+            return False
+        users = channel.count_members()
+        if self.min_users is not None and users <= self.min_users:
+            return False
+        if self.max_users is not None and users >= self.max_users:
+            return False
+        if self.min_topic_age is not None or self.max_topic_age is not None:
+            if not channel.topic:
+                return False
+            age = now - channel.topic_time
+            if self.min_topic_age is not None and age <= self.min_topic_age:
+                return False
+            if self.max_topic_age is not None and age >= self.max_topic_age:
+                return False
+        return True
+
+
+class ChannelHistory(object):
+    """Recent lines of a channel, kept ready to be sent again.
+
+    The last Server.history_length lines are held in a ring buffer. If
+    log is a HistoryLog, every line is also appended to it, and it
+    serves what the ring buffer no longer holds, including lines from
+    before a restart.
+    """
+
+    __slots__ = ("ring", "log")
+
+    def __init__(self, length, log=None):
+        self.ring = deque(maxlen=length)  # (time, line)
+        self.log = log
+
+    def append(self, when, line):
+        """Add line, said at time when.
+
+        Returns True if the log had nothing buffered before this line.
+        """
+        self.ring.append((when, line))
+        return self.log is not None and self.log.append(when, line)
+
+    def select(self, after, before, limit, latest=True):
+        """Return up to limit lines said strictly between after and before.
+
+        The latest such lines are returned if latest is true, otherwise
+        the earliest. The result is a list of strings of whole lines, in
+        the order they were said.
+        """
+        ring = self.ring
+        lines = [line for (when, line) in ring if after < when < before]
+        if (self.log is None
+                or (ring and ring[0][0] <= after)
+                or (latest and len(lines) >= limit)):
+            if latest:
+                return lines[max(0, len(lines) - limit):]
+            return lines[:limit]
+        return self.log.select(after, before, limit, latest)
+
+
+class HistoryLog(object):
+    """Append-only history of a channel in memory-mapped segment files.
+
+    A segment is a file of segment_size bytes, sparse until written,
+    holding lines back to back, and an index file with a (time, offset)
+    pair of native doubles per line. append() only buffers; flush()
+    copies the buffered lines into the mapping of the current segment,
+    which needs no system call, and appends their index entries with a
+    single write. Queries bisect the index for byte ranges and slice
+    them out of the mappings, so lines are never handled one by one.
+
+    At most max_segments segments are kept; the oldest is deleted when
+    a new one is started.
+    """
+
+    def __init__(self, directory, segment_size, max_segments):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.__pending = []  # (time, line) not yet written.
+        self.__map = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.__segments = sorted(
+            int(name[:-4]) for name in os.listdir(directory)
+            if name.endswith(".log"))
+        if self.__segments:
+            self.__open(self.__segments[-1])
+        else:
+            self.__segments.append(0)
+            self.__open(0)
+
+    def __path(self, number, suffix):
+        return os.path.join(self.directory, "%08d%s" % (number, suffix))
+
+    def __open(self, number):
+        fd = os.open(self.__path(number, ".log"), os.O_RDWR | os.O_CREAT,
+                     0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size < self.segment_size:
+                os.ftruncate(fd, self.segment_size)
+                size = self.segment_size
+            self.__map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.__size = size
+        self.__number = number
+        indexpath = self.__path(number, ".idx")
+        (self.__times, self.__offsets) = _read_history_index(indexpath)
+        self.__indexfile = open(indexpath, "ab", 0)
+        # Drop a partly written entry, if any.
+        self.__indexfile.truncate(16 * len(self.__times))
+        self.__position = _history_end(self.__map, self.__offsets)
+
+    def __rotate(self):
+        self.__map.close()
+        self.__indexfile.close()
+        number = self.__number + 1
+        self.__segments.append(number)
+        while len(self.__segments) > self.max_segments:
+            oldest = self.__segments.pop(0)
+            for suffix in (".log", ".idx"):
+                try:
+                    os.remove(self.__path(oldest, suffix))
+                except OSError:
+                    pass
+        self.__open(number)
+
+    def append(self, when, line):
+        """Buffer line for the next flush().
+
+        Returns True if nothing was buffered before.
+        """
+        if len(line) > self.segment_size:
+            return False
+        self.__pending.append((when, line))
+        return len(self.__pending) == 1
+
+    def flush(self):
+        """Write buffered lines to the current segment."""
+        pending = self.__pending
+        if not pending or self.__map is None:
+            return
+        self.__pending = []
+        first = 0
+        position = self.__position
+        for (i, (_, line)) in enumerate(pending):
+            if position + len(line) > self.__size:
+                self.__write(pending[first:i])
+                self.__rotate()
+                first = i
+                position = 0
+            position += len(line)
+        self.__write(pending[first:])
+
+    def __write(self, records):
+        if not records:
+            return
+        index = array.array("d")
+        start = position = self.__position
+        for (when, line) in records:
+            index.append(when)
+            index.append(position)
+            self.__times.append(when)
+            self.__offsets.append(position)
+            position += len(line)
+        self.__map[start:position] = "".join(line for (_, line) in records)
+        index.tofile(self.__indexfile)
+        self.__position = position
+
+    def close(self):
+        if self.__map is None:
+            return
+        self.flush()
+        self.__map.close()
+        self.__indexfile.close()
+        self.__map = None
+
+    def select(self, after, before, limit, latest=True):
+        """Like ChannelHistory.select, but for everything in the log."""
+        self.flush()
+        ranges = []  # (segment number, offsets, first, end)
+        remaining = limit
+        if latest:
+            numbers = reversed(self.__segments)
+        else:
+            numbers = iter(self.__segments)
+        for number in numbers:
+            if remaining <= 0:
+                break
+            if number == self.__number:
+                (times, offsets) = (self.__times, self.__offsets)
+            else:
+                (times, offsets) = _read_history_index(
+                    self.__path(number, ".idx"))
+            if not times:
+                continue
+            first = bisect.bisect_right(times, after)
+            end = _bisect_left(times, before)
+            if first < end:
+                if latest:
+                    first = max(first, end - remaining)
+                else:
+                    end = min(end, first + remaining)
+                remaining -= end - first
+                ranges.append((number, offsets, first, end))
+            if latest and times[0] <= after:
+                break
+            if not latest and times[-1] >= before:
+                break
+        if latest:
+            ranges.reverse()
+        return [self.__read(*x) for x in ranges]
+
+    def __read(self, number, offsets, first, end):
+        start = int(offsets[first])
+        if number == self.__number:
+            if end < len(offsets):
+                return self.__map[start:int(offsets[end])]
+            return self.__map[start:self.__position]
+        fd = os.open(self.__path(number, ".log"), os.O_RDONLY)
+        try:
+            segment = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        try:
+            if end < len(offsets):
+                return segment[start:int(offsets[end])]
+            return segment[start:_history_end(segment, offsets)]
+        finally:
+            segment.close()
+
+
+class ChannelStore(object):
+    """Persistent channels on disk, as a snapshot and a journal.
+
+    A channel is stored as a record of its name, topic, topic time and
+    key. The snapshot holds a record per channel, and each change
+    appends a record of the channel's new state, or of its removal, to
+    the journal; load() replays the journal over the snapshot. compact()
+    writes a new snapshot in a background thread and starts the next
+    journal. Journals are numbered and the snapshot names the first one
+    it doesn't cover, so nothing is lost if the process stops while the
+    snapshot is written.
+
+    Only one process at a time may use directory.
+    """
+
+    _HEADER = struct.Struct("!8sQ")  # Magic, first journal to replay.
+    # Operation, topic time, and lengths of name, topic and key (-1 for
+    # no key), followed by the name, topic and key.
+    _RECORD = struct.Struct("!BdHHh")
+    _MAGIC = b"MIRCCHN1"
+    _SET = 83  # "S"
+    _REMOVE = 82  # "R"
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.journal_size = 0  # Bytes in the current journal.
+        self.snapshot_size = 0
+        self.__number = 0  # Of the current journal.
+        self.__journal = None  # Opened on the first write.
+        self.__thread = None  # Writing a snapshot.
+
+    def __path(self, number=None):
+        if number is None:
+            return os.path.join(self.directory, "channels.snapshot")
+        return os.path.join(self.directory, "channels.%08d.journal" % number)
+
+    def __journals(self):
+        return sorted(
+            int(name[9:-8]) for name in os.listdir(self.directory)
+            if name.startswith("channels.") and name.endswith(".journal"))
+
+    def load(self):
+        """Return {irc_lower(name): (name, topic, topic time, key)}."""
+        channels = {}
+        try:
+            with open(self.__path(), "rb") as f:
+                data = f.read()
+        except IOError:
+            data = b""
+        first = 0
+        if data:
+            (magic, first) = self._HEADER.unpack_from(data)
+            if magic != self._MAGIC:
+                raise ValueError("%s is not a channel snapshot"
+                                 % self.__path())
+            self.__replay(data, self._HEADER.size, channels)
+        self.snapshot_size = len(data)
+        self.__number = first
+        for number in self.__journals():
+            path = self.__path(number)
+            if number < first:
+                os.remove(path)
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            end = self.__replay(data, 0, channels)
+            if end < len(data):
+                # Drop a partly written record.
+                with open(path, "r+b") as f:
+                    f.truncate(end)
+            self.__number = number
+            self.journal_size = end
+        return channels
+
+    def __replay(self, data, position, channels):
+        # Apply the records in data to channels. Returns where the last
+        # complete record ends.
+        unpack = self._RECORD.unpack_from
+        size = self._RECORD.size
+        # Like irc_lower, whose memo would only be thrashed here.
+        translation = _ircstring_translation
+        end = len(data)
+        while position + size <= end:
+            (operation, topic_time, name_length, topic_length,
+             key_length) = unpack(data, position)
+            start = position + size
+            position = start + name_length + topic_length + max(key_length, 0)
+            if position > end:
+                return start - size
+            name = data[start:start + name_length]
+            if operation == self._REMOVE:
+                channels.pop(name.translate(translation), None)
+                continue
+            start += name_length
+            topic = data[start:start + topic_length]
+            if key_length < 0:
+                key = None
+            else:
+                key = data[start + topic_length:position]
+            channels[name.translate(translation)] = (
+                name, topic, topic_time, key)
+        return position
+
+    def __record(self, operation, name, topic="", topic_time=0, key=None):
+        if key is None:
+            key_length = -1
+            key = ""
+        else:
+            key_length = len(key)
+        return (self._RECORD.pack(operation, topic_time, len(name),
+                                  len(topic), key_length)
+                + name + topic + key)
+
+    def __append(self, record):
+        if self.__journal is None:
+            self.__journal = open(self.__path(self.__number), "ab", 0)
+        self.__journal.write(record)
+        self.journal_size += len(record)
+
+    def set(self, name, topic, topic_time, key):
+        """Record the state of channel name."""
+        self.__append(self.__record(
+            self._SET, name, topic, topic_time, key))
+
+    def remove(self, name):
+        """Record that channel name is no longer persistent."""
+        self.__append(self.__record(self._REMOVE, name))
+
+    def compact(self, channels):
+        """Replace the snapshot and journal with a snapshot of channels.
+
+        channels is a list of (name, topic, topic time, key), the state
+        of all persistent channels. The snapshot is written by another
+        thread; if one is still busy, nothing is done and False is
+        returned.
+        """
+        if self.__thread is not None and self.__thread.is_alive():
+            return False
+        self.__number += 1
+        if self.__journal is not None:
+            self.__journal.close()
+            self.__journal = None
+        self.journal_size = 0
+        self.__thread = threading.Thread(
+            target=self.__write_snapshot, args=(channels, self.__number))
+        self.__thread.daemon = True
+        self.__thread.start()
+        return True
+
+    def __write_snapshot(self, channels, number):
+        data = b"".join(
+            [self._HEADER.pack(self._MAGIC, number)]
+            + [self.__record(self._SET, *x) for x in channels])
+        self.snapshot_size = len(data)
+        path = self.__path()
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+        for old in self.__journals():
+            if old < number:
+                os.remove(self.__path(old))
+
+    def close(self):
+        """Wait for compaction and close the journal.
+
+        The store can still be written to; the journal is opened again.
+        """
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        if self.__journal is not None:
+            self.__journal.close()
+            self.__journal = None
+
+
+class LineBuffer(object):
+    """Incremental splitter of CR?LF-terminated lines.
+
+    Reads go into a buffer shared by all clients (Server.read_buffer).
+    Only new bytes are scanned for line terminators, and only the
+    unterminated tail of a read is copied into the per-client pending
+    buffer.
+    """
+
+    __slots__ = ("_pending",)
+
+    def __init__(self):
+        self._pending = None  # bytearray holding an incomplete line.
+
+    def __len__(self):
+        if self._pending is None:
+            return 0
+        return len(self._pending)
+
+    def get_pending(self):
+        """Return the bytes of the incomplete line, if any."""
+        return bytes(self._pending or b"")
+
+    def set_pending(self, data):
+        self._pending = bytearray(data) if data else None
+
+    def feed(self, buf, length):
+        """Return the complete, non-empty lines ending in buf[:length]."""
+        pending = self._pending
+        if pending is None:
+            start = 0
+        else:
+            # pending never contains a newline, so only scan the new data.
+            start = len(pending)
+            pending += memoryview(buf)[:length]
+            buf = pending
+            length = len(pending)
+        lines = []
+        view = memoryview(buf)
+        pos = 0
+        nl = buf.find(b"\n", start, length)
+        while nl >= 0:
+            end = nl
+            if end > pos and buf[end - 1] == 13:  # CR
+                end -= 1
+            if end > pos:
+                lines.append(view[pos:end].tobytes())
+            pos = nl + 1
+            nl = buf.find(b"\n", pos, length)
+        del view  # Allow pending to be resized.
+        if pos == length:
+            self._pending = None
+        elif buf is pending:
+            del pending[:pos]
+        else:
+            self._pending = buf[pos:length]
+        return lines
+
+
+class Message(object):
+    """A parsed IRC line."""
+
+    __slots__ = ("prefix", "command", "params")
+
+    def __init__(self, prefix, command, params):
+        self.prefix = prefix  # None if the line had no prefix.
+        self.command = command  # Upper case.
+        self.params = params
+
+    def __repr__(self):
+        return "Message(%r, %r, %r)" % (self.prefix, self.command, self.params)
+
+
+def parse_message(line):
+    """Parse an IRC line into a Message."""
+    if line[:1] == ":":
+        (prefix, _, line) = line[1:].partition(" ")
+    else:
+        prefix = None
+    x = line.split(" ", 1)
+    command = x[0].upper()
+    if len(x) == 1:
+        params = []
+    elif x[1][:1] == ":":
+        params = [x[1][1:]]
+    else:
+        y = x[1].split(" :", 1)
+        params = y[0].split()
+        if len(y) == 2:
+            params.append(y[1])
+    return Message(prefix, command, params)
+
+
 class Client(object):
-    __linesep_regexp = re.compile(r"\r?\n")
+    __slots__ = (
+        "server", "socket", "channels", "nickname", "lower_nickname",
+        "user", "realname", "host", "port", "broadcast_epoch",
+        "__fileno", "__timestamp",
+        "__linebuffer", "__writequeue", "__writeoffset",
+        "__writequeue_size", "__write_interest", "__disconnected",
+        "__sent_ping", "__aliveness_timer", "__state", "__paused",
+        "__skipped", "__closing", "__replies", "__backlog", "__waiting",
+        "__reading", "__exempt", "__tokens", "__tokens_time", "__claim")
+
+    # Local clients are not reached through a link; see RemoteClient.
+    link = None
+
+    # Registration states.
+    _STATE_PASS = 0  # Waiting for PASS.
+    _STATE_REGISTRATION = 1  # Waiting for NICK and USER.
+    _STATE_REGISTERED = 2
+
     # The RFC limit for nicknames is 9 characters, but what the heck.
+    # Keep _MAX_NICKNAME_LENGTH in sync.
     __valid_nickname_regexp = re.compile(
         r"^[][\`_^{|}A-Za-z][][\`_^{|}A-Za-z0-9-]{0,50}$")
     __valid_channelname_regexp = re.compile(
@@ -76,78 +765,175 @@ class Client(object):
         self.socket = socket
         self.channels = {}  # irc_lower(Channel name) --> Channel
         self.nickname = None
+        self.lower_nickname = None  # irc_lower(nickname), set along with it.
         self.user = None
         self.realname = None
-        (self.host, self.port) = socket.getpeername()
+        (host, self.port) = socket.getpeername()
+        self.host = _intern(host)
+        self.broadcast_epoch = 0  # See Server.broadcast_channels.
+        self.__fileno = socket.fileno()
         self.__timestamp = time.time()
-        self.__readbuffer = ""
-        self.__writebuffer = ""
+        self.__linebuffer = LineBuffer()
+        # Deque of immutable chunks of wire data, or None when there is
+        # nothing to send; idle clients then don't hold an empty deque.
+        self.__writequeue = None
+        self.__writeoffset = 0  # Bytes of __writequeue[0] already sent.
+        self.__writequeue_size = 0
+        self.__write_interest = False
+        self.__disconnected = False
+        self.__paused = False  # Over the send queue limit; see enqueue.
+        self.__skipped = 0  # Lines not queued while paused.
+        self.__closing = False  # To be disconnected for exceeding SendQ.
+        self.__replies = None  # Iterator of paced reply lines, if any.
+        # Deque of received lines not handled yet, or None; see
+        # handle_backlog.
+        self.__backlog = None
+        self.__waiting = False  # For the next iteration or for tokens.
+        self.__reading = True  # False while the backlog is too long.
+        self.__exempt = self.host in server.flood_exempt
+        self.__tokens = server.flood_burst
+        self.__tokens_time = self.__timestamp
+        # What to do with the answer to a nickname claim that
+        # server.network has yet to answer, or None; see
+        # __claim_nickname.
+        self.__claim = None
         self.__sent_ping = False
-	self.ready_to_write = False
+        self.__aliveness_timer = server.scheduler.call_at(
+            self.__timestamp + 90, self.check_aliveness)
         if self.server.password:
-            self.__handle_command = self.__pass_handler
+            self.__state = self._STATE_PASS
         else:
-            self.__handle_command = self.__registration_handler
+            self.__state = self._STATE_REGISTRATION
 
     def get_prefix(self):
         return "%s!%s@%s" % (self.nickname, self.user, self.host)
     prefix = property(get_prefix)
 
     def check_aliveness(self):
+        # Run by the server's scheduler. Incoming data only updates
+        # __timestamp, so the timer is re-armed here rather than on every
+        # read.
         now = time.time()
-        if self.__timestamp + 180 < now:
+        if self.__timestamp + 180 <= now:
             self.disconnect("ping timeout")
             return
-        if not self.__sent_ping and self.__timestamp + 90 < now:
-            if self.__handle_command == self.__command_handler:
+        if not self.__sent_ping and self.__timestamp + 90 <= now:
+            if self.__state == self._STATE_REGISTERED:
                 # Registered.
                 self.message("PING :%s" % self.server.name)
                 self.__sent_ping = True
             else:
                 # Not registered.
                 self.disconnect("ping timeout")
+                return
+        if self.__sent_ping:
+            deadline = self.__timestamp + 180
+        else:
+            deadline = self.__timestamp + 90
+        self.__aliveness_timer = self.server.scheduler.call_at(
+            deadline, self.check_aliveness)
 
     def write_queue_size(self):
-        return len(self.__writebuffer)
-
-    def __parse_read_buffer(self):
-        lines = self.__linesep_regexp.split(self.__readbuffer)
-        self.__readbuffer = lines[-1]
-        lines = lines[:-1]
-        for line in lines:
-            if not line:
-                # Empty line. Ignore.
-                continue
-            x = line.split(" ", 1)
-            command = x[0].upper()
-            if len(x) == 1:
-                arguments = []
-            else:
-                if len(x[1]) > 0 and x[1][0] == ":":
-                    arguments = [x[1][1:]]
-                else:
-                    y = string.split(x[1], " :", 1)
-                    arguments = string.split(y[0])
-                    if len(y) == 2:
-                        arguments.append(y[1])
-            self.__handle_command(command, arguments)
-
-    def __pass_handler(self, command, arguments):
+        return self.__writequeue_size
+
+    def __update_write_interest(self):
+        # Only touch the poller when the write queue goes between empty
+        # and non-empty.
+        want = self.__writequeue_size > 0 or self.__replies is not None
+        if want != self.__write_interest:
+            self.__write_interest = want
+            self.server.poller.set_writable(self.__fileno, self, want)
+
+    def handle_backlog(self):
+        """Handle received lines, as far as fairness and flood control allow.
+
+        At most Server.lines_per_iteration lines are handled per event
+        loop iteration; the rest wait for the next one. Unless the
+        client's host is in Server.flood_exempt, each command also costs
+        Server.command_costs tokens (default 1), which refill at
+        Server.flood_rate per second up to Server.flood_burst, and
+        commands wait until there are enough. While more than
+        Server.backlog_limit lines wait, the socket isn't read, so TCP
+        flow control holds the client back.
+        """
+        self.__waiting = False
+        if self.__disconnected:
+            return
+        if self.__claim is not None:
+            # __claimed carries on.
+            self.__waiting = True
+            return
+        server = self.server
+        backlog = self.__backlog
+        rate = server.flood_rate
+        if self.__exempt:
+            rate = None
+        if rate is not None:
+            burst = server.flood_burst
+            costs = server.command_costs
+            now = time.time()
+            tokens = min(
+                burst, self.__tokens + (now - self.__tokens_time) * rate)
+            self.__tokens_time = now
+        budget = server.lines_per_iteration
+        while backlog and budget:
+            message = parse_message(backlog[0])
+            if rate is not None:
+                cost = min(costs.get(message.command, 1), burst)
+                if tokens < cost:
+                    self.__waiting = True
+                    server.scheduler.call_at(
+                        now + (cost - tokens) / float(rate),
+                        self.handle_backlog)
+                    server.flood_actions.labels("delay").value += 1
+                    break
+                tokens -= cost
+            backlog.popleft()
+            budget -= 1
+            self.__state_handlers[self.__state](self, message)
+            if self.__disconnected:
+                return
+            if self.__claim is not None:
+                break
+        if rate is not None:
+            self.__tokens = tokens
+        if not backlog:
+            self.__backlog = None
+            waiting = 0
+        else:
+            waiting = len(backlog)
+            if not self.__waiting:
+                self.__waiting = True
+                server.backlog_ready(self)
+        if self.__reading:
+            if waiting > server.backlog_limit:
+                self.__reading = False
+                server.poller.set_readable(self.__fileno, self, False)
+                server.flood_actions.labels("pause").value += 1
+        elif waiting <= server.backlog_limit // 2:
+            self.__reading = True
+            server.poller.set_readable(self.__fileno, self, True)
+
+    def __pass_handler(self, message):
         server = self.server
+        command = message.command
+        arguments = message.params
         if command == "PASS":
             if len(arguments) == 0:
                 self.reply_461("PASS")
             else:
                 if arguments[0].lower() == server.password:
-                    self.__handle_command = self.__registration_handler
+                    self.__state = self._STATE_REGISTRATION
                 else:
                     self.reply("464 :Password incorrect")
         elif command == "QUIT":
             self.disconnect("Client quit")
             return
 
-    def __registration_handler(self, command, arguments):
+    def __registration_handler(self, message):
         server = self.server
+        command = message.command
+        arguments = message.params
         if command == "NICK":
             if len(arguments) < 1:
                 self.reply("431 :No nickname given")
@@ -158,17 +944,31 @@ class Client(object):
             elif not self.__valid_nickname_regexp.match(nick):
                 self.reply("432 * %s :Erroneous nickname" % nick)
             else:
-                self.nickname = nick
-                server.client_changed_nickname(self, None)
+                self.__claim_nickname(nick, self.__registration_nickname)
+                return
         elif command == "USER":
             if len(arguments) < 4:
                 self.reply_461("USER")
                 return
-            self.user = arguments[0]
+            self.user = _intern(arguments[0])
             self.realname = arguments[3]
         elif command == "QUIT":
             self.disconnect("Client quit")
             return
+        self.__check_registration()
+
+    def __registration_nickname(self, nick, granted):
+        if not granted:
+            self.reply("433 * %s :Nickname is already in use" % nick)
+            return
+        oldnickname = self.nickname
+        self.nickname = _intern(nick)
+        self.lower_nickname = _intern(irc_lower(nick))
+        self.server.client_changed_nickname(self, oldnickname)
+        self.__check_registration()
+
+    def __check_registration(self):
+        server = self.server
         if self.nickname and self.user:
             self.reply("001 %s :Hi, welcome to IRC" % self.nickname)
             self.reply("002 %s :Your host is %s, running version miniircd-%s"
@@ -177,374 +977,858 @@ class Client(object):
                        % self.nickname)
             self.reply("004 %s :%s miniircd-%s o o"
                        % (self.nickname, server.name, VERSION))
+            self.reply("005 %s SAFELIST ELIST=MNTU :are supported by this "
+                       "server" % self.nickname)
             self.send_lusers()
             self.send_motd()
-            self.__handle_command = self.__command_handler
+            self.__state = self._STATE_REGISTERED
+            if server.network is not None:
+                server.network.introduce(self)
+
+    def __command_handler(self, message):
+        handler = self._command_handlers.get(message.command)
+        if handler is None:
+            self.server.unknown_commands.value += 1
+            self.reply("421 %s %s :Unknown command"
+                       % (self.nickname, message.command))
+            return
+        started = time.time()
+        handler(self, message)
+        self.server.command_histograms[message.command].observe(
+            time.time() - started)
 
-    def __command_handler(self, command, arguments):
-        def away_handler():
-            pass
+    def __away_handler(self, message):
+        pass
 
-        def ison_handler():
-            if len(arguments) < 1:
-                self.reply_461("ISON")
+    def __chathistory_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 4:
+            self.reply_461("CHATHISTORY")
+            return
+        subcommand = arguments[0].upper()
+        targetname = arguments[1]
+        channel = self.channels.get(irc_lower(targetname))
+        if channel is None:
+            self.reply("FAIL CHATHISTORY INVALID_TARGET %s %s :Messages "
+                       "could not be retrieved" % (subcommand, targetname))
+            return
+        try:
+            limit = int(arguments[-1])
+            if limit < 1:
+                raise ValueError(limit)
+            limit = min(limit, server.history_replay_limit)
+            latest = True
+            (after, before) = (_NEG_INFINITY, _INFINITY)
+            if subcommand == "LATEST":
+                if arguments[2] != "*":
+                    after = _parse_history_timestamp(arguments[2])
+            elif subcommand == "BEFORE":
+                before = _parse_history_timestamp(arguments[2])
+            elif subcommand == "AFTER":
+                after = _parse_history_timestamp(arguments[2])
+                latest = False
+            elif subcommand == "BETWEEN" and len(arguments) > 4:
+                after = _parse_history_timestamp(arguments[2])
+                before = _parse_history_timestamp(arguments[3])
+                # Going backwards from the first reference.
+                latest = after > before
+                if latest:
+                    (after, before) = (before, after)
+            else:
+                self.reply("FAIL CHATHISTORY INVALID_PARAMS %s :Unknown "
+                           "subcommand or missing parameters" % subcommand)
                 return
-            nicks = arguments
-            online = [n for n in nicks if server.get_client(n)]
-            self.reply("303 %s :%s" % (self.nickname, " ".join(online)))
+        except ValueError:
+            self.reply("FAIL CHATHISTORY INVALID_PARAMS %s :Invalid "
+                       "timestamp or limit" % subcommand)
+            return
+        for chunk in self.__history(channel, after, before, limit, latest):
+            self.enqueue(chunk, low_priority=True)
+        self.reply("NOTICE %s :End of CHATHISTORY for %s"
+                   % (self.nickname, channel.name))
 
-        def join_handler():
-            if len(arguments) < 1:
-                self.reply_461("JOIN")
-                return
-            if arguments[0] == "0":
-                for (channelname, channel) in self.channels.items():
-                    self.message_channel(channel, "PART", channelname, True)
-                    self.channel_log(channel, "left", meta=True)
-                    server.remove_member_from_channel(self, channelname)
-                self.channels = {}
-                return
-            channelnames = arguments[0].split(",")
-            if len(arguments) > 1:
-                keys = arguments[1].split(",")
-            else:
-                keys = []
-            keys.extend((len(channelnames) - len(keys)) * [None])
-            for (i, channelname) in enumerate(channelnames):
-                if irc_lower(channelname) in self.channels:
-                    continue
-                if not valid_channel_re.match(channelname):
-                    self.reply_403(channelname)
-                    continue
-                channel = server.get_channel(channelname)
-                if channel.key is not None and channel.key != keys[i]:
-                    self.reply(
-                        "475 %s %s :Cannot join channel (+k) - bad key"
-                        % (self.nickname, channelname))
-                    continue
-                channel.add_member(self)
-                self.channels[irc_lower(channelname)] = channel
-                self.message_channel(channel, "JOIN", channelname, True)
-                self.channel_log(channel, "joined", meta=True)
-                if channel.topic:
-                    self.reply("332 %s %s :%s"
-                               % (self.nickname, channel.name, channel.topic))
-                else:
-                    self.reply("331 %s %s :No topic is set"
-                               % (self.nickname, channel.name))
-                self.reply("353 %s = %s :%s"
-                           % (self.nickname,
-                              channelname,
-                              " ".join(sorted(x.nickname
-                                              for x in channel.members))))
-                self.reply("366 %s %s :End of NAMES list"
-                           % (self.nickname, channelname))
+    def __ison_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 1:
+            self.reply_461("ISON")
+            return
+        nicks = arguments
+        online = [n for n in nicks if server.get_client(n)]
+        self.reply("303 %s :%s" % (self.nickname, " ".join(online)))
 
-        def list_handler():
-            if len(arguments) < 1:
-                channels = server.channels.values()
+    def __join_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 1:
+            self.reply_461("JOIN")
+            return
+        if arguments[0] == "0":
+            for (channelname, channel) in self.channels.items():
+                self.message_channel(channel, "PART", channelname, True)
+                self.channel_log(channel, "left", meta=True)
+                if server.network is not None:
+                    server.network.parted(self, channel, self.nickname)
+                channel.remove_client(self)
+            self.channels = {}
+            return
+        channelnames = arguments[0].split(",")
+        if len(arguments) > 1:
+            keys = arguments[1].split(",")
+        else:
+            keys = []
+        keys.extend((len(channelnames) - len(keys)) * [None])
+        for (i, channelname) in enumerate(channelnames):
+            if irc_lower(channelname) in self.channels:
+                continue
+            if not self.__valid_channelname_regexp.match(channelname):
+                self.reply_403(channelname)
+                continue
+            channel = server.get_channel(channelname)
+            if channel.key is not None and channel.key != keys[i]:
+                self.reply(
+                    "475 %s %s :Cannot join channel (+k) - bad key"
+                    % (self.nickname, channelname))
+                continue
+            if server.history_on_join:
+                backlog = self.__history(
+                    channel, _NEG_INFINITY, _INFINITY,
+                    server.history_on_join)
             else:
-                channels = []
-                for channelname in arguments[0].split(","):
-                    if server.has_channel(channelname):
-                        channels.append(server.get_channel(channelname))
-            channels.sort(key=lambda x: x.name)
-            for channel in channels:
-                self.reply("322 %s %s %d :%s"
-                           % (self.nickname, channel.name,
-                              len(channel.members), channel.topic))
-            self.reply("323 %s :End of LIST" % self.nickname)
-
-        def lusers_handler():
-            self.send_lusers()
+                backlog = []
+            channel.add_member(self)
+            self.channels[channel.lower_name] = channel
+            if server.network is not None:
+                server.network.joined(self, channel)
+            self.message_channel(channel, "JOIN", channelname, True)
+            self.channel_log(channel, "joined", meta=True)
+            if channel.topic:
+                self.reply("332 %s %s :%s"
+                           % (self.nickname, channel.name, channel.topic))
+            else:
+                self.reply("331 %s %s :No topic is set"
+                           % (self.nickname, channel.name))
+            self.send_names(channel, channelname)
+            for chunk in backlog:
+                self.enqueue(chunk, low_priority=True)
+
+    def __list_handler(self, message):
+        arguments = message.params
+        if len(arguments) < 1:
+            channelfilter = ChannelFilter()
+        else:
+            channelfilter = ChannelFilter(arguments[0])
+        self.reply_paced(self.__list_replies(channelfilter))
 
-        def mode_handler():
-            if len(arguments) < 1:
-                self.reply_461("MODE")
+    def __list_replies(self, channelfilter):
+        nickname = self.nickname
+        now = time.time()
+        for channel in self.server.iter_channels(channelfilter.prefix):
+            if channelfilter.match(channel, now):
+                yield ("322 %s %s %d :%s"
+                       % (nickname, channel.name, channel.count_members(),
+                          channel.topic))
+        yield "323 %s :End of LIST" % nickname
+
+    def __lusers_handler(self, message):
+        self.send_lusers()
+
+    def __mode_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 1:
+            self.reply_461("MODE")
+            return
+        targetname = arguments[0]
+        if server.has_channel(targetname):
+            channel = server.get_channel(targetname)
+            if len(arguments) < 2:
+                modes = "+"
+                if channel.persistent:
+                    modes += "P"
+                if channel.key:
+                    modes += "k"
+                    if channel.lower_name in self.channels:
+                        modes += " %s" % channel.key
+                self.reply("324 %s %s %s"
+                           % (self.nickname, targetname, modes))
                 return
-            targetname = arguments[0]
-            if server.has_channel(targetname):
-                channel = server.get_channel(targetname)
-                if len(arguments) < 2:
-                    if channel.key:
-                        modes = "+k"
-                        if irc_lower(channel.name) in self.channels:
-                            modes += " %s" % channel.key
-                    else:
-                        modes = "+"
-                    self.reply("324 %s %s %s"
-                               % (self.nickname, targetname, modes))
+            flag = arguments[1]
+            if flag == "+k":
+                if len(arguments) < 3:
+                    self.reply_461("MODE")
                     return
-                flag = arguments[1]
-                if flag == "+k":
-                    if len(arguments) < 3:
-                        self.reply_461("MODE")
-                        return
-                    key = arguments[2]
-                    if irc_lower(channel.name) in self.channels:
-                        channel.key = key
-                        self.message_channel(
-                            channel, "MODE", "%s +k %s" % (channel.name, key),
-                            True)
+                key = arguments[2]
+                if channel.lower_name in self.channels:
+                    channel.key = key
+                    if server.network is not None:
+                        server.network.key_changed(self, channel)
+                    self.message_channel(
+                        channel, "MODE", "%s +k %s" % (channel.name, key),
+                        True)
+                    self.channel_log(
+                        channel, "set channel key to %s" % key, meta=True)
+                else:
+                    self.reply("442 %s :You're not on that channel"
+                               % targetname)
+            elif flag == "-k":
+                if channel.lower_name in self.channels:
+                    channel.key = None
+                    if server.network is not None:
+                        server.network.key_changed(self, channel)
+                    self.message_channel(
+                        channel, "MODE", "%s -k" % channel.name,
+                        True)
+                    self.channel_log(
+                        channel, "removed channel key", meta=True)
+                else:
+                    self.reply("442 %s :You're not on that channel"
+                               % targetname)
+            elif flag in ("+P", "-P"):
+                # Persistence is local to this server; it isn't passed
+                # on to server.network.
+                if channel.lower_name in self.channels:
+                    persistent = flag == "+P"
+                    server.set_channel_persistent(channel, persistent)
+                    self.message_channel(
+                        channel, "MODE", "%s %s" % (channel.name, flag),
+                        True)
+                    if persistent:
                         self.channel_log(
-                            channel, "set channel key to %s" % key, meta=True)
+                            channel, "made the channel persistent",
+                            meta=True)
                     else:
-                        self.reply("442 %s :You're not on that channel"
-                                   % targetname)
-                elif flag == "-k":
-                    if irc_lower(channel.name) in self.channels:
-                        channel.key = None
-                        self.message_channel(
-                            channel, "MODE", "%s -k" % channel.name,
-                            True)
                         self.channel_log(
-                            channel, "removed channel key", meta=True)
-                    else:
-                        self.reply("442 %s :You're not on that channel"
-                                   % targetname)
-                else:
-                    self.reply("472 %s %s :Unknown MODE flag"
-                               % (self.nickname, flag))
-            elif targetname == self.nickname:
-                if len(arguments) == 1:
-                    self.reply("221 %s +" % self.nickname)
+                            channel, "made the channel non-persistent",
+                            meta=True)
                 else:
-                    self.reply("501 %s :Unknown MODE flag" % self.nickname)
-            else:
-                self.reply_403(targetname)
-
-        def motd_handler():
-            self.send_motd()
-
-        def nick_handler():
-            if len(arguments) < 1:
-                self.reply("431 :No nickname given")
-                return
-            newnick = arguments[0]
-            client = server.get_client(newnick)
-            if newnick == self.nickname:
-                pass
-            elif client and client is not self:
-                self.reply("433 %s %s :Nickname is already in use"
-                           % (self.nickname, newnick))
-            elif not self.__valid_nickname_regexp.match(newnick):
-                self.reply("432 %s %s :Erroneous Nickname"
-                           % (self.nickname, newnick))
+                    self.reply("442 %s :You're not on that channel"
+                               % targetname)
             else:
-                for x in self.channels.values():
-                    self.channel_log(
-                        x, "changed nickname to %s" % newnick, meta=True)
-                oldnickname = self.nickname
-                self.nickname = newnick
-                server.client_changed_nickname(self, oldnickname)
-                self.message_related(
-                    ":%s!%s@%s NICK %s"
-                    % (oldnickname, self.user, self.host, self.nickname),
-                    True)
-
-        def notice_and_privmsg_handler():
-            if len(arguments) == 0:
-                self.reply("411 %s :No recipient given (%s)"
-                           % (self.nickname, command))
-                return
+                self.reply("472 %s %s :Unknown MODE flag"
+                           % (self.nickname, flag))
+        elif targetname == self.nickname:
             if len(arguments) == 1:
-                self.reply("412 %s :No text to send" % self.nickname)
-                return
-            targetname = arguments[0]
-            message = arguments[1]
-            client = server.get_client(targetname)
-            if client:
-                client.message(":%s %s %s :%s"
-                               % (self.prefix, command, targetname, message))
-            elif server.has_channel(targetname):
-                channel = server.get_channel(targetname)
-                self.message_channel(
-                    channel, command, "%s :%s" % (channel.name, message))
-                self.channel_log(channel, message)
+                self.reply("221 %s +" % self.nickname)
             else:
-                self.reply("401 %s %s :No such nick/channel"
-                           % (self.nickname, targetname))
+                self.reply("501 %s :Unknown MODE flag" % self.nickname)
+        else:
+            self.reply_403(targetname)
 
-        def part_handler():
-            if len(arguments) < 1:
-                self.reply_461("PART")
-                return
-            if len(arguments) > 1:
-                partmsg = arguments[1]
-            else:
-                partmsg = self.nickname
-            for channelname in arguments[0].split(","):
-                if not valid_channel_re.match(channelname):
-                    self.reply_403(channelname)
-                elif not irc_lower(channelname) in self.channels:
-                    self.reply("442 %s %s :You're not on that channel"
-                               % (self.nickname, channelname))
-                else:
-                    channel = self.channels[irc_lower(channelname)]
-                    self.message_channel(
-                        channel, "PART", "%s :%s" % (channelname, partmsg),
-                        True)
-                    self.channel_log(channel, "left (%s)" % partmsg, meta=True)
-                    del self.channels[irc_lower(channelname)]
-                    server.remove_member_from_channel(self, channelname)
+    def __motd_handler(self, message):
+        self.send_motd()
 
-        def ping_handler():
-            if len(arguments) < 1:
-                self.reply("409 %s :No origin specified" % self.nickname)
-                return
-            self.reply("PONG %s :%s" % (server.name, arguments[0]))
+    def __names_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 1:
+            # Listing every channel is not supported.
+            self.reply("366 %s * :End of NAMES list" % self.nickname)
+            return
+        for channelname in arguments[0].split(","):
+            if server.has_channel(channelname):
+                self.send_names(server.get_channel(channelname), channelname)
+            else:
+                self.reply("366 %s %s :End of NAMES list"
+                           % (self.nickname, channelname))
 
-        def pong_handler():
+    def __nick_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 1:
+            self.reply("431 :No nickname given")
+            return
+        newnick = arguments[0]
+        client = server.get_client(newnick)
+        if newnick == self.nickname:
             pass
+        elif client and client is not self:
+            self.reply("433 %s %s :Nickname is already in use"
+                       % (self.nickname, newnick))
+        elif not self.__valid_nickname_regexp.match(newnick):
+            self.reply("432 %s %s :Erroneous Nickname"
+                       % (self.nickname, newnick))
+        else:
+            self.__claim_nickname(newnick, self.__change_nickname)
 
-        def quit_handler():
-            if len(arguments) < 1:
-                quitmsg = self.nickname
-            else:
-                quitmsg = arguments[0]
-            self.disconnect(quitmsg)
+    def __change_nickname(self, newnick, granted):
+        if not granted:
+            self.reply("433 %s %s :Nickname is already in use"
+                       % (self.nickname, newnick))
+            return
+        for x in self.channels.values():
+            self.channel_log(x, "changed nickname to %s" % newnick, meta=True)
+        oldnickname = self.nickname
+        self.nickname = _intern(newnick)
+        self.lower_nickname = _intern(irc_lower(newnick))
+        self.server.client_changed_nickname(self, oldnickname)
+        self.message_related(
+            ":%s!%s@%s NICK %s"
+            % (oldnickname, self.user, self.host, self.nickname),
+            True)
+
+    def __claim_nickname(self, nickname, done):
+        # Have server.network, if any, approve of nickname, then call
+        # done(nickname, granted). If the answer comes later, no more
+        # lines are handled until it has.
+        network = self.server.network
+        if network is None:
+            done(nickname, True)
+            return
+        granted = network.claim_nickname(self, nickname, self.__claimed)
+        if granted is None:
+            self.__claim = (nickname, done)
+            self.__waiting = True
+        else:
+            done(nickname, granted)
+
+    def __claimed(self, granted):
+        # The answer to a claim_nickname() that was pending. Returns
+        # whether the client has taken the nickname.
+        (nickname, done) = self.__claim
+        self.__claim = None
+        if self.__disconnected:
+            return False
+        done(nickname, granted)
+        if self.__disconnected:
+            return False
+        if self.__backlog:
+            self.server.backlog_ready(self)
+        else:
+            self.__waiting = False
+        return granted
 
-        def topic_handler():
-            if len(arguments) < 1:
-                self.reply_461("TOPIC")
-                return
-            channelname = arguments[0]
+    def __notice_and_privmsg_handler(self, message):
+        server = self.server
+        arguments = message.params
+        command = message.command
+        if len(arguments) == 0:
+            self.reply("411 %s :No recipient given (%s)"
+                       % (self.nickname, command))
+            return
+        if len(arguments) == 1:
+            self.reply("412 %s :No text to send" % self.nickname)
+            return
+        targetname = arguments[0]
+        text = arguments[1]
+        client = server.get_client(targetname)
+        if client:
+            client.message(":%s %s %s :%s"
+                           % (self.prefix, command, targetname, text))
+        elif server.has_channel(targetname):
+            channel = server.get_channel(targetname)
+            self.message_channel(
+                channel, command, "%s :%s" % (channel.name, text))
+            self.channel_log(channel, text)
+            if server.network is not None:
+                server.network.channel_message(self, channel, command, text)
+        else:
+            self.reply("401 %s %s :No such nick/channel"
+                       % (self.nickname, targetname))
+
+    def __part_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 1:
+            self.reply_461("PART")
+            return
+        if len(arguments) > 1:
+            partmsg = arguments[1]
+        else:
+            partmsg = self.nickname
+        for channelname in arguments[0].split(","):
             channel = self.channels.get(irc_lower(channelname))
-            if channel:
-                if len(arguments) > 1:
-                    newtopic = arguments[1]
-                    channel.topic = newtopic
-                    self.message_channel(
-                        channel, "TOPIC", "%s :%s" % (channelname, newtopic),
-                        True)
-                    self.channel_log(
-                        channel, "set topic to %r" % newtopic, meta=True)
-                else:
-                    if channel.topic:
-                        self.reply("332 %s %s :%s"
-                                   % (self.nickname, channel.name,
-                                      channel.topic))
-                    else:
-                        self.reply("331 %s %s :No topic is set"
-                                   % (self.nickname, channel.name))
+            if not self.__valid_channelname_regexp.match(channelname):
+                self.reply_403(channelname)
+            elif channel is None:
+                self.reply("442 %s %s :You're not on that channel"
+                           % (self.nickname, channelname))
             else:
-                self.reply("442 %s :You're not on that channel" % channelname)
+                self.message_channel(
+                    channel, "PART", "%s :%s" % (channelname, partmsg),
+                    True)
+                self.channel_log(channel, "left (%s)" % partmsg, meta=True)
+                if server.network is not None:
+                    server.network.parted(self, channel, partmsg)
+                del self.channels[channel.lower_name]
+                channel.remove_client(self)
 
-        def wallops_handler():
-            if len(arguments) < 1:
-                self.reply_461(command)
-            message = arguments[0]
-            for client in server.clients.values():
-                client.message(":%s NOTICE %s :Global notice: %s"
-                               % (self.prefix, client.nickname, message))
+    def __ping_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 1:
+            self.reply("409 %s :No origin specified" % self.nickname)
+            return
+        self.reply("PONG %s :%s" % (server.name, arguments[0]))
 
-        def who_handler():
-            if len(arguments) < 1:
-                return
-            targetname = arguments[0]
-            if server.has_channel(targetname):
-                channel = server.get_channel(targetname)
-                for member in channel.members:
-                    self.reply("352 %s %s %s %s %s %s H :0 %s"
-                               % (self.nickname, targetname, member.user,
-                                  member.host, server.name, member.nickname,
-                                  member.realname))
-                self.reply("315 %s %s :End of WHO list"
-                           % (self.nickname, targetname))
-
-        def whois_handler():
-            if len(arguments) < 1:
-                return
-            username = arguments[0]
-            user = server.get_client(username)
-            if user:
-                self.reply("311 %s %s %s %s * :%s"
-                           % (self.nickname, user.nickname, user.user,
-                              user.host, user.realname))
-                self.reply("312 %s %s %s :%s"
-                           % (self.nickname, user.nickname, server.name,
-                              server.name))
-                self.reply("319 %s %s :%s"
-                           % (self.nickname, user.nickname,
-                              " ".join(user.channels)))
-                self.reply("318 %s %s :End of WHOIS list"
-                           % (self.nickname, user.nickname))
+    def __pong_handler(self, message):
+        pass
+
+    def __quit_handler(self, message):
+        arguments = message.params
+        if len(arguments) < 1:
+            quitmsg = self.nickname
+        else:
+            quitmsg = arguments[0]
+        self.disconnect(quitmsg)
+
+    def __stats_handler(self, message):
+        # miniircd has no IRC operators, so any registered client may ask.
+        server = self.server
+        arguments = message.params
+        query = arguments and arguments[0][:1] or ""
+        if query == "m":
+            # Command usage.
+            histograms = server.command_histograms
+            for command in sorted(histograms):
+                count = histograms[command].count
+                if count:
+                    self.reply("212 %s %s %d"
+                               % (self.nickname, command, count))
+        elif query == "u":
+            uptime = int(time.time() - server.started)
+            self.reply("242 %s :Server Up %d days %d:%02d:%02d"
+                       % (self.nickname, uptime // 86400,
+                          uptime // 3600 % 24, uptime // 60 % 60,
+                          uptime % 60))
+        elif query == "M":
+            # All metrics, one sample per line.
+            for (family, name, labels, value) in server.metrics.samples():
+                self.reply("249 %s :%s"
+                           % (self.nickname,
+                              format_sample(name, labels, value)))
+        self.reply("219 %s %s :End of STATS report"
+                   % (self.nickname, query or "*"))
+
+    def __topic_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 1:
+            self.reply_461("TOPIC")
+            return
+        channelname = arguments[0]
+        channel = self.channels.get(irc_lower(channelname))
+        if channel:
+            if len(arguments) > 1:
+                newtopic = arguments[1]
+                channel.topic = newtopic
+                if server.network is not None:
+                    server.network.topic_changed(self, channel)
+                self.message_channel(
+                    channel, "TOPIC", "%s :%s" % (channelname, newtopic),
+                    True)
+                self.channel_log(
+                    channel, "set topic to %r" % newtopic, meta=True)
             else:
-                self.reply("401 %s %s :No such nick"
-                           % (self.nickname, username))
-
-        handler_table = {
-            "AWAY": away_handler,
-            "ISON": ison_handler,
-            "JOIN": join_handler,
-            "LIST": list_handler,
-            "LUSERS": lusers_handler,
-            "MODE": mode_handler,
-            "MOTD": motd_handler,
-            "NICK": nick_handler,
-            "NOTICE": notice_and_privmsg_handler,
-            "PART": part_handler,
-            "PING": ping_handler,
-            "PONG": pong_handler,
-            "PRIVMSG": notice_and_privmsg_handler,
-            "QUIT": quit_handler,
-            "TOPIC": topic_handler,
-            "WALLOPS": wallops_handler,
-            "WHO": who_handler,
-            "WHOIS": whois_handler,
-        }
+                if channel.topic:
+                    self.reply("332 %s %s :%s"
+                               % (self.nickname, channel.name,
+                                  channel.topic))
+                else:
+                    self.reply("331 %s %s :No topic is set"
+                               % (self.nickname, channel.name))
+        else:
+            self.reply("442 %s :You're not on that channel" % channelname)
+
+    def __wallops_handler(self, message):
         server = self.server
-        valid_channel_re = self.__valid_channelname_regexp
-        try:
-            handler_table[command]()
-        except KeyError:
-            self.reply("421 %s %s :Unknown command" % (self.nickname, command))
+        arguments = message.params
+        if len(arguments) < 1:
+            self.reply_461("WALLOPS")
+            return
+        text = arguments[0]
+        # Each copy is addressed to its recipient, so the line cannot
+        # be shared, but sending is still deferred to the flush phase.
+        for client in server.clients.values():
+            client.message(":%s NOTICE %s :Global notice: %s"
+                           % (self.prefix, client.nickname, text))
+
+    def __who_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 1:
+            return
+        targetname = arguments[0]
+        if server.has_channel(targetname):
+            self.reply_paced(self.__who_replies(
+                server.get_channel(targetname), targetname))
+
+    def __who_replies(self, channel, targetname):
+        nickname = self.nickname
+        servername = self.server.name
+        members = list(channel.members)
+        members.extend(channel.remote_members)
+        for member in members:
+            # Skip members that left while the reply was paced.
+            if channel.lower_name in member.channels:
+                yield ("352 %s %s %s %s %s %s H :0 %s"
+                       % (nickname, targetname, member.user, member.host,
+                          servername, member.nickname, member.realname))
+        yield "315 %s %s :End of WHO list" % (nickname, targetname)
+
+    def __whois_handler(self, message):
+        server = self.server
+        arguments = message.params
+        if len(arguments) < 1:
+            return
+        username = arguments[0]
+        user = server.get_client(username)
+        if user:
+            self.reply("311 %s %s %s %s * :%s"
+                       % (self.nickname, user.nickname, user.user,
+                          user.host, user.realname))
+            self.reply("312 %s %s %s :%s"
+                       % (self.nickname, user.nickname, server.name,
+                          server.name))
+            self.reply("319 %s %s :%s"
+                       % (self.nickname, user.nickname,
+                          " ".join(user.channels)))
+            self.reply("318 %s %s :End of WHOIS list"
+                       % (self.nickname, user.nickname))
+        else:
+            self.reply("401 %s %s :No such nick"
+                       % (self.nickname, username))
+
+    # Command name --> handler for registered clients. The values are
+    # plain functions, called with the client and the Message.
+    _command_handlers = {
+        "AWAY": __away_handler,
+        "CHATHISTORY": __chathistory_handler,
+        "ISON": __ison_handler,
+        "JOIN": __join_handler,
+        "LIST": __list_handler,
+        "LUSERS": __lusers_handler,
+        "MODE": __mode_handler,
+        "MOTD": __motd_handler,
+        "NAMES": __names_handler,
+        "NICK": __nick_handler,
+        "NOTICE": __notice_and_privmsg_handler,
+        "PART": __part_handler,
+        "PING": __ping_handler,
+        "PONG": __pong_handler,
+        "PRIVMSG": __notice_and_privmsg_handler,
+        "QUIT": __quit_handler,
+        "STATS": __stats_handler,
+        "TOPIC": __topic_handler,
+        "WALLOPS": __wallops_handler,
+        "WHO": __who_handler,
+        "WHOIS": __whois_handler,
+    }
+
+    # Handler of incoming messages, indexed by registration state.
+    __state_handlers = (
+        __pass_handler, __registration_handler, __command_handler)
+
+    def get_state(self):
+        """Return what set_state needs to resume the client elsewhere.
+
+        Paced replies are queued in full first. See Server.get_state.
+        """
+        while self.__replies is not None:
+            self.__continue_replies()
+        queue = self.__writequeue or ()
+        return {
+            "nickname": self.nickname,
+            "user": self.user,
+            "realname": self.realname,
+            "registration": self.__state,
+            "channels": [x.name for x in self.channels.values()],
+            "pending": self.__linebuffer.get_pending(),
+            "backlog": list(self.__backlog or ()),
+            "output": b"".join(queue)[self.__writeoffset:],
+            "timestamp": self.__timestamp,
+            "sent_ping": self.__sent_ping,
+            "tokens": self.__tokens,
+            "paused": self.__paused,
+            "skipped": self.__skipped,
+        }
+
+    def set_state(self, state):
+        """Resume from a get_state() result, except for channels.
+
+        Call right after creating the client; Server.set_state adds it
+        to its channels.
+        """
+        self.nickname = state["nickname"]
+        if self.nickname is not None:
+            self.lower_nickname = _intern(irc_lower(self.nickname))
+        self.user = state["user"]
+        self.realname = state["realname"]
+        self.__state = state["registration"]
+        self.__linebuffer.set_pending(state["pending"])
+        if state["backlog"]:
+            self.__backlog = deque(state["backlog"])
+            self.__waiting = True
+            self.server.backlog_ready(self)
+        if state["output"]:
+            self.__append(state["output"])
+            self.__update_write_interest()
+        self.__timestamp = state["timestamp"]
+        self.__sent_ping = state["sent_ping"]
+        self.__tokens = state["tokens"]
+        self.__paused = state["paused"]
+        self.__skipped = state["skipped"]
+
+    def detach(self):
+        """Stop serving the client without telling it.
+
+        For after it has been handed over to another process, which
+        holds its own copy of the socket.
+        """
+        if self.__disconnected:
+            return
+        self.__disconnected = True
+        self.__replies = None
+        if self.__writequeue and self.server.global_sendq_limit is not None:
+            for chunk in self.__writequeue:
+                self.server.chunk_dequeued(chunk)
+        self.__writequeue = None
+        self.__backlog = None
+        self.server.poller.unregister(self.__fileno, self)
+        self.__aliveness_timer.cancel()
+        self.socket.close()
 
     def socket_readable_notification(self):
+        server = self.server
+        buf = server.read_buffer
         try:
-            data = self.socket.recv(2 ** 10)
-            self.server.print_debug(
-                "[%s:%d] -> %r" % (self.host, self.port, data))
+            length = self.socket.recv_into(buf)
             quitmsg = "EOT"
         except socket.error as x:
-            data = ""
+            if x.args[0] in _WOULD_BLOCK:
+                return
+            length = 0
             quitmsg = x
-        if data:
-            self.__readbuffer += data
-            self.__parse_read_buffer()
+        if length:
+            server.received_bytes.value += length
+            if server.debug:
+                server.print_debug(
+                    "[%s:%d] -> %r" % (self.host, self.port,
+                                       bytes(buf[:length])))
+            lines = self.__linebuffer.feed(buf, length)
+            if lines:
+                if self.__backlog is None:
+                    self.__backlog = deque(lines)
+                else:
+                    self.__backlog.extend(lines)
+                if not self.__waiting:
+                    self.handle_backlog()
             self.__timestamp = time.time()
             self.__sent_ping = False
         else:
             self.disconnect(quitmsg)
 
     def socket_writable_notification(self):
-	if self.__writebuffer == '':
-	    self.ready_to_write = True
-	    return
-	self.ready_to_write = False
-        try:
-            sent = self.socket.send(self.__writebuffer)
+        self.flush()
+
+    def __send_queued(self):
+        # Return (bytes sent, bytes offered to the socket).
+        queue = self.__writequeue
+        offset = self.__writeoffset
+        if _have_sendmsg:
+            buffers = list(itertools.islice(queue, _SENDMSG_MAX_BUFFERS))
+            if offset:
+                buffers[0] = memoryview(buffers[0])[offset:]
+            attempted = sum(len(x) for x in buffers)
+            return (self.socket.sendmsg(buffers), attempted)
+        first = queue[0]
+        if offset or len(queue) == 1 or len(first) >= _SEND_BATCH_SIZE:
+            return (self.socket.send(memoryview(first)[offset:]),
+                    len(first) - offset)
+        pieces = []
+        attempted = 0
+        for chunk in queue:
+            pieces.append(chunk)
+            attempted += len(chunk)
+            if attempted >= _SEND_BATCH_SIZE:
+                break
+        return (self.socket.send("".join(pieces)), attempted)
+
+    def __consume(self, sent):
+        queue = self.__writequeue
+        offset = self.__writeoffset
+        if self.server.debug:
             self.server.print_debug(
                 "[%s:%d] <- %r" % (
-                    self.host, self.port, self.__writebuffer[:sent]))
-            self.__writebuffer = self.__writebuffer[sent:]
-	    if self.__writebuffer == '':
-		self.ready_to_write = True
+                    self.host, self.port,
+                    "".join(queue)[offset:offset + sent]))
+        self.__writequeue_size -= sent
+        self.server.sent_bytes.value += sent
+        offset += sent
+        if self.server.global_sendq_limit is None:
+            while queue and offset >= len(queue[0]):
+                offset -= len(queue.popleft())
+        else:
+            while queue and offset >= len(queue[0]):
+                chunk = queue.popleft()
+                offset -= len(chunk)
+                self.server.chunk_dequeued(chunk)
+        self.__writeoffset = offset
+        if not queue:
+            self.__writequeue = None
+
+    def __send_some(self):
+        while self.__writequeue:
+            (sent, attempted) = self.__send_queued()
+            self.__consume(sent)
+            if sent < attempted:
+                break
+
+    def flush(self):
+        """Send as much queued data as the socket accepts without blocking.
+
+        Whatever is left is sent when the poller reports the socket as
+        writable.
+        """
+        if self.__disconnected:
+            return
+        try:
+            self.__send_some()
+            if self.__replies is not None \
+                    and self.__writequeue_size < _PACED_QUEUE_SIZE:
+                self.__continue_replies()
+                self.__send_some()
         except socket.error as x:
-            self.disconnect(x)
+            if x.args[0] not in _WOULD_BLOCK:
+                self.disconnect(x)
+                return
+        if self.__paused and not self.__closing \
+                and self.__writequeue_size <= self.server.sendq_limit // 2:
+            self.__resume()
+        self.__update_write_interest()
 
     def disconnect(self, quitmsg):
-        self.message("ERROR :%s" % quitmsg)
+        if self.__disconnected:
+            return
+        self.__disconnected = True
+        self.__replies = None
+        self.__append("ERROR :%s\r\n" % quitmsg)
+        try:
+            self.__send_some()
+        except socket.error:
+            pass
+        if self.__writequeue and self.server.global_sendq_limit is not None:
+            for chunk in self.__writequeue:
+                self.server.chunk_dequeued(chunk)
+        self.__writequeue = None
         self.server.print_info(
             "Disconnected connection from %s:%s (%s)." % (
                 self.host, self.port, quitmsg))
+        self.server.poller.unregister(self.__fileno, self)
+        self.__aliveness_timer.cancel()
         self.socket.close()
         self.server.remove_client(self, quitmsg)
 
     def message(self, msg):
-        self.__writebuffer += msg + "\r\n"
-	if self.ready_to_write:
-		self.socket_writable_notification()
+        self.enqueue(msg + "\r\n")
+
+    def reply_paced(self, replies):
+        """Send replies, an iterable of reply lines, as the client reads.
+
+        Lines are taken from replies only while the send queue is short,
+        so a long reply neither holds up the event loop nor fills the
+        queue at once. Replies to later commands may overtake them.
+        """
+        if self.__replies is None:
+            self.__replies = iter(replies)
+        else:
+            self.__replies = itertools.chain(self.__replies, replies)
+        if self.__continue_replies():
+            self.server.schedule_flush(self)
+
+    def __continue_replies(self):
+        # Queue reply lines until the send queue holds _PACED_QUEUE_SIZE
+        # bytes. Returns whether the queue was empty before.
+        budget = _PACED_QUEUE_SIZE - self.__writequeue_size
+        prefix = ":%s " % self.server.name
+        pieces = []
+        for line in self.__replies:
+            data = prefix + line + "\r\n"
+            pieces.append(data)
+            budget -= len(data)
+            if budget <= 0:
+                break
+        else:
+            self.__replies = None
+        return bool(pieces) and self.__append("".join(pieces))
+
+    def __append(self, data):
+        if self.server.global_sendq_limit is not None:
+            self.server.chunk_queued(data)
+        if self.__writequeue is None:
+            self.__writequeue = deque([data])
+            self.__writequeue_size = len(data)
+            return True
+        self.__writequeue.append(data)
+        self.__writequeue_size += len(data)
+        return False
+
+    def enqueue(self, data, low_priority=False):
+        """Queue CRLF-terminated wire data for sending.
+
+        The string is queued by reference, so the same data can be queued
+        for many clients without being copied. Sending happens in the
+        server's flush phase.
+
+        If the client's send queue is over Server.sendq_limit, or the
+        server's over Server.global_sendq_limit while this client has
+        data waiting, Server.sendq_policy decides what happens:
+        "disconnect" drops the client, "drop" discards low_priority data
+        (channel chatter) and "pause" discards everything until the
+        queue has drained to half the limit.
+        """
+        if self.__disconnected:
+            return
+        if self.__paused:
+            self.__skipped += data.count("\n")
+            return
+        server = self.server
+        if (server.sendq_limit is not None
+                and self.__writequeue_size + len(data) > server.sendq_limit
+                or server.global_sendq_limit is not None
+                and server.queued_bytes + len(data)
+                > server.global_sendq_limit
+                and self.__writequeue_size):
+            if not self.__sendq_exceeded(data, low_priority):
+                return
+        if self.__append(data):
+            # Nothing is waiting for the socket to become writable.
+            server.schedule_flush(self)
+
+    def __sendq_exceeded(self, data, low_priority):
+        # Apply the send queue policy. Returns whether to queue data
+        # anyway.
+        server = self.server
+        policy = server.sendq_policy
+        if policy == "drop":
+            if low_priority:
+                server.sendq_actions.labels("drop").value += 1
+                return False
+            # Data that should not be lost is allowed up to twice the
+            # limit before giving up on the client.
+            if self.__writequeue_size < 2 * server.sendq_limit:
+                return True
+        elif policy == "pause":
+            server.sendq_actions.labels("pause").value += 1
+            self.__paused = True
+            self.__skipped = data.count("\n")
+            return False
+        server.sendq_actions.labels("disconnect").value += 1
+        # Disconnecting removes the client from channels, which may be
+        # what is being broadcast to right now, so do it a bit later.
+        # Until then, nothing more is queued.
+        self.__paused = True
+        self.__closing = True
+        server.scheduler.call_at(0, self.disconnect, "SendQ exceeded")
+        return False
+
+    def __resume(self):
+        self.__paused = False
+        skipped = self.__skipped
+        self.__skipped = 0
+        self.reply("NOTICE %s :%d lines were not delivered because of"
+                   " a slow connection" % (self.nickname or "*", skipped))
 
     def reply(self, msg):
         self.message(":%s %s" % (self.server.name, msg))
@@ -558,23 +1842,47 @@ class Client(object):
 
     def message_channel(self, channel, command, message, include_self=False):
         line = ":%s %s %s" % (self.prefix, command, message)
-        for client in channel.members:
-            if client != self or include_self:
-                client.message(line)
+        # Chatter may be dropped for slow clients; membership and mode
+        # changes may not.
+        low_priority = command in ("PRIVMSG", "NOTICE")
+        if include_self:
+            channel.broadcast(line, low_priority=low_priority)
+        else:
+            channel.broadcast(line, exclude=self, low_priority=low_priority)
 
     def channel_log(self, channel, message, meta=False):
-	pass
+        server = self.server
+        if meta:
+            server.log_channel(channel, server.name, "NOTICE",
+                               "* %s %s" % (self.nickname, message))
+        else:
+            server.log_channel(channel, self.prefix, "PRIVMSG", message)
+
+    def __history(self, channel, after, before, limit, latest=True):
+        history = self.server.get_history(channel)
+        if history is None:
+            return []
+        try:
+            return history.select(after, before, limit, latest)
+        except EnvironmentError as e:
+            self.server.print_error("Could not read history of %s: %s"
+                                    % (channel.name, e))
+            return []
 
     def message_related(self, msg, include_self=False):
-        clients = set()
         if include_self:
-            clients.add(self)
-        for channel in self.channels.values():
-            clients |= channel.members
-        if not include_self:
-            clients.discard(self)
-        for client in clients:
-            client.message(msg)
+            self.server.broadcast_channels(
+                self.channels.values(), msg, include=self)
+        else:
+            self.server.broadcast_channels(
+                self.channels.values(), msg, exclude=self)
+
+    def send_names(self, channel, channelname):
+        for names in channel.get_names():
+            self.reply("353 %s = %s :%s"
+                       % (self.nickname, channelname, names))
+        self.reply("366 %s %s :End of NAMES list"
+                   % (self.nickname, channelname))
 
     def send_lusers(self):
         self.reply("251 %s :There are %d users and 0 services on 1 server"
@@ -593,13 +1901,637 @@ class Client(object):
             self.reply("422 %s :MOTD File is missing" % self.nickname)
 
 
+class RemoteClient(object):
+    """A user connected to another server, reached through link.
+
+    Remote users are in Server.nicknames, so they are found, messaged
+    and WHOISed like local clients, and in the remote_members of their
+    channels. Nothing is queued for them here: private messages are
+    handed to link, and the other server sends channel lines to its own
+    clients. The methods below apply what the user did over there and
+    show it to local clients.
+    """
+
+    __slots__ = ("server", "link", "nickname", "lower_nickname", "user",
+                 "host", "realname", "channels", "broadcast_epoch")
+
+    def __init__(self, server, link, nickname, user, host, realname):
+        self.server = server
+        self.link = link
+        self.nickname = _intern(nickname)
+        self.lower_nickname = _intern(irc_lower(nickname))
+        self.user = _intern(user)
+        self.host = _intern(host)
+        self.realname = realname
+        self.channels = {}  # irc_lower(Channel name) --> Channel
+        self.broadcast_epoch = 0
+
+    def get_prefix(self):
+        return "%s!%s@%s" % (self.nickname, self.user, self.host)
+    prefix = property(get_prefix)
+
+    def message(self, msg):
+        self.link.private_message(self, msg)
+
+    def channel_log(self, channel, message, meta=False):
+        server = self.server
+        if meta:
+            server.log_channel(channel, server.name, "NOTICE",
+                               "* %s %s" % (self.nickname, message))
+        else:
+            server.log_channel(channel, self.prefix, "PRIVMSG", message)
+
+    def join(self, channel):
+        channel.add_member(self)
+        self.channels[channel.lower_name] = channel
+        channel.broadcast(":%s JOIN %s" % (self.prefix, channel.name))
+        self.channel_log(channel, "joined", meta=True)
+
+    def part(self, channel, partmsg):
+        channel.broadcast(
+            ":%s PART %s :%s" % (self.prefix, channel.name, partmsg))
+        self.channel_log(channel, "left (%s)" % partmsg, meta=True)
+        del self.channels[channel.lower_name]
+        channel.remove_client(self)
+
+    def change_nickname(self, newnickname):
+        for x in self.channels.values():
+            self.channel_log(
+                x, "changed nickname to %s" % newnickname, meta=True)
+        oldprefix = self.prefix
+        oldnickname = self.nickname
+        self.nickname = _intern(newnickname)
+        self.lower_nickname = _intern(irc_lower(newnickname))
+        self.server.client_changed_nickname(self, oldnickname)
+        self.server.broadcast_channels(
+            self.channels.values(), ":%s NICK %s" % (oldprefix, newnickname))
+
+    def set_topic(self, channel, topic):
+        channel.topic = topic
+        channel.broadcast(
+            ":%s TOPIC %s :%s" % (self.prefix, channel.name, topic))
+        self.channel_log(channel, "set topic to %r" % topic, meta=True)
+
+    def set_key(self, channel, key):
+        channel.key = key
+        if key is None:
+            channel.broadcast(":%s MODE %s -k" % (self.prefix, channel.name))
+            self.channel_log(channel, "removed channel key", meta=True)
+        else:
+            channel.broadcast(
+                ":%s MODE %s +k %s" % (self.prefix, channel.name, key))
+            self.channel_log(
+                channel, "set channel key to %s" % key, meta=True)
+
+    def message_channel(self, channel, command, text):
+        channel.broadcast(
+            ":%s %s %s :%s" % (self.prefix, command, channel.name, text),
+            low_priority=True)
+        self.channel_log(channel, text)
+
+
+class Timer(object):
+    """Handle for a callback scheduled with Scheduler."""
+
+    __slots__ = ("scheduler", "when", "callback", "args", "cancelled")
+
+    def __init__(self, scheduler, when, callback, args):
+        self.scheduler = scheduler
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.scheduler._timer_cancelled()
+
+
+class Scheduler(object):
+    """Heap of timed callbacks run by the server's event loop.
+
+    Cancelled timers are left in the heap and skipped when they reach the
+    top; the heap is rebuilt once they make up more than half of it.
+    """
+
+    def __init__(self):
+        self._heap = []  # (when, sequence number, Timer)
+        self._sequence = itertools.count()
+        self._cancelled = 0
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(self, when, callback, args)
+        heapq.heappush(self._heap, (when, next(self._sequence), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def _timer_cancelled(self):
+        self._cancelled += 1
+        if self._cancelled > 64 and self._cancelled > len(self._heap) // 2:
+            self._heap = [x for x in self._heap if not x[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def _pop(self):
+        (when, sequence, timer) = heapq.heappop(self._heap)
+        if timer.cancelled:
+            self._cancelled -= 1
+        return timer
+
+    def next_deadline(self):
+        heap = self._heap
+        while heap and heap[0][2].cancelled:
+            self._pop()
+        if heap:
+            return heap[0][0]
+        else:
+            return None
+
+    def timeout(self, now):
+        """Return seconds until the next timer is due, or None if idle."""
+        deadline = self.next_deadline()
+        if deadline is None:
+            return None
+        return max(0, deadline - now)
+
+    def run_due(self, now):
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            timer = self._pop()
+            if not timer.cancelled:
+                # Mark as done so that a late cancel() is a no-op.
+                timer.cancelled = True
+                timer.callback(*timer.args)
+
+
+class _Poller(object):
+    """Persistent readiness registry.
+
+    File descriptors are registered once together with a handler object
+    that has socket_readable_notification and socket_writable_notification
+    methods. Interest in writability is toggled explicitly with
+    set_writable, so that poll() costs O(ready sockets) rather than
+    O(registered sockets). Interest in readability is on from register
+    until turned off with set_readable.
+    """
+
+    def __init__(self):
+        self._handlers = {}  # File descriptor --> handler.
+        self._writable = set()  # File descriptors to poll for writing.
+        self._unreadable = set()  # File descriptors not to poll for reading.
+
+    def owns(self, fd, handler):
+        return self._handlers.get(fd) is handler
+
+    def set_writable(self, fd, handler, writable):
+        if self.owns(fd, handler):
+            if writable:
+                self._writable.add(fd)
+            else:
+                self._writable.discard(fd)
+            self._modify(fd, handler)
+
+    def set_readable(self, fd, handler, readable):
+        if self.owns(fd, handler):
+            if readable:
+                self._unreadable.discard(fd)
+            else:
+                self._unreadable.add(fd)
+            self._modify(fd, handler)
+
+    def _forget(self, fd):
+        del self._handlers[fd]
+        self._writable.discard(fd)
+        self._unreadable.discard(fd)
+
+    def __len__(self):
+        return len(self._handlers)
+
+
+class _EpollPoller(_Poller):
+    def __init__(self):
+        _Poller.__init__(self)
+        self._epoll = select.epoll()
+        self._error_mask = select.EPOLLERR | select.EPOLLHUP
+
+    def register(self, fd, handler, writable=False):
+        self._handlers[fd] = handler
+        mask = select.EPOLLIN
+        if writable:
+            self._writable.add(fd)
+            mask |= select.EPOLLOUT
+        self._epoll.register(fd, mask)
+
+    def _modify(self, fd, handler):
+        mask = 0
+        if fd not in self._unreadable:
+            mask |= select.EPOLLIN
+        if fd in self._writable:
+            mask |= select.EPOLLOUT
+        self._epoll.modify(fd, mask)
+
+    def unregister(self, fd, handler):
+        if self.owns(fd, handler):
+            self._forget(fd)
+            try:
+                self._epoll.unregister(fd)
+            except (IOError, OSError):
+                # Already closed.
+                pass
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self._epoll.poll(timeout)
+        except (IOError, OSError) as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+        handlers = self._handlers
+        error_mask = self._error_mask
+        return [(fd,
+                 handlers.get(fd),
+                 mask & (select.EPOLLIN | error_mask),
+                 mask & (select.EPOLLOUT | error_mask))
+                for (fd, mask) in events]
+
+
+class _SelectorsPoller(_Poller):
+    def __init__(self):
+        _Poller.__init__(self)
+        self._selector = selectors.DefaultSelector()
+
+    def register(self, fd, handler, writable=False):
+        self._handlers[fd] = handler
+        mask = selectors.EVENT_READ
+        if writable:
+            self._writable.add(fd)
+            mask |= selectors.EVENT_WRITE
+        self._selector.register(fd, mask, handler)
+
+    def _modify(self, fd, handler):
+        mask = 0
+        if fd not in self._unreadable:
+            mask |= selectors.EVENT_READ
+        if fd in self._writable:
+            mask |= selectors.EVENT_WRITE
+        # Selectors don't take an empty mask.
+        if fd in self._selector.get_map():
+            if mask:
+                self._selector.modify(fd, mask, handler)
+            else:
+                self._selector.unregister(fd)
+        elif mask:
+            self._selector.register(fd, mask, handler)
+
+    def unregister(self, fd, handler):
+        if self.owns(fd, handler):
+            self._forget(fd)
+            if fd in self._selector.get_map():
+                self._selector.unregister(fd)
+
+    def poll(self, timeout):
+        return [(key.fd,
+                 key.data,
+                 mask & selectors.EVENT_READ,
+                 mask & selectors.EVENT_WRITE)
+                for (key, mask) in self._selector.select(timeout)]
+
+
+class _SelectPoller(_Poller):
+    # Last resort for platforms with neither epoll nor the selectors
+    # module. Still subject to FD_SETSIZE.
+
+    def register(self, fd, handler, writable=False):
+        self._handlers[fd] = handler
+        if writable:
+            self._writable.add(fd)
+
+    def _modify(self, fd, handler):
+        pass
+
+    def unregister(self, fd, handler):
+        if self.owns(fd, handler):
+            self._forget(fd)
+
+    def poll(self, timeout):
+        if self._unreadable:
+            readable = [fd for fd in self._handlers
+                        if fd not in self._unreadable]
+        else:
+            readable = list(self._handlers)
+        try:
+            (iwtd, owtd, ewtd) = select.select(
+                readable, list(self._writable), [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        handlers = self._handlers
+        owtd = set(owtd)
+        events = [(fd, handlers.get(fd), True, fd in owtd) for fd in iwtd]
+        owtd.difference_update(iwtd)
+        events.extend((fd, handlers.get(fd), False, True) for fd in owtd)
+        return events
+
+
+def make_poller():
+    """Return the best readiness backend available on this platform."""
+    if hasattr(select, "epoll"):
+        return _EpollPoller()
+    if selectors is not None:
+        return _SelectorsPoller()
+    return _SelectPoller()
+
+
+class _Listener(object):
+    # Connections accepted per readiness notification, so that a burst of
+    # reconnects does not overflow the listen backlog.
+    accepts_per_event = 64
+
+    def __init__(self, server, socket):
+        self.server = server
+        self.socket = socket
+
+    def socket_readable_notification(self):
+        for _ in range(self.accepts_per_event):
+            try:
+                (conn, addr) = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] not in _WOULD_BLOCK:
+                    self.server.print_error(
+                        "Could not accept connection: %s." % e)
+                return
+            self.server.add_client(conn)
+
+    def socket_writable_notification(self):
+        pass
+
+
+class _Waker(object):
+    """Self-pipe that lets other threads wake up the event loop."""
+
+    def __init__(self, server):
+        self.server = server
+        (self.read_fd, self.write_fd) = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            set_nonblocking(fd)
+
+    def wake(self):
+        try:
+            os.write(self.write_fd, b"x")
+        except OSError as e:
+            # A full pipe will wake the loop anyway.
+            if e.errno not in _WOULD_BLOCK:
+                raise
+
+    def socket_readable_notification(self):
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in _WOULD_BLOCK:
+                raise
+        self.server.run_injected()
+
+    def socket_writable_notification(self):
+        pass
+
+
+class Counter(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Histogram(object):
+    """Counts of observed values per bucket, plus their sum.
+
+    bounds are the inclusive upper bounds of the buckets; values above
+    the last bound go into an extra, unbounded bucket.
+    """
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[_bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+
+class MetricFamily(object):
+    """A named metric, with one value per combination of label values.
+
+    Values are Counters or Histograms created by labels(), or, if the
+    family was given a function, whatever that function returns when
+    the family is collected: a dict mapping label value tuples to
+    numbers or Histograms.
+    """
+
+    def __init__(self, kind, name, help, labelnames, bounds, function):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.bounds = bounds
+        self.function = function
+        self.children = {}  # Label value tuple --> Counter or Histogram
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if self.kind == "histogram":
+                child = Histogram(self.bounds)
+            else:
+                child = Counter()
+            self.children[values] = child
+        return child
+
+    def collect(self):
+        if self.function is None:
+            return self.children
+        return self.function()
+
+
+class Metrics(object):
+    """Registry of server metrics.
+
+    Recording is meant to stay on under full load: the hot paths keep
+    references to Counter and Histogram objects and update them
+    directly. Gauges and other derived values are only computed by
+    their functions when the metrics are collected. Not thread-safe;
+    use the registry from the event loop.
+    """
+
+    def __init__(self):
+        self.families = []
+
+    def __add(self, kind, name, help, labelnames=(), bounds=None,
+              function=None):
+        family = MetricFamily(kind, name, help, labelnames, bounds, function)
+        self.families.append(family)
+        if labelnames or function:
+            return family
+        return family.labels()
+
+    def counter(self, name, help, labelnames=(), function=None):
+        """Register a counter.
+
+        Returns the Counter for an unlabelled counter without a function,
+        otherwise the MetricFamily.
+        """
+        return self.__add("counter", name, help, labelnames, None, function)
+
+    def gauge(self, name, help, function, labelnames=()):
+        return self.__add("gauge", name, help, labelnames, None, function)
+
+    def histogram(self, name, help, bounds, labelnames=(), function=None):
+        """Register a histogram; see counter() for the return value."""
+        return self.__add(
+            "histogram", name, help, labelnames, bounds, function)
+
+    def samples(self):
+        """Yield (family, sample name, labels, value) for every value.
+
+        labels is a list of (name, value) pairs.
+        """
+        for family in self.families:
+            children = family.collect()
+            for values in sorted(children):
+                child = children[values]
+                labels = list(zip(family.labelnames, values))
+                if isinstance(child, Histogram):
+                    cumulative = 0
+                    bounds = list(child.bounds) + ["+Inf"]
+                    for (bound, count) in zip(bounds, child.counts):
+                        cumulative += count
+                        yield (family, family.name + "_bucket",
+                               labels + [("le", str(bound))], cumulative)
+                    yield (family, family.name + "_sum", labels, child.sum)
+                    yield (family, family.name + "_count", labels,
+                           child.count)
+                elif isinstance(child, Counter):
+                    yield (family, family.name, labels, child.value)
+                else:
+                    yield (family, family.name, labels, child)
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        family = None
+        for (sample_family, name, labels, value) in self.samples():
+            if sample_family is not family:
+                family = sample_family
+                lines.append("# HELP %s %s" % (family.name, family.help))
+                lines.append("# TYPE %s %s" % (family.name, family.kind))
+            lines.append(format_sample(name, labels, value))
+        return "".join(line + "\n" for line in lines)
+
+
+def format_sample(name, labels, value):
+    if labels:
+        name += "{%s}" % ",".join(
+            '%s="%s"' % (k, str(v).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+            for (k, v) in labels)
+    return "%s %s" % (name, repr(value) if isinstance(value, float)
+                      else value)
+
+
+# Bucket bounds, in seconds, for latencies of work done in the event loop.
+LATENCY_BOUNDS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SIZE_BOUNDS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+               10000)
+BYTES_BOUNDS = (0, 512, 1024, 4096, 16384, 65536, 262144, 1048576,
+                4194304, 16777216)
+
+
 class Server(object):
-    def __init__(self, listen_host="", ports=(8001,), password=None, motd=(), verbose=True, debug=False):
+    def __init__(self, listen_host="", ports=(8001,), password=None, motd=(),
+                 verbose=True, debug=False, read_size=2 ** 14,
+                 sendq_limit=None, global_sendq_limit=None,
+                 sendq_policy="disconnect", history_dir=None,
+                 history_on_join=0, reuse_port=False, flood_rate=None,
+                 flood_burst=10, flood_exempt=(), state_dir=None):
+        if sendq_policy not in ("disconnect", "drop", "pause"):
+            raise ValueError(
+                "sendq_policy must be 'disconnect', 'drop' or 'pause'")
+        if sendq_policy in ("drop", "pause") and sendq_limit is None:
+            raise ValueError(
+                "sendq_policy=%r requires sendq_limit" % sendq_policy)
         self.ports = ports
+        # Let other processes listen on the same ports (SO_REUSEPORT),
+        # for the kernel to spread connections over; see cluster.py.
+        self.reuse_port = reuse_port
         self.password = password
         self.motd = motd
         self.verbose = verbose
         self.debug = debug
+        # Receive buffer shared by all clients; see LineBuffer.
+        self.read_buffer = bytearray(read_size)
+        # Send queue high-water marks in bytes; see Client.enqueue.
+        self.sendq_limit = sendq_limit
+        self.global_sendq_limit = global_sendq_limit
+        self.sendq_policy = sendq_policy
+        # Bytes in all send queues, counting shared chunks once. Only
+        # kept up to date when global_sendq_limit is set.
+        self.queued_bytes = 0
+        self.__chunk_references = {}  # id(chunk) --> [references, size]
+        # Channel history; see log_channel. Lines are kept on disk only
+        # if history_dir is set. history_on_join lines are replayed to
+        # joining clients, and CHATHISTORY returns at most
+        # history_replay_limit lines.
+        self.history_dir = history_dir
+        self.history_on_join = history_on_join
+        self.history_length = 100
+        self.history_segment_size = 2 ** 20
+        self.history_segments = 16
+        self.history_replay_limit = 500
+        self.history_flush_interval = 1.0
+        self.__unflushed_logs = []
+        self.__history_timer = None
+        self.__history_second = None
+        self.__history_stamp = None
+        # Fair scheduling and flood control; see Client.handle_backlog.
+        # flood_rate is in tokens per second, None for no limit, and
+        # flood_exempt holds addresses of trusted hosts, e.g. bridges.
+        self.lines_per_iteration = 16
+        self.backlog_limit = 256
+        self.flood_rate = flood_rate
+        self.flood_burst = flood_burst
+        self.flood_exempt = frozenset(flood_exempt)
+        self.command_costs = {
+            "CHATHISTORY": 3, "JOIN": 2, "LIST": 5, "NAMES": 2, "WHO": 3,
+            "WHOIS": 2}
+        self.__backlogged = []  # Clients with lines for the next iteration.
+        # Persistent channels are kept in state_dir if set; see
+        # ChannelStore. The snapshot is rewritten when the journal has
+        # grown larger than it, checked every state_compact_interval
+        # seconds.
+        self.state_dir = state_dir
+        self.state_compact_interval = 60.0
+        self.channel_store = None
 
         if listen_host:
             self.address = socket.gethostbyname(listen_host)
@@ -609,8 +2541,95 @@ class Server(object):
         self.name = socket.getfqdn(self.address)[:server_name_limit]
 
         self.channels = {}  # irc_lower(Channel name) --> Channel instance.
+        self.channel_index = []  # Sorted keys of channels.
         self.clients = {}  # Socket --> Client instance.
-        self.nicknames = {}  # irc_lower(Nickname) --> Client instance.
+        self.nicknames = {}  # irc_lower(Nickname) --> (Remote)Client.
+        # Replicates local changes to other servers, which it applies
+        # here through RemoteClients; see cluster.WorkerBus. Its
+        # claim_nickname(client, nickname, callback) may veto a
+        # nickname: it returns whether the client may have it, or None
+        # and later calls callback(granted), which returns whether the
+        # client took it.
+        self.network = None
+        self.poller = make_poller()
+        self.scheduler = Scheduler()
+        self.__flush_pending = []  # Clients with newly queued data.
+        self.__deferring_flush = False
+        self.__quitting = []  # (client, quitmsg) for remove_clients.
+        self.__listeners = []
+        self.__listening = False  # Whether listen() has been done.
+        self.__stopping = False  # See stop().
+        self.__epoch = 0  # Last stamp used by broadcast_channels.
+
+        # Work handed to the event loop by other threads; see inject().
+        self.max_injected = 10000
+        self.inject_batch_size = 256
+        self.__injected = deque()  # (callback, arguments)
+        self.__inject_lock = threading.Lock()
+        self.__wakeup_pending = False
+        self.__waker = _Waker(self)
+
+        if state_dir:
+            self.__load_channels()
+
+        self.started = time.time()
+        self.metrics = Metrics()
+        metrics = self.metrics
+        metrics.gauge("irc_clients", "Connected clients.",
+                      lambda: {(): len(self.clients)})
+        metrics.gauge("irc_channels", "Existing channels.",
+                      lambda: {(): len(self.channels)})
+        self.received_bytes = metrics.counter(
+            "irc_received_bytes_total", "Bytes received from clients.")
+        self.sent_bytes = metrics.counter(
+            "irc_sent_bytes_total", "Bytes sent to clients.")
+        self.command_seconds = metrics.histogram(
+            "irc_command_seconds",
+            "Time spent handling commands from registered clients.",
+            LATENCY_BOUNDS, ("command",))
+        self.command_histograms = dict(
+            (command, self.command_seconds.labels(command))
+            for command in Client._command_handlers)
+        self.unknown_commands = metrics.counter(
+            "irc_unknown_commands_total", "Unknown commands received.")
+        self.broadcast_recipients = metrics.histogram(
+            "irc_broadcast_recipients",
+            "Recipients of lines sent to channels and related clients.",
+            SIZE_BOUNDS)
+        self.sendq_actions = metrics.counter(
+            "irc_sendq_actions_total",
+            "Send queue limit policy actions taken, by action.",
+            ("action",))
+        for action in ("disconnect", "drop", "pause"):
+            self.sendq_actions.labels(action)
+        self.flood_actions = metrics.counter(
+            "irc_flood_actions_total",
+            "Flood control actions taken, by action.", ("action",))
+        for action in ("delay", "pause"):
+            self.flood_actions.labels(action)
+        metrics.gauge("irc_send_queues_bytes",
+                      "Bytes in all send queues, counting shared data once.",
+                      lambda: {(): self.queued_bytes})
+        metrics.histogram(
+            "irc_send_queue_bytes",
+            "Queued outgoing bytes per client, when collected.",
+            BYTES_BOUNDS, function=self.__send_queue_histogram)
+        # Time spent handling events, timers and flushing in an event
+        # loop iteration, i.e. everything but waiting in poll().
+        self.loop_seconds = metrics.histogram(
+            "irc_loop_iteration_seconds",
+            "Busy time per event loop iteration.", LATENCY_BOUNDS)
+        self.loop_busy_max = 0.0
+
+    def __send_queue_histogram(self):
+        histogram = Histogram(BYTES_BOUNDS)
+        for client in self.clients.values():
+            histogram.observe(client.write_queue_size())
+        return {(): histogram}
+
+    def backlog_ready(self, client):
+        """Have client.handle_backlog() called in the next iteration."""
+        self.__backlogged.append(client)
 
     def get_client(self, nickname):
         return self.nicknames.get(irc_lower(nickname))
@@ -619,15 +2638,30 @@ class Server(object):
         return irc_lower(name) in self.channels
 
     def get_channel(self, channelname):
-        if irc_lower(channelname) in self.channels:
-            channel = self.channels[irc_lower(channelname)]
-        else:
+        channel = self.channels.get(irc_lower(channelname))
+        if channel is None:
             channel = Channel(self, channelname)
-            self.channels[irc_lower(channelname)] = channel
+            self.channels[channel.lower_name] = channel
+            bisect.insort(self.channel_index, channel.lower_name)
         return channel
 
+    def iter_channels(self, prefix=""):
+        """Yield channels in order of irc_lower()ed name.
+
+        Only channels whose irc_lower()ed names start with prefix are
+        yielded. Channels may be created and removed between steps.
+        """
+        index = self.channel_index
+        position = _bisect_left(index, prefix)
+        while position < len(index):
+            name = index[position]
+            if not name.startswith(prefix):
+                break
+            yield self.channels[name]
+            position = bisect.bisect_right(index, name)
+
     def get_motd_lines(self):
-	return self.motd
+        return self.motd
 
     def print_info(self, msg):
         if self.verbose:
@@ -645,76 +2679,623 @@ class Server(object):
     def client_changed_nickname(self, client, oldnickname):
         if oldnickname:
             del self.nicknames[irc_lower(oldnickname)]
-        self.nicknames[irc_lower(client.nickname)] = client
+        self.nicknames[client.lower_nickname] = client
+        for channel in client.channels.values():
+            channel.rename_member(oldnickname, client.nickname)
 
     def remove_member_from_channel(self, client, channelname):
-        if irc_lower(channelname) in self.channels:
-            channel = self.channels[irc_lower(channelname)]
+        channel = self.channels.get(irc_lower(channelname))
+        if channel is not None:
             channel.remove_client(client)
 
     def remove_client(self, client, quitmsg):
-        client.message_related(":%s QUIT :%s" % (client.prefix, quitmsg))
-        for x in client.channels.values():
-            client.channel_log(x, "quit (%s)" % quitmsg, meta=True)
-            x.remove_client(client)
-        if client.nickname \
-                and irc_lower(client.nickname) in self.nicknames:
-            del self.nicknames[irc_lower(client.nickname)]
-        del self.clients[client.socket]
+        if self.__deferring_flush:
+            # Clients often go away together, e.g. after a network
+            # problem; let remove_clients handle them in one go.
+            self.__quitting.append((client, quitmsg))
+        else:
+            self.remove_clients([(client, quitmsg)])
+
+    def remove_clients(self, quits):
+        """Forget disconnected clients and tell their channels.
+
+        quits is a list of (client, quit message) pairs, where clients
+        may also be RemoteClients that quit elsewhere. All of the
+        clients leave their channels before any QUIT is sent, so clients
+        quitting together don't get each other's QUITs, and each
+        remaining member gets all QUITs meant for it as one chunk.
+        """
+        for (client, quitmsg) in quits:
+            for x in client.channels.values():
+                client.channel_log(x, "quit (%s)" % quitmsg, meta=True)
+                x.remove_client(client)
+            if self.nicknames.get(client.lower_nickname) is client:
+                del self.nicknames[client.lower_nickname]
+            if client.link is None:
+                del self.clients[client.socket]
+                if self.network is not None:
+                    self.network.quit(client, quitmsg)
+        outbox = {}  # Client --> [QUIT line]
+        for (client, quitmsg) in quits:
+            if not client.channels:
+                continue
+            line = ":%s QUIT :%s" % (client.prefix, quitmsg)
+            self.__epoch += 1
+            epoch = self.__epoch
+            recipients = 0
+            for channel in client.channels.values():
+                for member in channel.members:
+                    if member.broadcast_epoch != epoch:
+                        member.broadcast_epoch = epoch
+                        recipients += 1
+                        lines = outbox.get(member)
+                        if lines is None:
+                            outbox[member] = [line]
+                        else:
+                            lines.append(line)
+            self.broadcast_recipients.observe(recipients)
+        for (member, lines) in outbox.items():
+            member.enqueue("\r\n".join(lines) + "\r\n")
+
+    def __load_channels(self):
+        store = self.channel_store = ChannelStore(self.state_dir)
+        channels = self.channels
+        # Creating this many objects at once would set off many garbage
+        # collections for nothing.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            for (lower_name, (name, topic, topic_time, key)) \
+                    in store.load().items():
+                channel = Channel(self, name, lower_name)
+                channel.load(topic, topic_time, key)
+                channel.persistent = True
+                channels[channel.lower_name] = channel
+        finally:
+            if collecting:
+                gc.enable()
+        self.channel_index = sorted(channels)
+        self.print_info("Loaded %d persistent channels." % len(channels))
+        self.scheduler.call_later(
+            self.state_compact_interval, self.__compact_channels)
+
+    def __compact_channels(self):
+        store = self.channel_store
+        if store.journal_size > max(2 ** 16, store.snapshot_size):
+            store.compact([
+                (x.name, x.topic, x.topic_time, x.key)
+                for x in self.channels.values() if x.persistent])
+        self.scheduler.call_later(
+            self.state_compact_interval, self.__compact_channels)
+
+    def set_channel_persistent(self, channel, persistent):
+        """Make channel persistent, or not.
+
+        Persistent channels stay when their last member leaves, and
+        with state_dir also across restarts, with topic and key.
+        """
+        if channel.persistent == persistent:
+            return
+        channel.persistent = persistent
+        if persistent:
+            self.channel_changed(channel)
+        else:
+            if self.channel_store is not None:
+                self.channel_store.remove(channel.name)
+            if not channel.members and not channel.remote_members:
+                self.remove_channel(channel)
+
+    def channel_changed(self, channel):
+        """Record the state of a persistent channel."""
+        if self.channel_store is not None:
+            self.channel_store.set(channel.name, channel.topic,
+                                   channel.topic_time, channel.key)
 
     def remove_channel(self, channel):
-        del self.channels[irc_lower(channel.name)]
+        del self.channels[channel.lower_name]
+        index = self.channel_index
+        del index[_bisect_left(index, channel.lower_name)]
+        if channel.history is not None and channel.history.log is not None:
+            channel.history.log.close()
+
+    def log_channel(self, channel, source, command, text):
+        """Add a line to the history of channel.
+
+        The line is stored as ":source command channel :[time] text",
+        ready to be replayed as is. Lines written to a HistoryLog are
+        buffered and flushed every history_flush_interval seconds.
+        """
+        history = self.get_history(channel)
+        if history is None:
+            return
+        now = time.time()
+        second = int(now)
+        if second != self.__history_second:
+            self.__history_second = second
+            # UTC, in the form CHATHISTORY timestamp= references take.
+            self.__history_stamp = time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", time.gmtime(second))
+        line = ":%s %s %s :[%s] %s\r\n" % (
+            source, command, channel.name, self.__history_stamp, text)
+        if history.append(now, line):
+            self.__unflushed_logs.append(history.log)
+            if self.__history_timer is None:
+                self.__history_timer = self.scheduler.call_later(
+                    self.history_flush_interval, self.flush_history)
+
+    def get_history(self, channel):
+        """Return the ChannelHistory of channel, or None if disabled."""
+        history = channel.history
+        if history is None:
+            if not self.history_length and not self.history_dir:
+                return None
+            history = channel.history = ChannelHistory(
+                self.history_length, self.__open_history_log(channel))
+        return history
+
+    def __open_history_log(self, channel):
+        if not self.history_dir:
+            return None
+        directory = os.path.join(
+            self.history_dir, _history_dirname(channel.lower_name))
+        try:
+            return HistoryLog(directory, self.history_segment_size,
+                              self.history_segments)
+        except EnvironmentError as e:
+            self.print_error("Could not open history log %s: %s"
+                             % (directory, e))
+            return None
+
+    def flush_history(self):
+        """Write buffered channel history to disk."""
+        if self.__history_timer is not None:
+            self.__history_timer.cancel()
+            self.__history_timer = None
+        logs = self.__unflushed_logs
+        self.__unflushed_logs = []
+        for log in logs:
+            try:
+                log.flush()
+            except EnvironmentError as e:
+                self.print_error("Could not write history log %s: %s"
+                                 % (log.directory, e))
+
+    def broadcast(self, clients, line, exclude=None, low_priority=False):
+        """Queue line for each of clients except exclude.
+
+        The line is encoded once and the same string is queued for every
+        recipient. See Client.enqueue for low_priority.
+        """
+        self.broadcast_recipients.observe(len(clients))
+        data = line + "\r\n"
+        for client in clients:
+            if client is not exclude:
+                client.enqueue(data, low_priority)
+
+    def broadcast_channels(self, channels, line, exclude=None,
+                           include=None, low_priority=False):
+        """Queue line once for each member of channels, and for include.
+
+        exclude is skipped. Clients in several of the channels are
+        recognised by stamping them with a number unique to this call
+        (Client.broadcast_epoch), so no set of recipients is built.
+        """
+        self.__epoch += 1
+        epoch = self.__epoch
+        data = line + "\r\n"
+        recipients = 0
+        if exclude is not None:
+            exclude.broadcast_epoch = epoch
+        if include is not None and include.broadcast_epoch != epoch:
+            include.broadcast_epoch = epoch
+            include.enqueue(data, low_priority)
+            recipients += 1
+        for channel in channels:
+            for client in channel.members:
+                if client.broadcast_epoch != epoch:
+                    client.broadcast_epoch = epoch
+                    client.enqueue(data, low_priority)
+                    recipients += 1
+        self.broadcast_recipients.observe(recipients)
+
+    def broadcast_lines(self, clients, lines, exclude=None,
+                        low_priority=False):
+        """Queue lines for each of clients except exclude, in one chunk."""
+        if not lines:
+            return
+        self.broadcast_recipients.observe(len(clients))
+        data = "\r\n".join(lines) + "\r\n"
+        for client in clients:
+            if client is not exclude:
+                client.enqueue(data, low_priority)
+
+    def chunk_queued(self, chunk):
+        # Count the bytes of chunk once, however many send queues hold
+        # it. Only done when global_sendq_limit is set. A chunk is
+        # keyed by id(), which is stable while a queue references it.
+        entry = self.__chunk_references.get(id(chunk))
+        if entry is None:
+            self.__chunk_references[id(chunk)] = [1, len(chunk)]
+            self.queued_bytes += len(chunk)
+        else:
+            entry[0] += 1
+
+    def chunk_dequeued(self, chunk):
+        entry = self.__chunk_references[id(chunk)]
+        entry[0] -= 1
+        if entry[0] == 0:
+            del self.__chunk_references[id(chunk)]
+            self.queued_bytes -= entry[1]
+
+    def inject(self, callback, *args):
+        """Run callback(*args) in the event loop.
+
+        This is the only Server method that is safe to call from other
+        threads. Callbacks run in the order they were injected. Returns
+        False, and queues nothing, if max_injected callbacks are already
+        waiting.
+        """
+        with self.__inject_lock:
+            if len(self.__injected) >= self.max_injected:
+                return False
+            self.__injected.append((callback, args))
+            wake = not self.__wakeup_pending
+            self.__wakeup_pending = True
+        if wake:
+            self.__waker.wake()
+        return True
+
+    def run_injected(self):
+        injected = self.__injected
+        for _ in range(self.inject_batch_size):
+            try:
+                (callback, args) = injected.popleft()
+            except IndexError:
+                break
+            try:
+                callback(*args)
+            except Exception:
+                self.print_error("Error in injected callback %r:\n%s"
+                                 % (callback, traceback.format_exc()))
+        with self.__inject_lock:
+            if injected:
+                # Let other events in before running the next batch.
+                self.__waker.wake()
+            else:
+                self.__wakeup_pending = False
 
-    def run(self):
-        serversockets = []
+    def schedule_flush(self, client):
+        if self.__deferring_flush:
+            self.__flush_pending.append(client)
+        else:
+            # Called outside the event loop's dispatch phase.
+            client.flush()
+
+    def flush_pending(self):
+        """Send data queued since the last flush phase.
+
+        Clients that disconnected since then are removed first.
+        """
+        # Flushing may disconnect clients, which queues more data.
+        while self.__flush_pending or self.__quitting:
+            if self.__quitting:
+                quitting = self.__quitting
+                self.__quitting = []
+                self.remove_clients(quitting)
+            pending = self.__flush_pending
+            self.__flush_pending = []
+            for client in pending:
+                client.flush()
+
+    def add_client(self, conn):
+        try:
+            client = Client(self, conn)
+        except socket.error:
+            try:
+                conn.close()
+            except:
+                pass
+            return None
+        conn.setblocking(0)
+        if conn.family in (socket.AF_INET, socket.AF_INET6):
+            # Writes are already batched in the flush phase; Nagle would
+            # only delay them further.
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.clients[conn] = client
+        self.poller.register(conn.fileno(), client)
+        self.print_info("Accepted connection from %s:%s." % (
+            client.host, client.port))
+        return client
+
+    def listen(self):
+        """Open the listening sockets. Called by run()."""
+        self.__listening = True
         for port in self.ports:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                s.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
             try:
                 s.bind((self.address, port))
             except socket.error as e:
                 self.print_error("Could not bind port %s: %s." % (port, e))
                 raise
-            s.listen(5)
-            serversockets.append(s)
+            s.listen(socket.SOMAXCONN)
+            s.setblocking(0)
+            self.__add_listener(s)
             del s
             self.print_info("Listening on port %d." % port)
-        last_aliveness_check = time.time()
-        while True:
-            (iwtd, owtd, ewtd) = select.select(
-                serversockets + [x.socket for x in self.clients.values()],
-                [x.socket for x in self.clients.values()
-                 if x.write_queue_size() > 0],
-                [],
-                10)
-            for x in iwtd:
-                if x in self.clients:
-                    self.clients[x].socket_readable_notification()
-                else:
-                    (conn, addr) = x.accept()
-                    try:
-                        self.clients[conn] = Client(self, conn)
-                        self.print_info("Accepted connection from %s:%s." % (
-                            addr[0], addr[1]))
-                    except socket.error as e:
-                        try:
-                            conn.close()
-                        except:
-                            pass
-            for x in owtd:
-                if x in self.clients:  # client may have been disconnected
-                    self.clients[x].socket_writable_notification()
-            now = time.time()
-            if last_aliveness_check + 10 < now:
-                for client in self.clients.values():
-                    client.check_aliveness()
-                last_aliveness_check = now
+        self.poller.register(self.__waker.read_fd, self.__waker)
 
+    def __add_listener(self, sock):
+        listener = _Listener(self, sock)
+        self.poller.register(sock.fileno(), listener)
+        self.__listeners.append(listener)
+
+    def run(self):
+        """Serve clients until stop() is called.
+
+        May be called again after returning, to carry on.
+        """
+        if not self.__listening:
+            self.listen()
+        try:
+            while not self.__stopping:
+                self.run_once()
+        finally:
+            self.__stopping = False
+            self.flush_history()
+
+    def run_once(self, max_timeout=None):
+        """Wait for and handle one batch of events and due timers.
+
+        Waits at most max_timeout seconds, if given.
+        """
+        poller = self.poller
+        scheduler = self.scheduler
+        if self.__backlogged:
+            timeout = 0
+        else:
+            timeout = scheduler.timeout(time.time())
+        if max_timeout is not None and (timeout is None
+                                        or timeout > max_timeout):
+            timeout = max_timeout
+        events = poller.poll(timeout)
+        started = time.time()
+        self.__deferring_flush = True
+        backlogged = self.__backlogged
+        if backlogged:
+            self.__backlogged = []
+            for client in backlogged:
+                client.handle_backlog()
+        for (fd, handler, readable, writable) in events:
+            # A handler earlier in this batch may have closed the socket,
+            # and its descriptor may even have been reused.
+            if readable and poller.owns(fd, handler):
+                handler.socket_readable_notification()
+            if writable and poller.owns(fd, handler):
+                handler.socket_writable_notification()
+        scheduler.run_due(time.time())
+        self.flush_pending()
+        self.__deferring_flush = False
+        busy = time.time() - started
+        self.loop_seconds.observe(busy)
+        if busy > self.loop_busy_max:
+            self.loop_busy_max = busy
+
+    def stop(self):
+        """Make run() return after the current loop iteration.
+
+        Like inject(), safe to call from other threads, and also from
+        signal handlers.
+        """
+        self.__stopping = True
+        self.__waker.wake()
+
+    def close(self, quitmsg="Server shutting down"):
+        """Stop listening and disconnect all clients.
+
+        Call after run() has returned. Timers and other handlers on the
+        poller are left alone, so run_once() can still be used to finish
+        outstanding work.
+        """
+        for listener in self.__listeners:
+            self.poller.unregister(listener.socket.fileno(), listener)
+            listener.socket.close()
+        self.__listeners = []
+        # Let remove_clients handle all of them together.
+        self.__deferring_flush = True
+        for client in list(self.clients.values()):
+            client.disconnect(quitmsg)
+        self.flush_pending()
+        self.__deferring_flush = False
+        self.flush_history()
+        if self.channel_store is not None:
+            self.channel_store.close()
+
+    def get_state(self):
+        """Return (state, sockets) for handing the server over.
+
+        Another process can resume service with set_state(), given the
+        state, which is made of plain data for pickling, and duplicates
+        of the sockets: the listening sockets, then the clients'. Call
+        after run() has returned, and detach() once the other process
+        has taken over. Linked servers (see network) can't be handed
+        over.
+        """
+        if self.network is not None:
+            raise ValueError("can't hand over a server with a network")
+        self.flush_history()
+        if self.channel_store is not None:
+            # The other process loads it; see set_state.
+            self.channel_store.close()
+        sockets = [x.socket for x in self.__listeners]
+        clients = []
+        for client in self.clients.values():
+            state = client.get_state()
+            state["socket"] = len(sockets)
+            sockets.append(client.socket)
+            clients.append(state)
+        channels = []
+        for channel in self.channels.values():
+            if channel.history is None:
+                history = None
+            else:
+                history = list(channel.history.ring)
+            channels.append({
+                "name": channel.name,
+                "topic": channel.topic,
+                "topic_time": channel.topic_time,
+                "key": channel.key,
+                "persistent": channel.persistent,
+                "history": history,
+            })
+        state = {
+            "listeners": len(self.__listeners),
+            "clients": clients,
+            "channels": channels,
+        }
+        return (state, sockets)
+
+    def set_state(self, state, sockets):
+        """Resume service from get_state() of another process.
+
+        Call before run(), which then uses the given listening sockets
+        instead of opening new ones.
+        """
+        for sock in sockets[:state["listeners"]]:
+            sock.setblocking(0)
+            self.__add_listener(sock)
+        self.poller.register(self.__waker.read_fd, self.__waker)
+        self.__listening = True
+        for x in state["channels"]:
+            # Persistent channels have been loaded from state_dir, if
+            # set, with the same topic and key.
+            channel = self.get_channel(x["name"])
+            channel.load(x["topic"], x["topic_time"], x["key"])
+            self.set_channel_persistent(channel, x["persistent"])
+            if x["history"]:
+                history = self.get_history(channel)
+                if history is not None:
+                    history.ring.extend(x["history"])
+        for x in state["clients"]:
+            client = self.add_client(sockets[x["socket"]])
+            if client is None:
+                continue
+            client.set_state(x)
+            if client.nickname is not None:
+                self.nicknames[client.lower_nickname] = client
+            for name in x["channels"]:
+                channel = self.get_channel(name)
+                channel.add_member(client)
+                client.channels[channel.lower_name] = channel
+        self.print_info("Resumed %d clients and %d channels."
+                        % (len(state["clients"]), len(state["channels"])))
+
+    def detach(self):
+        """Forget all clients and listening sockets without a word.
+
+        For after get_state() has been handed to another process, which
+        carries on from there; this process' copies of the sockets are
+        closed. Other handlers on the poller are left alone.
+        """
+        for listener in self.__listeners:
+            self.poller.unregister(listener.socket.fileno(), listener)
+            listener.socket.close()
+        self.__listeners = []
+        for client in self.clients.values():
+            client.detach()
+        self.clients = {}
+        self.nicknames = {}
+        self.channels = {}
+        self.channel_index = []
+        self.__backlogged = []
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+_bisect_left = bisect.bisect_left
+_INFINITY = float("inf")
+_NEG_INFINITY = float("-inf")
 _maketrans = str.maketrans if sys.version_info[0] == 3 else string.maketrans
+_intern = sys.intern if sys.version_info[0] == 3 else intern
 _ircstring_translation = _maketrans(
     string.ascii_lowercase.upper() + "[]\\^",
     string.ascii_lowercase + "{}|~")
 
 
+# Bounded memo of irc_lower results for names supplied by clients. It is
+# simply emptied when full.
+_irc_lower_cache = {}
+_IRC_LOWER_CACHE_SIZE = 4096
+
+
 def irc_lower(s):
-    return string.translate(s, _ircstring_translation)
+    try:
+        return _irc_lower_cache[s]
+    except KeyError:
+        pass
+    result = s.translate(_ircstring_translation)
+    if len(_irc_lower_cache) >= _IRC_LOWER_CACHE_SIZE:
+        _irc_lower_cache.clear()
+    _irc_lower_cache[s] = result
+    return result
+
+
+def _read_history_index(path):
+    """Return (times, offsets) arrays read from a HistoryLog index."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except IOError:
+        data = b""
+    entries = array.array("d")
+    data = data[:len(data) - len(data) % (2 * entries.itemsize)]
+    if hasattr(entries, "frombytes"):
+        entries.frombytes(data)
+    else:
+        entries.fromstring(data)
+    return (entries[0::2], entries[1::2])
+
+
+def _history_end(segment, offsets):
+    """Return the offset just after the last indexed line in segment."""
+    if not offsets:
+        return 0
+    last = int(offsets[-1])
+    end = segment.find(b"\n", last)
+    if end < 0:
+        return last
+    return end + 1
+
+
+def _mask_regexp(mask):
+    """Compile a mask with * and ? wildcards for irc_lower()ed names."""
+    pattern = "".join(
+        ".*" if c == "*" else "." if c == "?" else re.escape(c)
+        for c in irc_lower(mask))
+    return re.compile(pattern + r"\Z", re.DOTALL)
+
+
+def _history_dirname(lower_name):
+    return lower_name.replace("_", "__").replace("/", "_")
+
+
+def _parse_history_timestamp(reference):
+    """Parse a CHATHISTORY "timestamp=YYYY-MM-DDThh:mm:ss.sssZ" reference.
+
+    Returns seconds since the epoch. Raises ValueError if reference is
+    not a valid timestamp reference.
+    """
+    if not reference.startswith("timestamp="):
+        raise ValueError(reference)
+    (whole, _, fraction) = reference[10:].rstrip("Z").partition(".")
+    seconds = calendar.timegm(time.strptime(whole, "%Y-%m-%dT%H:%M:%S"))
+    if not fraction:
+        return float(seconds)
+    if not fraction.isdigit():
+        raise ValueError(reference)
+    return seconds + float("0." + fraction)
@@ -0,0 +1,139 @@
+"""Handing a running miniircd Server over to a new process.
+
+The old process starts the new one with one end of a Unix socket pair,
+then sends it the server's state (Server.get_state) and duplicates of
+the listening and client sockets, passed as SCM_RIGHTS. The new process
+restores the state (Server.set_state) and confirms; from then on it
+serves the clients, and the old process forgets them (Server.detach)
+and exits. Clients stay connected throughout: while neither process
+reads their sockets, what they send waits in the kernel, and lines
+read or queued but not yet handled or sent are part of the state.
+
+    if hand_over(server, [sys.executable] + sys.argv):
+        server.detach()
+
+and in the new process, started with --resume-fd FD appended:
+
+    take_over(server, fd)
+    server.run()
+"""
+
+import os
+import pickle
+import socket
+import struct
+import subprocess
+
+try:
+    from multiprocessing.reduction import recvfds, sendfds
+except ImportError:
+    # Python 2.
+    import _multiprocessing
+
+    def sendfds(sock, fds):
+        for fd in fds:
+            _multiprocessing.sendfd(sock.fileno(), fd)
+
+    def recvfds(sock, count):
+        return [_multiprocessing.recvfd(sock.fileno()) for _ in range(count)]
+
+_HEADER = struct.Struct("!I")
+
+# Descriptors passed per message; the kernel limit (SCM_MAX_FD) is 253.
+_FDS_PER_MESSAGE = 200
+
+
+def _recv_exactly(sock, length):
+    # Reading past the state would lose the descriptors sent after it.
+    pieces = []
+    while length:
+        data = sock.recv(length)
+        if not data:
+            raise EOFError("connection closed")
+        pieces.append(data)
+        length -= len(data)
+    return b"".join(pieces)
+
+
+def _close_fds_except(fd):
+    os.closerange(3, fd)
+    os.closerange(fd + 1, subprocess.MAXFD)
+
+
+def hand_over(server, argv, extra_sockets=(), timeout=60):
+    """Start argv as a new process and hand server over to it.
+
+    Call after server.run() has returned. argv is given --resume-fd and
+    a descriptor to pass to take_over(). extra_sockets, e.g. other
+    listening sockets, are passed along as they are.
+
+    Returns True once the new process has taken over; then call
+    server.detach(). Returns False, having logged why, if it failed;
+    server is then as it was and run() can carry on.
+    """
+    (ours, theirs) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    process = None
+    try:
+        (state, sockets) = server.get_state()
+        sockets.extend(extra_sockets)
+        fd = theirs.fileno()
+        argv = argv + ["--resume-fd", str(fd)]
+        # The new process must not hold copies of other descriptors,
+        # such as client sockets it did not get through take_over().
+        if hasattr(subprocess, "MAXFD"):
+            # Python 2.
+            process = subprocess.Popen(
+                argv, preexec_fn=lambda: _close_fds_except(fd))
+        else:
+            process = subprocess.Popen(argv, pass_fds=[fd])
+        theirs.close()
+        ours.settimeout(timeout)
+        payload = pickle.dumps(
+            {"state": state,
+             "families": [x.family for x in sockets],
+             "extra": len(extra_sockets)},
+            2)
+        ours.sendall(_HEADER.pack(len(payload)) + payload)
+        fds = [x.fileno() for x in sockets]
+        for i in range(0, len(fds), _FDS_PER_MESSAGE):
+            sendfds(ours, fds[i:i + _FDS_PER_MESSAGE])
+        if ours.recv(2) != b"ok":
+            raise EOFError("the new process did not take over")
+    except (EnvironmentError, EOFError, ValueError) as e:
+        server.print_error("Could not hand over: %s." % e)
+        if process is not None and process.poll() is None:
+            process.kill()
+        return False
+    finally:
+        ours.close()
+        theirs.close()
+    server.print_info("Handed over to process %d." % process.pid)
+    return True
+
+
+def take_over(server, fd):
+    """Resume service of the server handed over on descriptor fd.
+
+    Call before server.run(). Returns the extra_sockets given to
+    hand_over().
+    """
+    sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(fd)
+    try:
+        (length,) = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+        message = pickle.loads(_recv_exactly(sock, length))
+        families = message["families"]
+        fds = []
+        while len(fds) < len(families):
+            fds.extend(recvfds(
+                sock, min(_FDS_PER_MESSAGE, len(families) - len(fds))))
+        sockets = []
+        for (family, fd) in zip(families, fds):
+            sockets.append(socket.fromfd(fd, family, socket.SOCK_STREAM))
+            os.close(fd)
+        extra = len(sockets) - message["extra"]
+        server.set_state(message["state"], sockets[:extra])
+        sock.sendall(b"ok")
+    finally:
+        sock.close()
+    return sockets[extra:]
@@ -1,9 +1,14 @@
 import web
+import json
 import sys
-import simplejson
+import Queue
+
+import bridge
 
 urls = (
-  '/', 'index'
+  '/', 'index',
+  '/bulk', 'bulk',
+  '/metrics', 'metrics',
 )
 
 ircd = getattr(sys.modules['__main__'], 'ircd', None)
@@ -15,48 +20,74 @@ class index:
 	channel = '#' + str(input.channel_name)
 	user_name = input.user_name
 	message = input.text
-	chan = ircd.get_channel(channel)
-	for client in chan.members:
-		client.message(':%s PRIVMSG %s :%s' % (user_name, channel, message))
+	if not bridge.valid_nickname(user_name):
+		raise web.BadRequest('Invalid user_name')
+	# Runs on the web.py thread; hand the message to the IRC loop.
+	if not ircd.inject(bridge.relay_to_channel, ircd, channel, user_name, message):
+		raise web.HTTPError('503 Service Unavailable')
 	return ""
 
+class bulk:
+	def POST(self):
+		# Body is a JSON array or newline-delimited JSON objects with
+		# channel_name, user_name and text; see bridge.parse_bulk.
+		try:
+			results = bridge.ingest_bulk(ircd, web.data())
+		except ValueError, e:
+			raise web.BadRequest('Invalid JSON: %s' % e)
+		except Queue.Full:
+			raise web.HTTPError('503 Service Unavailable')
+		web.header('Content-Type', 'application/json')
+		return json.dumps({'results': results})
+
+class metrics:
+	def GET(self):
+		# The registry belongs to the IRC loop; render it there.
+		try:
+			completion = bridge.call_in_loop(ircd, 5, ircd.metrics.render)
+		except Queue.Full:
+			raise web.HTTPError('503 Service Unavailable')
+		if not completion.event.is_set() or completion.failed:
+			raise web.HTTPError('503 Service Unavailable')
+		web.header('Content-Type', 'text/plain; version=0.0.4')
+		return completion.value
+
 channels = {
 	'#off-topic': '', # hook URL here
 }
 
-import urllib2
-
 import miniircd
-old_message_channel = miniircd.Client.message_channel
-def message_channel(self, channel, command, message, include_self=False):
-	try:
-		print "message_channel", channel, command, message, include_self
-		if command == 'PRIVMSG' and channel.name in channels:
-			url = channels[channel.name]
-			print url
-			resp = urllib2.urlopen(url, 'payload=' + simplejson.dumps({'text': message.split(' ', 1)[1][1:], 'username': self.nickname}))
-			print "Fetched"
-			print resp
-			print list(resp)
-		else:
-			print channel.name, channels, command
-		print "Done."
-	except:
-		import traceback
-		traceback.print_exc()
-	old_message_channel(self, channel, command, message)
-miniircd.Client.message_channel = message_channel
+
+dispatcher = bridge.WebhookDispatcher()
+# Lines said within a second of each other go out as one webhook call.
+coalescer = bridge.Coalescer(dispatcher, window=1.0, max_batch=20)
+bridge.bridge_channels(channels, coalescer)
+if ircd is not None:
+	dispatcher.register_metrics(ircd.metrics)
+	coalescer.register_metrics(ircd.metrics)
 
 app = web.application(urls, globals())
 
 if __name__ == '__main__':
 	import threading
+	dispatcher.start()
 	ht = threading.Thread(target=app.run)
 	ht.setDaemon(True)
 	ht.start()
-	ircd = miniircd.Server()
+	ircd = miniircd.Server(history_on_join=20)
+	dispatcher.register_metrics(ircd.metrics)
+	coalescer.register_metrics(ircd.metrics)
+	coalescer.start(ircd.scheduler)
 	it = threading.Thread(target=ircd.run)
 	it.setDaemon(True)
 	it.start()
-	import pdb
-	pdb.set_trace()
+	import signal
+	signal.signal(signal.SIGINT, lambda signum, frame: ircd.stop())
+	signal.signal(signal.SIGTERM, lambda signum, frame: ircd.stop())
+	# Join with a timeout so that the main thread still gets signals.
+	while it.is_alive():
+		it.join(1)
+	# The loop has stopped, so its state can be used from here.
+	coalescer.stop()
+	ircd.close()
+	dispatcher.stop(10)